@@ -0,0 +1,185 @@
+import dbm
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Union
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+from dotenv import load_dotenv
+
+from backend import metrics
+from backend.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+# "db"     - carts are TEMP rows in orders/order_items (the original behaviour)
+# "memory" - carts live in this process only and are lost on restart
+# "dbm"    - carts live in a local key-value file shared by restarts and by
+#            the workers on this host (not by several hosts)
+CART_STORE = os.getenv("CART_STORE", "db").lower()
+CART_TTL = float(os.getenv("CART_TTL", "86400"))
+CART_STORE_MAX = int(os.getenv("CART_STORE_MAX", "100000"))
+CART_STORE_PATH = os.getenv("CART_STORE_PATH", "data/carts.dbm")
+CART_PURGE_INTERVAL = float(os.getenv("CART_PURGE_INTERVAL", "600"))
+
+# order_id under which a stored cart is shown and closed through the orders API.
+CART_ORDER_ID = 0
+
+# A cart is {product_id: quantity}. Stored carts hold no stock: it is reserved
+# when the cart is closed and turned into a real order (see inventory.close_stored_cart).
+
+
+def _merge(cart: Dict[int, int], lines: Dict[int, int], sign: int) -> Dict[int, int]:
+    """Add (sign=1) or take out (sign=-1) `lines`; lines that drop to zero are removed."""
+    for product_id, quantity in lines.items():
+        left = cart.get(product_id, 0) + sign * quantity
+        if left > 0:
+            cart[product_id] = left
+        else:
+            cart.pop(product_id, None)
+    return cart
+
+
+class MemoryCartStore:
+    """Carts in a TTLCache; every write refreshes the cart's TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._carts = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Dict[int, int]:
+        return dict(self._carts.get(user_id) or {})
+
+    def add(self, user_id: int, lines: Dict[int, int]) -> Dict[int, int]:
+        with self._lock:
+            cart = _merge(self.get(user_id), lines, 1)
+            self._carts.set(user_id, cart)
+            return dict(cart)
+
+    def remove(self, user_id: int, lines: Dict[int, int]) -> None:
+        """Take `lines` out of the cart (after they were ordered); lines added meanwhile stay."""
+        with self._lock:
+            cart = _merge(self.get(user_id), lines, -1)
+            if cart:
+                self._carts.set(user_id, cart)
+            else:
+                self._carts.pop(user_id)
+
+    def purge_expired(self) -> int:
+        return self._carts.purge_expired()
+
+    def stats(self) -> dict:
+        return {"store": "memory", **self._carts.stats()}
+
+
+class DbmCartStore:
+    """
+    Carts in a local dbm file (JSON values with an absolute expiry time), so
+    they survive restarts without touching the database.
+
+    dbm files are not safe for concurrent writers, and an open handle does not
+    see writes made through another one. So every operation takes an exclusive
+    flock on `<path>.lock` (and a thread lock within the process), opens the
+    file, and closes it again: worker processes on the same host can share the
+    file. Workers on different hosts cannot; use CART_STORE=db there.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        if fcntl is None:
+            raise RuntimeError("CART_STORE=dbm needs fcntl file locks, which this platform lacks")
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._lock_path = f"{path}.lock"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._open():
+            pass
+
+    @contextmanager
+    def _open(self) -> Iterator:
+        # A lock file opened per operation: a descriptor inherited across fork
+        # would share its flock with the parent.
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with dbm.open(self.path, "c") as db:
+                yield db
+
+    def _load(self, db, user_id: int) -> Dict[int, int]:
+        raw = db.get(str(user_id))
+        if raw is None:
+            return {}
+        entry = json.loads(raw)
+        if entry["expires_at"] <= time.time():
+            del db[str(user_id)]
+            return {}
+        return {int(product_id): quantity for product_id, quantity in entry["lines"].items()}
+
+    def _save(self, db, user_id: int, cart: Dict[int, int]) -> None:
+        if cart:
+            db[str(user_id)] = json.dumps({"expires_at": time.time() + self.ttl, "lines": cart})
+        elif str(user_id) in db:
+            del db[str(user_id)]
+
+    def get(self, user_id: int) -> Dict[int, int]:
+        with self._open() as db:
+            return self._load(db, user_id)
+
+    def add(self, user_id: int, lines: Dict[int, int]) -> Dict[int, int]:
+        with self._open() as db:
+            cart = _merge(self._load(db, user_id), lines, 1)
+            self._save(db, user_id, cart)
+            return cart
+
+    def remove(self, user_id: int, lines: Dict[int, int]) -> None:
+        with self._open() as db:
+            self._save(db, user_id, _merge(self._load(db, user_id), lines, -1))
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        with self._open() as db:
+            expired = [key for key in db.keys() if json.loads(db[key])["expires_at"] <= now]
+            for key in expired:
+                del db[key]
+        return len(expired)
+
+    def stats(self) -> dict:
+        with self._open() as db:
+            return {"store": "dbm", "path": self.path, "size": len(db), "ttl_seconds": self.ttl}
+
+
+def _create_store():
+    if CART_STORE == "memory":
+        return MemoryCartStore(CART_STORE_MAX, CART_TTL)
+    if CART_STORE == "dbm":
+        return DbmCartStore(CART_STORE_PATH, CART_TTL)
+    if CART_STORE != "db":
+        raise ValueError(f"Unknown CART_STORE '{CART_STORE}' (expected db, memory or dbm)")
+    return None
+
+
+# None when carts are kept as TEMP orders in the database.
+cart_store: Optional[Union[MemoryCartStore, DbmCartStore]] = _create_store()
+
+
+def purge_task() -> None:
+    removed = cart_store.purge_expired()
+    if removed:
+        logger.info(f"Cart store purged {removed} expired carts.")
+
+
+if cart_store is not None:
+    metrics.register("cart_store", cart_store.stats)
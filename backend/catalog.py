@@ -0,0 +1,289 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+
+from backend import changefeed, database, metrics, schemas
+from backend.cache import TTLCache
+from backend.search import product_index, product_suggester
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "10000"))
+PRODUCT_PAGE_CACHE_SIZE = int(os.getenv("PRODUCT_PAGE_CACHE_SIZE", "256"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "60"))
+CATALOG_FOLLOW_INTERVAL = float(os.getenv("CATALOG_FOLLOW_INTERVAL", "5"))
+# How long the shared catalog version (see below) is reused before it is read again.
+CATALOG_VERSION_TTL = float(os.getenv("CATALOG_VERSION_TTL", "1"))
+# Followed changes per batch; a batch this large rebuilds the indexes instead.
+FOLLOW_BATCH_SIZE = 10000
+
+# ==========================================
+# Product caches
+# ==========================================
+# product_id -> ProductOut
+product_cache = TTLCache(PRODUCT_CACHE_SIZE, PRODUCT_CACHE_TTL)
+# (after, limit) -> (List[ProductOut], next_cursor)
+page_cache = TTLCache(PRODUCT_PAGE_CACHE_SIZE, PRODUCT_CACHE_TTL)
+
+# Bumped on every product write. Readers capture it before querying and only
+# fill the cache if it has not moved, so a read that raced with a write can
+# never put the pre-write row back into the cache. Checks and bumps both run
+# under _version_lock.
+_version = 0
+_version_lock = threading.Lock()
+# time.monotonic() of the last bump.
+_changed_at = 0.0
+
+# The change feed's (head, catalog version) (changefeed.version), shared by
+# every process that writes products through this code: API workers, the
+# importer CLI, checkout and the sweeper. ETags are built from it. It is
+# re-read at most every CATALOG_VERSION_TTL seconds, and right after a local
+# write, by one thread at a time; when it moves, the caches are dropped so no
+# body older than it is served. Both fields are guarded by _version_lock.
+_shared_version: Optional[Tuple[int, int]] = None
+_shared_checked_at = 0.0
+_shared_refresh_lock = threading.Lock()
+
+
+def catalog_version() -> int:
+    return _version
+
+
+def _bump_locked() -> None:
+    """Stop every cache fill in flight; call with _version_lock held."""
+    global _version, _changed_at
+    _version += 1
+    _changed_at = time.monotonic()
+
+
+def _fresh_shared_version() -> Optional[Tuple[int, int]]:
+    with _version_lock:
+        if _shared_version is not None and time.monotonic() - _shared_checked_at < CATALOG_VERSION_TTL:
+            return _shared_version
+    return None
+
+
+def shared_version() -> Tuple[int, int]:
+    """The shared version, read from the database when stale; blocks, so async code uses shared_version_async."""
+    global _shared_version, _shared_checked_at
+    current = _fresh_shared_version()
+    if current is not None:
+        return current
+    with _shared_refresh_lock:
+        # Whoever held the lock may just have read it.
+        current = _fresh_shared_version()
+        if current is not None:
+            return current
+        started, seen = time.monotonic(), _version
+        db = database.SessionLocal()
+        try:
+            current = changefeed.version(db)
+        finally:
+            db.close()
+        with _version_lock:
+            if _shared_version is not None and current != _shared_version:
+                # Changed by another process: drop what this one has cached.
+                _bump_locked()
+                product_cache.clear()
+                page_cache.clear()
+            elif _version == seen:
+                # Not after a local write made while reading; that one needs a fresh read.
+                _shared_checked_at = started
+            _shared_version = current
+    return current
+
+
+async def shared_version_async() -> Tuple[int, int]:
+    current = _fresh_shared_version()
+    if current is None:
+        current = await run_in_threadpool(shared_version)
+    return current
+
+
+def changed_within(seconds: float) -> bool:
+    return time.monotonic() - _changed_at < seconds
+
+
+# ==========================================
+# Conditional GET
+# ==========================================
+def _etag(current: Tuple[int, int], parts) -> str:
+    head, version = current
+    key = "|".join(map(str, parts))
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    return f'"{head}.{version}-{digest}"'
+
+
+def etag(*parts) -> str:
+    """Strong ETag for a catalog response: changes whenever any product change is committed."""
+    return _etag(shared_version(), parts)
+
+
+async def etag_async(*parts) -> str:
+    """etag() for async handlers: a stale shared version is read on the threadpool."""
+    return _etag(await shared_version_async(), parts)
+
+
+def etag_matches(if_none_match: Optional[str], current: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or current in candidates or f"W/{current}" in candidates
+
+
+def get_product(product_id: int) -> Optional[schemas.ProductOut]:
+    return product_cache.get(product_id)
+
+
+def cache_product(product, seen_version: Optional[int]) -> schemas.ProductOut:
+    """Convert an ORM product to ProductOut and cache it unless the catalog changed meanwhile (or seen_version is None)."""
+    product_out = schemas.ProductOut.model_validate(product)
+    with _version_lock:
+        if seen_version == _version:
+            product_cache.set(product_out.product_id, product_out)
+    return product_out
+
+
+def get_page(after: Optional[int], limit: int):
+    return page_cache.get((after, limit))
+
+
+def cache_page(after: Optional[int], limit: int, products, next_cursor: Optional[int], seen_version: Optional[int]) -> list:
+    page = [schemas.ProductOut.model_validate(product) for product in products]
+    with _version_lock:
+        if seen_version == _version:
+            page_cache.set((after, limit), (page, next_cursor))
+    return page
+
+
+# ==========================================
+# Invalidation (call after the write commits)
+# ==========================================
+def invalidate_products(product_ids: Iterable[int]) -> None:
+    global _shared_checked_at
+    with _version_lock:
+        _bump_locked()
+        # The write just committed a change feed entry; read the new version on the next ETag.
+        _shared_checked_at = 0.0
+        for product_id in product_ids:
+            product_cache.pop(product_id)
+        page_cache.clear()
+
+
+def invalidate_catalog() -> None:
+    global _shared_checked_at
+    with _version_lock:
+        _bump_locked()
+        _shared_checked_at = 0.0
+        product_cache.clear()
+        page_cache.clear()
+
+
+# ==========================================
+# Product write hooks (call after the write commits)
+# ==========================================
+def product_saved(product) -> None:
+    """A product was created or updated; `product` is the refreshed ORM row."""
+    products_saved([product])
+
+
+def products_saved(products: Iterable) -> None:
+    """Several products changed; invalidates the caches once for all of them."""
+    products = list(products)
+    invalidate_products(product.product_id for product in products)
+    product_index.upsert_many(
+        (product.product_id, product.name, product.price, product.stock_amount) for product in products
+    )
+    for product in products:
+        product_suggester.upsert(product.product_id, product.name, product.stock_amount)
+
+
+def product_deleted(product_id: int) -> None:
+    invalidate_products([product_id])
+    product_index.remove(product_id)
+    product_suggester.remove(product_id)
+
+
+def stock_adjusted(deltas: Dict[int, int]) -> None:
+    """Stock moved by `deltas` ({product_id: change}) through an order, not a product edit."""
+    invalidate_products(deltas)
+    for product_id, delta in deltas.items():
+        product_index.adjust_stock(product_id, delta)
+        product_suggester.adjust_stock(product_id, delta)
+
+
+def catalog_reloaded(session_factory) -> None:
+    """Many products changed at once (bulk import): drop caches and rebuild the indexes."""
+    invalidate_catalog()
+    if product_index.ready:
+        product_index.build(session_factory)
+    if product_suggester.ready:
+        product_suggester.build(session_factory)
+
+
+# ==========================================
+# Following other writers (change feed)
+# ==========================================
+# Products written outside this process (other workers, `python -m
+# backend.importer`, checkout runs) reach it through the change feed: settled
+# entries after the last one applied are evicted from the caches and applied
+# to the search and suggest indexes. Entries are full snapshots, so applying
+# this process's own writes a second time is harmless.
+_followed_seq: Optional[int] = None
+
+
+def indexes_current() -> bool:
+    """True once every change up to the shared version has been applied to the search indexes."""
+    return _followed_seq is not None and _followed_seq >= shared_version()[0]
+
+
+def start_following(db) -> None:
+    """Follow changes made from now on; call before the indexes are built."""
+    global _followed_seq
+    _followed_seq = changefeed.head(db)
+
+
+def follow_task() -> None:
+    global _followed_seq
+    if _followed_seq is None:
+        return
+    while True:
+        changes = list(changefeed.iter_changes(_followed_seq, FOLLOW_BATCH_SIZE))
+        if not changes:
+            return
+        if len(changes) >= FOLLOW_BATCH_SIZE:
+            catalog_reloaded(database.SessionLocal)
+            # Whatever the rebuild read is applied; skip past it.
+            db = database.SessionLocal()
+            try:
+                _followed_seq = changefeed.head(db)
+            finally:
+                db.close()
+            return
+        latest = {change.product_id: change for change in changes}
+        deleted = [product_id for product_id, change in latest.items() if change.op == "delete"]
+        for product_id in deleted:
+            product_deleted(product_id)
+        products_saved(change for change in latest.values() if change.op != "delete")
+        _followed_seq = changes[-1].seq
+
+
+def _stats() -> dict:
+    return {
+        "version": _version,
+        "shared_version": _shared_version,
+        "followed_seq": _followed_seq,
+        "by_id": product_cache.stats(),
+        "pages": page_cache.stats(),
+    }
+
+
+metrics.register("product_cache", _stats)
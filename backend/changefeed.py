@@ -0,0 +1,164 @@
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, insert, literal, select
+from sqlalchemy.orm import Session, aliased
+
+from backend import database, models
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+# Entries younger than this are not served yet, so a slightly older
+# transaction that commits late is not skipped by a client's cursor.
+CHANGE_FEED_SETTLE_SECONDS = float(os.getenv("CHANGE_FEED_SETTLE_SECONDS", "2"))
+# Superseded entries older than this are removed by compaction.
+CHANGE_FEED_COMPACT_AFTER_SECONDS = float(os.getenv("CHANGE_FEED_COMPACT_AFTER_SECONDS", "3600"))
+CHANGE_FEED_COMPACT_INTERVAL = float(os.getenv("CHANGE_FEED_COMPACT_INTERVAL", "300"))
+COMPACT_BATCH_SIZE = 5000
+STREAM_BATCH_SIZE = 1000
+
+# ==========================================
+# Recording (inside the writing transaction)
+# ==========================================
+# Every entry is a full snapshot of the product after the change ("upsert") or
+# a tombstone ("delete"), so a mirror only ever needs the latest entry per
+# product. The log is written in the same transaction as the product change,
+# which also bumps the single catalog_version row (see version()). The bump
+# locks that row until commit, so record() must be the transaction's last
+# product write: every writer locks products first and catalog_version last.
+
+
+def _bump_version(db: Session) -> None:
+    table = models.CatalogVersion.__table__
+    db.execute(
+        database.upsert(db, table, ["id"], lambda new: {"version": table.c.version + 1}),
+        [{"id": 1, "version": 1}],
+    )
+
+
+def record(db: Session, product_ids: Optional[Iterable[int]] = None, after_id: Optional[int] = None) -> None:
+    """
+    Snapshot the current rows of `product_ids` (or of every product with an id
+    greater than `after_id`) into the change log with one INSERT ... SELECT.
+    Call after the product write has been flushed and before commit.
+    """
+    query = select(
+        models.Product.product_id,
+        literal("upsert"),
+        models.Product.name,
+        models.Product.price,
+        models.Product.stock_amount,
+        literal(datetime.utcnow()),
+    )
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        query = query.where(models.Product.product_id.in_(product_ids))
+    elif after_id is not None:
+        query = query.where(models.Product.product_id > after_id)
+    else:
+        raise ValueError("record() needs product_ids or after_id")
+
+    db.execute(
+        insert(models.ProductChange).from_select(
+            ["product_id", "op", "name", "price", "stock_amount", "changed_at"],
+            query.order_by(models.Product.product_id),
+        )
+    )
+    _bump_version(db)
+
+
+def record_deleted(db: Session, product_ids: Iterable[int]) -> None:
+    now = datetime.utcnow()
+    rows = [{"product_id": product_id, "op": "delete", "changed_at": now} for product_id in product_ids]
+    if rows:
+        db.execute(insert(models.ProductChange), rows)
+        _bump_version(db)
+
+
+def max_product_id(db: Session) -> int:
+    return db.execute(select(func.coalesce(func.max(models.Product.product_id), 0))).scalar_one()
+
+
+# ==========================================
+# Reading
+# ==========================================
+def head(db: Session) -> int:
+    """Sequence number a new mirror should start following from."""
+    return db.execute(select(func.coalesce(func.max(models.ProductChange.seq), 0))).scalar_one()
+
+
+def version(db: Session) -> Tuple[int, int]:
+    """
+    (head, catalog version): the version moves with every committed change,
+    including one that commits after a later sequence number is already
+    visible. Both are single index lookups.
+    """
+    current = db.scalar(select(models.CatalogVersion.version).where(models.CatalogVersion.id == 1))
+    return head(db), current or 0
+
+
+def iter_changes(since: int, limit: int) -> Iterator[models.ProductChange]:
+    """Yield up to `limit` settled entries after `since`, in sequence order, through a server-side cursor."""
+    db = database.SessionLocal()
+    try:
+        settled = datetime.utcnow() - timedelta(seconds=CHANGE_FEED_SETTLE_SECONDS)
+        query = (
+            select(models.ProductChange)
+            .where(models.ProductChange.seq > since, models.ProductChange.changed_at <= settled)
+            .order_by(models.ProductChange.seq)
+            .limit(limit)
+            .execution_options(yield_per=STREAM_BATCH_SIZE)
+        )
+        for change in db.scalars(query):
+            yield change
+    finally:
+        db.close()
+
+
+# ==========================================
+# Compaction
+# ==========================================
+def compact(db: Session) -> int:
+    """
+    Delete entries that are older than CHANGE_FEED_COMPACT_AFTER_SECONDS and
+    superseded by a later entry for the same product. The newest entry per
+    product (including tombstones) is always kept, so any cursor still
+    converges on the current catalog. Returns the number of entries removed.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=CHANGE_FEED_COMPACT_AFTER_SECONDS)
+    newer = aliased(models.ProductChange)
+    removed = 0
+    while True:
+        seqs = db.scalars(
+            select(models.ProductChange.seq)
+            .join(newer, (newer.product_id == models.ProductChange.product_id) & (newer.seq > models.ProductChange.seq))
+            .where(models.ProductChange.changed_at < cutoff)
+            .distinct()
+            .limit(COMPACT_BATCH_SIZE)
+        ).all()
+        if not seqs:
+            break
+        db.execute(delete(models.ProductChange).where(models.ProductChange.seq.in_(seqs)))
+        db.commit()
+        removed += len(seqs)
+    if removed:
+        logger.info(f"Change feed compacted: {removed} superseded entries removed.")
+    return removed
+
+
+def compact_task() -> None:
+    db = database.SessionLocal()
+    try:
+        compact(db)
+    finally:
+        db.close()
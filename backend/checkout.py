@@ -0,0 +1,181 @@
+import argparse
+import json
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from backend import database, models, rollups, schemas
+from backend.importer import batched
+
+logger = logging.getLogger(__name__)
+
+CHECKOUT_BATCH_SIZE = 500
+# Times a batch is re-locked when a cart gained a line while its products were
+# being locked; after that the new lines' products are locked out of order.
+CHECKOUT_LOCK_ATTEMPTS = 3
+
+
+# ==========================================
+# Set-based pricing
+# ==========================================
+def price_orders(db: Session, order_ids: List[int]) -> None:
+    """
+    Snapshot every line's current product price into order_items.unit_price
+    and recompute the orders' totals from those snapshots. Two statements for
+    any number of orders; the caller commits.
+    """
+    current_price = (
+        select(models.Product.price)
+        .where(models.Product.product_id == models.OrderItem.product_id)
+        .scalar_subquery()
+    )
+    db.execute(
+        update(models.OrderItem)
+        .where(models.OrderItem.order_id.in_(order_ids))
+        .values(unit_price=current_price)
+        .execution_options(synchronize_session=False)
+    )
+    line_total = (
+        select(func.coalesce(func.sum(models.OrderItem.quantity * models.OrderItem.unit_price), 0))
+        .where(models.OrderItem.order_id == models.Order.order_id)
+        .scalar_subquery()
+    )
+    db.execute(
+        update(models.Order)
+        .where(models.Order.order_id.in_(order_ids))
+        .values(total_price=line_total)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# ==========================================
+# Checkout
+# ==========================================
+_STATUS_RESULT = {
+    models.OrderStatus.CLOSE: "already_closed",
+    models.OrderStatus.EXPIRED: "expired",
+}
+
+
+def _lock_products(db: Session, batch: List[int], user_id: Optional[int]) -> List[int]:
+    """Share-lock the products on the batch's TEMP orders, in product_id order; returns their ids."""
+    held = (
+        select(models.OrderItem.product_id)
+        .join(models.Order, models.Order.order_id == models.OrderItem.order_id)
+        .where(models.Order.order_id.in_(batch), models.Order.status == models.OrderStatus.TEMP)
+        .distinct()
+    )
+    if user_id is not None:
+        held = held.where(models.Order.user_id == user_id)
+    return db.scalars(
+        select(models.Product.product_id)
+        .where(models.Product.product_id.in_(held))
+        .order_by(models.Product.product_id)
+        .with_for_update(read=True)
+    ).all()
+
+
+def _lock_orders(db: Session, batch: List[int], user_id: Optional[int]) -> Dict[int, models.OrderStatus]:
+    """
+    Lock the batch's orders after their products, the order add_to_cart and
+    the sweeper use, so checkout cannot deadlock with them. Returns
+    {order_id: status} for the orders found.
+    """
+    for attempt in range(1, CHECKOUT_LOCK_ATTEMPTS + 1):
+        locked_products = _lock_products(db, batch, user_id)
+        query = (
+            select(models.Order.order_id, models.Order.status)
+            .where(models.Order.order_id.in_(batch))
+            .order_by(models.Order.order_id)
+            .with_for_update()
+        )
+        if user_id is not None:
+            query = query.where(models.Order.user_id == user_id)
+        found = {row.order_id: row.status for row in db.execute(query)}
+        to_close = [order_id for order_id, status in found.items() if status == models.OrderStatus.TEMP]
+        # A line added between the two locking reads has a product that is not locked yet.
+        added = db.execute(
+            select(models.OrderItem.order_id)
+            .where(models.OrderItem.order_id.in_(to_close), models.OrderItem.product_id.not_in(locked_products))
+            .limit(1)
+        ).first()
+        if added is None or attempt == CHECKOUT_LOCK_ATTEMPTS:
+            return found
+        db.rollback()
+
+
+def checkout_orders(
+    db: Session, order_ids: Iterable[int], user_id: Optional[int] = None, batch_size: int = CHECKOUT_BATCH_SIZE
+) -> List[schemas.CheckoutResult]:
+    """
+    Close TEMP orders: lock their products and then them (see _lock_orders),
+    snapshot line prices, recompute totals with
+    one SQL aggregate and flip the status, in one transaction per batch of
+    `batch_size` orders. With `user_id`, only that user's orders are touched.
+    Returns one result per requested order id, in the order given.
+    """
+    order_ids = list(dict.fromkeys(order_ids))
+    results: Dict[int, schemas.CheckoutResult] = {}
+    for batch in batched(sorted(order_ids), batch_size):
+        try:
+            found = _lock_orders(db, batch, user_id)
+            to_close = [order_id for order_id, status in found.items() if status == models.OrderStatus.TEMP]
+            if to_close:
+                price_orders(db, to_close)
+                db.execute(
+                    update(models.Order)
+                    .where(models.Order.order_id.in_(to_close))
+                    .values(status=models.OrderStatus.CLOSE, order_date=datetime.utcnow())
+                    .execution_options(synchronize_session=False)
+                )
+                rollups.orders_status_changed(db, to_close, models.OrderStatus.TEMP.value, models.OrderStatus.CLOSE.value)
+                totals = dict(db.execute(
+                    select(models.Order.order_id, models.Order.total_price).where(models.Order.order_id.in_(to_close))
+                ).all())
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        for order_id in batch:
+            if order_id not in found:
+                results[order_id] = schemas.CheckoutResult(order_id=order_id, status="not_found")
+            elif found[order_id] == models.OrderStatus.TEMP:
+                results[order_id] = schemas.CheckoutResult(order_id=order_id, status="closed", total_price=totals[order_id])
+            else:
+                results[order_id] = schemas.CheckoutResult(order_id=order_id, status=_STATUS_RESULT[found[order_id]])
+
+    closed = sum(1 for result in results.values() if result.status == "closed")
+    logger.info(f"Checkout closed {closed} of {len(order_ids)} orders.")
+    return [results[order_id] for order_id in order_ids]
+
+
+# ==========================================
+# Command line (back-office batches)
+# ==========================================
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Close TEMP orders with set-based totals.")
+    parser.add_argument("order_ids", nargs="*", type=int, help="Orders to close")
+    parser.add_argument("--all-temp", action="store_true", help="Close every TEMP order")
+    parser.add_argument("--batch-size", type=int, default=CHECKOUT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    db = database.SessionLocal()
+    try:
+        order_ids = args.order_ids
+        if args.all_temp:
+            order_ids += db.scalars(
+                select(models.Order.order_id).where(models.Order.status == models.OrderStatus.TEMP)
+            ).all()
+        results = checkout_orders(db, order_ids, batch_size=args.batch_size)
+    finally:
+        db.close()
+    print(json.dumps([result.model_dump() for result in results], indent=2))
+
+
+if __name__ == "__main__":
+    main()
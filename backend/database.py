@@ -1,8 +1,22 @@
+import hashlib
+import itertools
+import logging
+import math
 import os
+import time
+from typing import Any, Callable, Iterable, List, Optional, Union
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, sessionmaker
+from backend import metrics
 from backend.base import Base
+from backend.cache import TTLCache
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
@@ -29,3 +43,254 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# ==========================================
+# Async engine (ASYNC_DB=true)
+# ==========================================
+# Read endpoints take `get_request_db` and run their queries through
+# `run_db`. With ASYNC_DB the session is an AsyncSession on aiomysql /
+# aiosqlite and waiting on the database holds no thread; otherwise it is a
+# regular Session and the queries run in the threadpool as before.
+ASYNC_DB = os.getenv("ASYNC_DB", "false").lower() == "true"
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "20"))
+ASYNC_DB_MAX_OVERFLOW = int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "20"))
+
+ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+def async_url(url: str):
+    """DATABASE_URL with its driver swapped for the asyncio one."""
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.drivername)
+    if driver is None:
+        raise ValueError(f"No asyncio driver configured for '{parsed.drivername}'")
+    return parsed.set(drivername=driver)
+
+def _async_sessionmaker(url: str, **session_options):
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    parsed = async_url(url)
+    pool_options = {} if parsed.get_backend_name() == "sqlite" else {
+        "pool_size": ASYNC_DB_POOL_SIZE,
+        "max_overflow": ASYNC_DB_MAX_OVERFLOW,
+    }
+    engine = create_async_engine(parsed, pool_pre_ping=True, pool_recycle=3600, **pool_options)
+    return async_sessionmaker(engine, autoflush=False, expire_on_commit=False, **session_options)
+
+async_engine = None
+AsyncSessionLocal = None
+if ASYNC_DB:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+    AsyncSessionLocal = _async_sessionmaker(DATABASE_URL)
+    async_engine = AsyncSessionLocal.kw["bind"]
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def run_db(db: Union[Session, "AsyncSession"], fn: Callable, *args, **kwargs) -> Any:
+    """Call `fn(session, *args, **kwargs)`, written against the sync Session API, on either kind of session."""
+    if isinstance(db, Session):
+        return await run_in_threadpool(fn, db, *args, **kwargs)
+    return await db.run_sync(fn, *args, **kwargs)
+
+# ==========================================
+# Read replicas (DATABASE_REPLICA_URLS)
+# ==========================================
+# Read-only endpoints take `get_read_db` / `get_request_db` and are served by
+# a replica, round-robin among those whose last health check found them
+# reachable and at most REPLICA_MAX_LAG seconds behind. Writes, reads by a
+# client that wrote in the last REPLICA_READ_AFTER_WRITE seconds, and reads
+# while no replica is usable all go to the primary.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "10"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_READ_AFTER_WRITE = float(os.getenv("REPLICA_READ_AFTER_WRITE", "10"))
+REPLICA_RETRY_INTERVAL = float(os.getenv("REPLICA_RETRY_INTERVAL", "30"))
+# A usable replica may still miss writes made this long ago (lag limit plus check resolution).
+REPLICA_STALE_WINDOW = REPLICA_MAX_LAG + REPLICA_CHECK_INTERVAL
+
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+class Replica:
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.engine = create_engine(url, echo=False, pool_pre_ping=True, pool_recycle=3600)
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine, info={"replica": name})
+        self.AsyncSessionLocal = _async_sessionmaker(url, info={"replica": name}) if ASYNC_DB else None
+        # Seconds behind the primary as of the last health check; None until the first one.
+        self.lag: Optional[float] = None
+        self.down_until = 0.0
+        self.reads = 0
+        self.failures = 0
+
+    def usable(self, now: float) -> bool:
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG and now >= self.down_until
+
+    def mark_down(self, error: Exception) -> None:
+        self.failures += 1
+        self.down_until = time.monotonic() + REPLICA_RETRY_INTERVAL
+        logger.warning(f"Read replica {self.name} failed, reading from the primary instead: {error}")
+
+    def stats(self) -> dict:
+        return {
+            "lag_seconds": None if self.lag is None else round(min(self.lag, 1e9), 3),
+            "usable": self.usable(time.monotonic()),
+            "reads": self.reads,
+            "failures": self.failures,
+        }
+
+class ReplicaSet:
+    def __init__(self, urls: List[str]):
+        self.replicas = [Replica(f"replica{i}", url) for i, url in enumerate(urls, 1)]
+        self._next = itertools.count()
+        # Request keys (client IP, bearer token) that recently wrote.
+        self._writers = TTLCache(100000, REPLICA_READ_AFTER_WRITE)
+        self.read_after_write = 0
+        self.no_replica = 0
+
+    def note_write(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            self._writers.set(key, True)
+
+    def pick(self, keys: Iterable[str] = ()) -> Optional[Replica]:
+        """Replica for a read by a client with these keys, or None to use the primary."""
+        if not self.replicas:
+            return None
+        if any(self._writers.get(key) for key in keys):
+            self.read_after_write += 1
+            return None
+        now = time.monotonic()
+        usable = [replica for replica in self.replicas if replica.usable(now)]
+        if not usable:
+            self.no_replica += 1
+            return None
+        replica = usable[next(self._next) % len(usable)]
+        replica.reads += 1
+        return replica
+
+    def check(self) -> None:
+        """Health check: update every replica's lag from its copy of the heartbeat, then beat again."""
+        from backend import models
+
+        heartbeat = select(models.ReplicaHeartbeat.beat_at).where(models.ReplicaHeartbeat.id == 1)
+        db = SessionLocal()
+        try:
+            primary_beat = db.scalar(heartbeat)
+            for replica in self.replicas:
+                try:
+                    with replica.engine.connect() as conn:
+                        beat = conn.scalar(heartbeat)
+                except DBAPIError as e:
+                    replica.mark_down(e)
+                    continue
+                replica.down_until = 0.0
+                if beat is None:
+                    replica.lag = math.inf
+                elif primary_beat is None or beat >= primary_beat:
+                    replica.lag = 0.0
+                else:
+                    # It has not seen the primary's last beat: it is at least as old as its own.
+                    replica.lag = max(0.0, time.time() - beat)
+            db.execute(
+                upsert(db, models.ReplicaHeartbeat.__table__, ["id"], lambda new: {"beat_at": new.beat_at}),
+                [{"id": 1, "beat_at": time.time()}],
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        return {
+            "replicas": {replica.name: replica.stats() for replica in self.replicas},
+            "read_after_write": self.read_after_write,
+            "no_replica": self.no_replica,
+        }
+
+replicas = ReplicaSet(DATABASE_REPLICA_URLS)
+
+def on_replica(db: Session) -> bool:
+    return "replica" in db.info
+
+def request_keys(request: Request) -> List[str]:
+    """Keys identifying the client for read-your-writes: its address and its bearer token."""
+    keys = []
+    if request.client is not None:
+        keys.append(f"ip:{request.client.host}")
+    authorization = request.headers.get("authorization")
+    if authorization:
+        keys.append("auth:" + hashlib.blake2b(authorization.encode(), digest_size=16).hexdigest())
+    return keys
+
+async def track_writes(request: Request, call_next):
+    """HTTP middleware: send the client's reads to the primary for a while after it writes."""
+    response = await call_next(request)
+    if replicas.replicas and request.method in WRITE_METHODS:
+        replicas.note_write(request_keys(request))
+    return response
+
+def read_session(keys: Iterable[str] = ()) -> Session:
+    """Session for read-only work: on a replica when one is usable, otherwise on the primary."""
+    replica = replicas.pick(keys)
+    if replica is not None:
+        db = replica.SessionLocal()
+        try:
+            db.connection()
+            return db
+        except DBAPIError as e:
+            db.close()
+            replica.mark_down(e)
+    return SessionLocal()
+
+def get_read_db(request: Request):
+    db = read_session(request_keys(request))
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db(request: Request):
+    replica = replicas.pick(request_keys(request))
+    if replica is not None:
+        async with replica.AsyncSessionLocal() as db:
+            try:
+                await db.connection()
+            except DBAPIError as e:
+                replica.mark_down(e)
+            else:
+                yield db
+                return
+    async with AsyncSessionLocal() as db:
+        yield db
+
+get_request_db = get_async_read_db if ASYNC_DB else get_read_db
+
+metrics.register("read_replicas", replicas.stats)
+
+def upsert(db: Session, table, index_elements: Iterable[str], set_: Callable):
+    """
+    Build an INSERT ... ON DUPLICATE KEY UPDATE (MySQL) / ON CONFLICT DO UPDATE
+    (SQLite, PostgreSQL) statement for `table`.
+
+    `set_` receives the "incoming row" namespace (`inserted` / `excluded`) and
+    returns the column -> value mapping to apply to an existing row, so callers
+    can write either `new.price` or `table.c.total + new.total`.
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update(**set_(stmt.inserted))
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise NotImplementedError(f"Upsert is not supported for the '{dialect}' dialect")
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(index_elements=list(index_elements), set_=set_(stmt.excluded))
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from backend import database, metrics, models
+from backend.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+# "memory" - responses are kept in this process only
+# "db"     - responses are kept in idempotency_keys and shared by every worker
+IDEMPOTENCY_STORE = os.getenv("IDEMPOTENCY_STORE", "memory").lower()
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX = int(os.getenv("IDEMPOTENCY_MAX", "100000"))
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", "600"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+# (user_id, route, key)
+Scope = Tuple[int, str, str]
+# (request_hash, response)
+Entry = Tuple[str, dict]
+
+_stats = {"requests": 0, "replays": 0, "coalesced": 0, "conflicts": 0}
+_stats_lock = threading.Lock()
+
+
+class IdempotencyKeyReused(Exception):
+    """The key was already used for a request with a different body."""
+
+
+def _count(name: str) -> None:
+    with _stats_lock:
+        _stats[name] += 1
+
+
+# ==========================================
+# Stores
+# ==========================================
+# Finished responses are always kept in a TTLCache, so repeats served by the
+# same worker never reach the database. The db store also writes each
+# response in the transaction that made it, which makes replays work across
+# workers and restarts.
+class MemoryIdempotencyStore:
+    name = "memory"
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._responses = TTLCache(maxsize, ttl)
+
+    def lookup(self, db: Session, scope: Scope) -> Optional[Entry]:
+        return self._responses.get(scope)
+
+    def stage(self, db: Session, scope: Scope, entry: Entry) -> None:
+        pass
+
+    def remember(self, scope: Scope, entry: Entry) -> None:
+        self._responses.set(scope, entry)
+
+    def purge_expired(self) -> int:
+        return self._responses.purge_expired()
+
+    def stats(self) -> dict:
+        return {"store": self.name, **self._responses.stats()}
+
+
+class DbIdempotencyStore(MemoryIdempotencyStore):
+    name = "db"
+
+    def lookup(self, db: Session, scope: Scope) -> Optional[Entry]:
+        entry = super().lookup(db, scope)
+        if entry is not None:
+            return entry
+        user_id, route, key = scope
+        record = db.get(models.IdempotencyRecord, (user_id, route, key))
+        if record is None:
+            return None
+        if record.created_at <= datetime.utcnow() - timedelta(seconds=self._responses.ttl):
+            # Expired but not purged yet: free the key for this request.
+            db.delete(record)
+            db.flush()
+            return None
+        entry = (record.request_hash, json.loads(record.response))
+        self.remember(scope, entry)
+        return entry
+
+    def stage(self, db: Session, scope: Scope, entry: Entry) -> None:
+        user_id, route, key = scope
+        request_hash, response = entry
+        db.add(models.IdempotencyRecord(
+            user_id=user_id, route=route, idempotency_key=key,
+            request_hash=request_hash, response=json.dumps(response),
+        ))
+
+    def purge_expired(self) -> int:
+        removed = super().purge_expired()
+        db = database.SessionLocal()
+        try:
+            cutoff = datetime.utcnow() - timedelta(seconds=self._responses.ttl)
+            removed += db.execute(
+                delete(models.IdempotencyRecord).where(models.IdempotencyRecord.created_at <= cutoff)
+            ).rowcount
+            db.commit()
+        finally:
+            db.close()
+        return removed
+
+
+def _create_store():
+    if IDEMPOTENCY_STORE == "memory":
+        return MemoryIdempotencyStore(IDEMPOTENCY_MAX, IDEMPOTENCY_TTL)
+    if IDEMPOTENCY_STORE == "db":
+        return DbIdempotencyStore(IDEMPOTENCY_MAX, IDEMPOTENCY_TTL)
+    raise ValueError(f"Unknown IDEMPOTENCY_STORE '{IDEMPOTENCY_STORE}' (expected memory or db)")
+
+
+store = _create_store()
+
+
+# ==========================================
+# Coalescing
+# ==========================================
+# One lock per scope while a request with that key is running: duplicates
+# arriving meanwhile wait for it and then replay its response.
+_inflight: Dict[Scope, list] = {}
+_inflight_lock = threading.Lock()
+
+
+@contextmanager
+def _single_flight(scope: Scope):
+    with _inflight_lock:
+        entry = _inflight.setdefault(scope, [threading.Lock(), 0])
+        entry[1] += 1
+        if entry[1] > 1:
+            _count("coalesced")
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _inflight_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _inflight[scope]
+
+
+# ==========================================
+# Running a request once
+# ==========================================
+def request_hash(body: dict) -> str:
+    return hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _replay(entry: Entry, fingerprint: str) -> dict:
+    stored_hash, response = entry
+    if stored_hash != fingerprint:
+        _count("conflicts")
+        raise IdempotencyKeyReused()
+    _count("replays")
+    return response
+
+
+def run_once(
+    db: Session, user_id: int, route: str, key: str, body: dict, write: Callable[[], dict]
+) -> Tuple[dict, bool]:
+    """
+    Run `write` at most once per (user, route, key). `write` makes its
+    changes in `db` without committing and returns the JSON response; this
+    commits them. Returns (response, replayed). A repeat of a finished request
+    gets the stored response without calling `write`; a repeat with another
+    body raises IdempotencyKeyReused. Failed writes are not stored.
+    """
+    scope = (user_id, route, key)
+    fingerprint = request_hash(body)
+    _count("requests")
+    with _single_flight(scope):
+        entry = store.lookup(db, scope)
+        if entry is not None:
+            return _replay(entry, fingerprint), True
+
+        response = write()
+        entry = (fingerprint, response)
+        store.stage(db, scope, entry)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another worker committed the same key first (db store only):
+            # our write is rolled back and theirs is replayed.
+            db.rollback()
+            entry = store.lookup(db, scope)
+            if entry is None:
+                raise
+            _count("coalesced")
+            return _replay(entry, fingerprint), True
+        store.remember(scope, entry)
+        return response, False
+
+
+def purge_task() -> None:
+    removed = store.purge_expired()
+    if removed:
+        logger.info(f"Idempotency store purged {removed} expired keys.")
+
+
+def _metrics() -> dict:
+    with _stats_lock:
+        return {**store.stats(), **_stats}
+
+
+metrics.register("idempotency", _metrics)
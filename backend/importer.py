@@ -0,0 +1,403 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import uuid
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple, Type
+
+from dotenv import load_dotenv
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import and_, delete, func, insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from backend import changefeed, database, inventory, models, rollups, schemas
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+MAX_REPORTED_ERRORS = 100
+FORMATS = ("csv", "ndjson")
+# Largest difference between an order's total and its payments that still counts as settled.
+AMOUNT_TOLERANCE = 0.005
+
+
+# ==========================================
+# Streaming readers
+# ==========================================
+def detect_format(filename: Optional[str], content_type: Optional[str] = None) -> str:
+    if (filename or "").lower().endswith((".ndjson", ".jsonl")) or "ndjson" in (content_type or ""):
+        return "ndjson"
+    return "csv"
+
+
+def iter_records(stream: BinaryIO, fmt: str) -> Iterator[Tuple[int, object]]:
+    """
+    Yield (row number, record) pairs from a CSV or NDJSON byte stream without
+    loading it into memory. A line that cannot be parsed is yielded as the
+    exception instead of a dict so the caller can report it and keep going.
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        if fmt == "csv":
+            # Row 1 is the header line.
+            for row_number, row in enumerate(csv.DictReader(text), start=2):
+                yield row_number, row
+        elif fmt == "ndjson":
+            for row_number, line in enumerate(text, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield row_number, json.loads(line)
+                except ValueError as e:
+                    yield row_number, e
+        else:
+            raise ValueError(f"Unsupported import format: {fmt}")
+    finally:
+        text.detach()
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _clean(record: dict) -> dict:
+    """Drop blank CSV cells so optional fields fall back to their defaults."""
+    return {key: value for key, value in record.items() if key is not None and value not in ("", None)}
+
+
+class ImportReporter:
+    """Accumulates counts and the first MAX_REPORTED_ERRORS row errors."""
+
+    def __init__(self):
+        self.report = schemas.ImportReport()
+
+    def error(self, row_number: int, message: str) -> None:
+        self.report.rows_failed += 1
+        if len(self.report.errors) < MAX_REPORTED_ERRORS:
+            self.report.errors.append(schemas.ImportRowError(row=row_number, error=message))
+
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, e['loc'])) or 'row'}: {e['msg']}" for e in error.errors())
+
+
+def _validated(reporter: ImportReporter, batch, model: Type[BaseModel]) -> Iterator[Tuple[int, BaseModel]]:
+    """Yield (row number, model) for the valid records of `batch`; the rest are reported."""
+    for row_number, record in batch:
+        reporter.report.rows_read += 1
+        if isinstance(record, Exception):
+            reporter.error(row_number, f"Unreadable row: {record}")
+            continue
+        if not isinstance(record, dict):
+            reporter.error(row_number, "Row must be an object")
+            continue
+        try:
+            yield row_number, model.model_validate(_clean(record))
+        except ValidationError as e:
+            reporter.error(row_number, _validation_message(e))
+
+
+# ==========================================
+# Product import
+# ==========================================
+def import_products(db: Session, stream: BinaryIO, fmt: str = "csv", batch_size: int = IMPORT_BATCH_SIZE) -> schemas.ImportReport:
+    """
+    Stream products from CSV/NDJSON into the products table.
+
+    Rows are validated against ProductImportRow and written `batch_size` at a
+    time, one transaction per batch: rows without product_id with a multi-row
+    INSERT, rows with product_id with a multi-row upsert. If a batch fails in
+    the database it is retried row by row so only the offending rows are
+    reported. Memory use depends on batch_size, not on file size.
+    """
+    reporter = ImportReporter()
+    for batch in batched(iter_records(stream, fmt), batch_size):
+        new_rows: List[Tuple[int, dict]] = []
+        upsert_rows: List[Tuple[int, dict]] = []
+        for row_number, row in _validated(reporter, batch, schemas.ProductImportRow):
+            if row.product_id is None:
+                new_rows.append((row_number, row.model_dump(exclude={"product_id"})))
+            else:
+                upsert_rows.append((row_number, row.model_dump()))
+
+        _write_batch(db, reporter, new_rows, upsert_rows)
+
+    logger.info(
+        f"Product import finished: {reporter.report.rows_written} written, "
+        f"{reporter.report.rows_failed} failed of {reporter.report.rows_read} rows."
+    )
+    return reporter.report
+
+
+def _product_statements(db: Session):
+    table = models.Product.__table__
+    insert_stmt = insert(table)
+    upsert_stmt = database.upsert(
+        db, table, ["product_id"],
+        lambda new: {"name": new.name, "price": new.price, "stock_amount": new.stock_amount},
+    )
+    return insert_stmt, upsert_stmt
+
+
+def _write_batch(db: Session, reporter: ImportReporter, new_rows, upsert_rows) -> None:
+    if not new_rows and not upsert_rows:
+        return
+    insert_stmt, upsert_stmt = _product_statements(db)
+    try:
+        if new_rows:
+            # New ids are not returned by a multi-row INSERT; everything above the
+            # current maximum is recorded instead (a concurrent insert may be
+            # recorded twice, which is harmless for snapshot entries).
+            last_id = changefeed.max_product_id(db)
+            db.execute(insert_stmt, [values for _, values in new_rows])
+        if upsert_rows:
+            db.execute(upsert_stmt, [values for _, values in upsert_rows])
+            upserted_ids = [values["product_id"] for _, values in upsert_rows]
+            inventory.spread_shards(db, upserted_ids)
+        # Recorded after every product write: recording locks catalog_version until commit.
+        if new_rows:
+            changefeed.record(db, after_id=last_id)
+        if upsert_rows:
+            changefeed.record(db, upserted_ids)
+        db.commit()
+        reporter.report.rows_written += len(new_rows) + len(upsert_rows)
+        return
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.warning(f"Batch write failed, retrying row by row: {e}")
+
+    for stmt, rows in ((insert_stmt, new_rows), (upsert_stmt, upsert_rows)):
+        for row_number, values in rows:
+            try:
+                last_id = changefeed.max_product_id(db)
+                db.execute(stmt, [values])
+                if "product_id" in values:
+                    inventory.spread_shards(db, [values["product_id"]])
+                changefeed.record(db, [values["product_id"]] if "product_id" in values else None, after_id=last_id)
+                db.commit()
+                reporter.report.rows_written += 1
+            except SQLAlchemyError as e:
+                db.rollback()
+                reporter.error(row_number, f"Database error: {getattr(e, 'orig', e)}")
+
+
+# ==========================================
+# Payment import (settlement files)
+# ==========================================
+def import_payments(db: Session, stream: BinaryIO, fmt: str = "csv", batch_size: int = IMPORT_BATCH_SIZE) -> schemas.PaymentImportReport:
+    """
+    Stream payments (PaymentCreate fields) from CSV/NDJSON into the payments
+    table and reconcile them against orders.
+
+    Each batch of `batch_size` valid rows is bulk-inserted into
+    payment_import_staging and copied into payments with one INSERT ... SELECT
+    joined to orders, so rows for unknown orders are never written; one
+    transaction per batch. A row whose reference (see _payment_ref) is
+    already in payments is counted as a duplicate and skipped, so importing
+    the same file twice writes nothing the second time. Afterwards every
+    order the file touched is compared with all of its payments in set-based
+    queries (see reconcile_payments). Memory use depends on batch_size, not
+    on file size.
+    """
+    reporter = ImportReporter()
+    reporter.report = schemas.PaymentImportReport(import_id=uuid.uuid4().hex)
+    import_id = reporter.report.import_id
+    try:
+        for batch in batched(iter_records(stream, fmt), batch_size):
+            rows = [
+                (row_number, _staging_values(import_id, row_number, row))
+                for row_number, row in _validated(reporter, batch, schemas.PaymentImportRow)
+            ]
+            _write_payment_batch(db, reporter, rows)
+        reconcile_payments(db, reporter.report)
+    except Exception:
+        # Roll back first: the session may be unusable, and the cleanup must
+        # not replace the original error.
+        db.rollback()
+        _drop_staging(db, import_id, quiet=True)
+        raise
+    _drop_staging(db, import_id)
+
+    logger.info(
+        f"Payment import {import_id} finished: {reporter.report.rows_written} written, "
+        f"{reporter.report.rows_duplicate} already imported, "
+        f"{reporter.report.rows_failed} failed of {reporter.report.rows_read} rows; "
+        f"{reporter.report.orders_matched} of {reporter.report.orders_checked} orders settled, "
+        f"issues {reporter.report.issue_counts}."
+    )
+    return reporter.report
+
+
+def _payment_ref(row: schemas.PaymentImportRow) -> str:
+    """The row's settlement reference, or one made of its order, method, amount and time."""
+    if row.reference:
+        return f"ref:{row.reference}"
+    return f"row:{row.order_id}:{row.payment_method}:{row.amount:.2f}:{row.paid_at:%Y-%m-%dT%H:%M:%S}"
+
+
+def _staging_values(import_id: str, row_number: int, row: schemas.PaymentImportRow) -> dict:
+    return {
+        "import_id": import_id,
+        "line_no": row_number,
+        "external_ref": _payment_ref(row),
+        **row.model_dump(exclude={"reference"}),
+    }
+
+
+def _drop_staging(db: Session, import_id: str, quiet: bool = False) -> None:
+    """Delete the staging rows of `import_id` in a transaction of their own; `quiet` only logs a failure."""
+    try:
+        db.execute(delete(models.PaymentImportStaging).where(models.PaymentImportStaging.import_id == import_id))
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        if not quiet:
+            raise
+        logger.warning(f"Could not delete the staging rows of payment import {import_id}: {e}")
+
+
+def _stage_payments(db: Session, import_id: str, rows: List[dict]) -> Tuple[int, int]:
+    """
+    Stage `rows` (ascending line_no) and copy those with an existing order and
+    a new external_ref into payments; returns (written, duplicates). The
+    unique external_ref makes a concurrent import of the same rows fail
+    rather than write them twice.
+    """
+    staging = models.PaymentImportStaging
+    db.execute(insert(staging.__table__), rows)
+    in_batch = and_(staging.import_id == import_id, staging.line_no.between(rows[0]["line_no"], rows[-1]["line_no"]))
+    duplicates = db.execute(
+        update(staging)
+        .where(in_batch, select(models.Payment.payment_id).where(models.Payment.external_ref == staging.external_ref).exists())
+        .values(duplicate=True)
+    ).rowcount
+    known = (
+        select(staging.order_id, staging.payment_method, staging.amount, staging.paid_at, staging.external_ref)
+        .join(models.Order, models.Order.order_id == staging.order_id)
+        .where(in_batch, staging.duplicate.is_(False))
+        .order_by(staging.line_no)
+    )
+    written = db.execute(
+        insert(models.Payment).from_select(["order_id", "payment_method", "amount", "paid_at", "external_ref"], known)
+    ).rowcount
+    if written:
+        rollups.apply(db, db.execute(known).all())
+    return written, duplicates
+
+
+def _write_payment_batch(db: Session, reporter: ImportReporter, rows: List[Tuple[int, dict]]) -> None:
+    if not rows:
+        return
+    import_id = reporter.report.import_id
+    report = reporter.report
+    try:
+        written, duplicates = _stage_payments(db, import_id, [values for _, values in rows])
+        db.commit()
+        report.rows_written += written
+        report.rows_duplicate += duplicates
+        return
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.warning(f"Payment batch write failed, retrying row by row: {e}")
+
+    # Row by row, a reference repeated within the batch is a duplicate of the row written before it.
+    for row_number, values in rows:
+        try:
+            written, duplicates = _stage_payments(db, import_id, [values])
+            db.commit()
+            report.rows_written += written
+            report.rows_duplicate += duplicates
+        except SQLAlchemyError as e:
+            db.rollback()
+            reporter.error(row_number, f"Database error: {getattr(e, 'orig', e)}")
+
+
+def _issue(report: schemas.PaymentImportReport, issue: schemas.ReconciliationIssue) -> None:
+    report.issue_counts[issue.kind] = report.issue_counts.get(issue.kind, 0) + 1
+    if len(report.issues) < MAX_REPORTED_ERRORS:
+        report.issues.append(issue)
+
+
+def reconcile_payments(db: Session, report: schemas.PaymentImportReport) -> None:
+    """
+    Flag the staged rows of `report.import_id` whose order does not exist,
+    and every touched order that is not CLOSE or whose total differs from the
+    sum of all its payments. Two streamed join queries, whatever the file size.
+    """
+    staging = models.PaymentImportStaging
+    missing = db.execute(
+        select(staging.order_id, func.min(staging.line_no))
+        .outerjoin(models.Order, models.Order.order_id == staging.order_id)
+        .where(staging.import_id == report.import_id, models.Order.order_id.is_(None))
+        .group_by(staging.order_id)
+        .order_by(func.min(staging.line_no))
+        .execution_options(yield_per=IMPORT_BATCH_SIZE)
+    )
+    for order_id, line_no in missing:
+        _issue(report, schemas.ReconciliationIssue(kind="order_missing", order_id=order_id, row=line_no))
+
+    paid_total = (
+        select(func.coalesce(func.sum(models.Payment.amount), 0.0))
+        .where(models.Payment.order_id == models.Order.order_id)
+        .scalar_subquery()
+    )
+    touched = db.execute(
+        select(models.Order.order_id, models.Order.status, models.Order.total_price, paid_total)
+        .where(models.Order.order_id.in_(select(staging.order_id).where(staging.import_id == report.import_id)))
+        .order_by(models.Order.order_id)
+        .execution_options(yield_per=IMPORT_BATCH_SIZE)
+    )
+    for order_id, order_status, order_total, paid in touched:
+        report.orders_checked += 1
+        details = {
+            "order_id": order_id,
+            "order_status": order_status.value if order_status else None,
+            "order_total": order_total,
+            "paid_total": paid,
+        }
+        settled = True
+        if order_status != models.OrderStatus.CLOSE:
+            _issue(report, schemas.ReconciliationIssue(kind="order_not_closed", **details))
+            settled = False
+        if abs((order_total or 0.0) - paid) > AMOUNT_TOLERANCE:
+            _issue(report, schemas.ReconciliationIssue(kind="amount_mismatch", **details))
+            settled = False
+        report.orders_matched += settled
+
+
+# ==========================================
+# Command line
+# ==========================================
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Bulk import products or payments from a CSV or NDJSON file.")
+    parser.add_argument("path", help="File to import, e.g. data/items.csv")
+    parser.add_argument("--payments", action="store_true", help="Import a payment settlement file and reconcile it")
+    parser.add_argument("--format", choices=FORMATS, help="Defaults to the file extension")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    database.create_tables()
+    db = database.SessionLocal()
+    try:
+        with open(args.path, "rb") as stream:
+            run = import_payments if args.payments else import_products
+            report = run(db, stream, args.format or detect_format(args.path), args.batch_size)
+    finally:
+        db.close()
+    print(report.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
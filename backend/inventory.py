@@ -0,0 +1,627 @@
+import logging
+import os
+import random
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from backend import cart_store, catalog, changefeed, database, metrics, models, schemas
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+INVENTORY_MAX_SHARDS = int(os.getenv("INVENTORY_MAX_SHARDS", "64"))
+INVENTORY_RECONCILE_INTERVAL = float(os.getenv("INVENTORY_RECONCILE_INTERVAL", "5"))
+
+_counters = {"shard_hits": 0, "shard_fallbacks": 0, "reconciled": 0, "rebalanced": 0}
+_counters_lock = threading.Lock()
+
+
+def _count(name: str, amount: int = 1) -> None:
+    with _counters_lock:
+        _counters[name] += amount
+
+
+class ProductNotFound(Exception):
+    pass
+
+
+class InsufficientStock(Exception):
+    pass
+
+
+class EmptyCart(Exception):
+    pass
+
+
+# ==========================================
+# Stock reservation
+# ==========================================
+def reserve_stock(db: Session, product_id: int, quantity: int, stock_shards: int = 0) -> bool:
+    """
+    Take `quantity` units in a single conditional UPDATE.
+
+    The check and the decrement happen in one statement under the row lock, so
+    concurrent reservations can never drive stock below zero. Returns False
+    (and changes nothing) when there is not enough stock. Sharded products are
+    served from their shard rows instead of the product row.
+    """
+    if stock_shards:
+        return _reserve_sharded(db, product_id, quantity, stock_shards)
+    result = db.execute(
+        update(models.Product)
+        .where(
+            models.Product.product_id == product_id,
+            models.Product.stock_shards == 0,
+            models.Product.stock_amount >= quantity,
+        )
+        .values(stock_amount=models.Product.stock_amount - quantity)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 1:
+        return True
+    # `stock_shards` was read without a lock; if the product was sharded since,
+    # its stock is in the shards now. Re-read it locked, as set_shards() writes it.
+    stock_shards = db.execute(
+        select(models.Product.stock_shards).where(models.Product.product_id == product_id).with_for_update()
+    ).scalar()
+    if stock_shards:
+        return _reserve_sharded(db, product_id, quantity, stock_shards)
+    return False
+
+
+def release_stock(db: Session, product_id: int, quantity: int) -> None:
+    stock_shards = db.execute(
+        select(models.Product.stock_shards).where(models.Product.product_id == product_id)
+    ).scalar()
+    if stock_shards:
+        db.execute(
+            update(models.ProductStockShard)
+            .where(
+                models.ProductStockShard.product_id == product_id,
+                models.ProductStockShard.shard == random.randrange(stock_shards),
+            )
+            .values(stock_amount=models.ProductStockShard.stock_amount + quantity)
+            .execution_options(synchronize_session=False)
+        )
+        return
+    db.execute(
+        update(models.Product)
+        .where(models.Product.product_id == product_id)
+        .values(stock_amount=models.Product.stock_amount + quantity)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# ==========================================
+# Sharded stock
+# ==========================================
+# A hot product's stock can be split across N rows of product_stock_shards.
+# Each reservation decrements one randomly chosen shard, so concurrent
+# checkouts of the same product mostly lock different rows instead of queueing
+# on the product row. While a product is sharded the shards hold the truth;
+# products.stock_amount is refreshed from them by reconcile().
+
+
+def _take_from_shard(db: Session, product_id: int, shard: int, quantity: int) -> bool:
+    result = db.execute(
+        update(models.ProductStockShard)
+        .where(
+            models.ProductStockShard.product_id == product_id,
+            models.ProductStockShard.shard == shard,
+            models.ProductStockShard.stock_amount >= quantity,
+        )
+        .values(stock_amount=models.ProductStockShard.stock_amount - quantity)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def _reserve_sharded(db: Session, product_id: int, quantity: int, stock_shards: int) -> bool:
+    if _take_from_shard(db, product_id, random.randrange(stock_shards), quantity):
+        _count("shard_hits")
+        return True
+
+    # The chosen shard ran dry (or holds less than `quantity`): lock all of the
+    # product's shards and take from as many as needed. This path serializes,
+    # but only while shards are uneven; reconcile() rebalances them.
+    _count("shard_fallbacks")
+    rows = db.execute(
+        select(models.ProductStockShard.shard, models.ProductStockShard.stock_amount)
+        .where(models.ProductStockShard.product_id == product_id)
+        .order_by(models.ProductStockShard.shard)
+        .with_for_update()
+    ).all()
+    if sum(row.stock_amount for row in rows) < quantity:
+        return False
+    remaining = quantity
+    for row in sorted(rows, key=lambda row: row.stock_amount, reverse=True):
+        take = min(remaining, row.stock_amount)
+        if take:
+            _take_from_shard(db, product_id, row.shard, take)
+            remaining -= take
+        if not remaining:
+            break
+    return True
+
+
+def _split(total: int, shards: int) -> List[int]:
+    base, extra = divmod(total, shards)
+    return [base + (1 if shard < extra else 0) for shard in range(shards)]
+
+
+def _write_shards(db: Session, product_id: int, total: int, shards: int) -> None:
+    stmt = database.upsert(
+        db, models.ProductStockShard.__table__, ["product_id", "shard"],
+        lambda new: {"stock_amount": new.stock_amount},
+    )
+    db.execute(stmt, [
+        {"product_id": product_id, "shard": shard, "stock_amount": amount}
+        for shard, amount in enumerate(_split(total, shards))
+    ])
+
+
+def _locked_shard_totals(db: Session, product_ids: Iterable[int]) -> Dict[int, int]:
+    totals: Dict[int, int] = {}
+    rows = db.execute(
+        select(models.ProductStockShard.product_id, models.ProductStockShard.stock_amount)
+        .where(models.ProductStockShard.product_id.in_(list(product_ids)))
+        .order_by(models.ProductStockShard.product_id, models.ProductStockShard.shard)
+        .with_for_update()
+    ).all()
+    for row in rows:
+        totals[row.product_id] = totals.get(row.product_id, 0) + row.stock_amount
+    return totals
+
+
+def shard_totals(db: Session, product_ids: Iterable[int]) -> Dict[int, int]:
+    """Current stock of sharded products ({product_id: sum of shards}), read without locks."""
+    rows = db.execute(
+        select(models.ProductStockShard.product_id, func.sum(models.ProductStockShard.stock_amount))
+        .where(models.ProductStockShard.product_id.in_(list(product_ids)))
+        .group_by(models.ProductStockShard.product_id)
+    ).all()
+    return {product_id: int(total) for product_id, total in rows}
+
+
+def fold_shards(db: Session, product_ids: Iterable[int]) -> None:
+    """
+    Before an edit that reads stock_amount (e.g. a delta update): lock the
+    products, then the shards of the sharded ones (the order set_shards() and
+    reconcile() use), and copy each shard sum into stock_amount. The locks are
+    held until commit, so no reservation slips in between the fold and
+    spread_shards().
+    """
+    rows = db.execute(
+        select(models.Product.product_id, models.Product.stock_shards)
+        .where(models.Product.product_id.in_(sorted(product_ids)))
+        .order_by(models.Product.product_id)
+        .with_for_update()
+    ).all()
+    sharded = [row.product_id for row in rows if row.stock_shards]
+    if not sharded:
+        return
+    totals = _locked_shard_totals(db, sharded)
+    if totals:
+        db.execute(
+            update(models.Product),
+            [{"product_id": product_id, "stock_amount": total} for product_id, total in totals.items()],
+        )
+
+
+def spread_shards(db: Session, product_ids: Iterable[int]) -> None:
+    """After stock_amount of products was written directly: redistribute it over their shards."""
+    rows = db.execute(
+        select(models.Product.product_id, models.Product.stock_amount, models.Product.stock_shards)
+        .where(models.Product.product_id.in_(list(product_ids)), models.Product.stock_shards > 0)
+    ).all()
+    for row in rows:
+        _write_shards(db, row.product_id, row.stock_amount, row.stock_shards)
+
+
+def set_shards(db: Session, product_id: int, shards: int) -> Optional[models.Product]:
+    """
+    Switch a product to `shards` stock shards (0 = back to a single counter),
+    keeping its total stock. Commits; returns None if the product is missing.
+    """
+    try:
+        product = db.execute(
+            select(models.Product).where(models.Product.product_id == product_id).with_for_update()
+        ).scalar()
+        if product is None:
+            return None
+        total = product.stock_amount
+        if product.stock_shards:
+            total = _locked_shard_totals(db, [product_id]).get(product_id, 0)
+        db.execute(delete(models.ProductStockShard).where(models.ProductStockShard.product_id == product_id))
+        if shards:
+            _write_shards(db, product_id, total, shards)
+        product.stock_amount = total
+        product.stock_shards = shards
+        db.flush()
+        changefeed.record(db, [product_id])
+        db.commit()
+        db.refresh(product)
+        logger.info(f"Product {product_id} stock now kept in {shards or 1} counter(s), total {total}")
+        return product
+    except Exception:
+        db.rollback()
+        raise
+
+
+def drop_shards(db: Session, product_ids: Iterable[int]) -> None:
+    db.execute(delete(models.ProductStockShard).where(models.ProductStockShard.product_id.in_(list(product_ids))))
+
+
+# ==========================================
+# Cart (TEMP order)
+# ==========================================
+def _find_cart(db: Session, user_id: int, for_update: bool = False) -> Optional[int]:
+    query = (
+        select(models.Order.order_id)
+        .where(models.Order.user_id == user_id, models.Order.status == models.OrderStatus.TEMP)
+        .order_by(models.Order.order_id)
+        .limit(1)
+    )
+    if for_update:
+        query = query.with_for_update()
+    return db.execute(query).scalar()
+
+
+def get_or_create_cart(db: Session, user_id: int) -> int:
+    """
+    Return the id of the user's TEMP order, creating it if needed.
+
+    Creation is serialized per user by locking the user's row, and the cart is
+    looked up again with a locking read after the lock is held. Two concurrent
+    first adds therefore end up in the same cart instead of creating two. An
+    existing cart is locked too, so the expiry sweeper cannot archive it while
+    items are being added.
+    """
+    order_id = _find_cart(db, user_id, for_update=True)
+    if order_id is not None:
+        return order_id
+
+    db.execute(select(models.User.id).where(models.User.id == user_id).with_for_update())
+    order_id = _find_cart(db, user_id, for_update=True)
+    if order_id is not None:
+        return order_id
+
+    order = models.Order(
+        user_id=user_id,
+        status=models.OrderStatus.TEMP,
+        order_date=datetime.utcnow(),
+        total_price=0.0,
+    )
+    db.add(order)
+    db.flush()
+    return order.order_id
+
+
+def add_to_cart(db: Session, user_id: int, product_id: int, quantity: int) -> Tuple[str, int]:
+    """
+    Reserve stock and add one line to the user's cart in a single transaction.
+
+    Returns (product name, order_id). Raises ProductNotFound or
+    InsufficientStock after rolling back; nothing is left half-applied.
+    """
+    try:
+        product = db.execute(
+            select(models.Product.name, models.Product.price, models.Product.stock_shards)
+            .where(models.Product.product_id == product_id)
+        ).first()
+        if product is None:
+            raise ProductNotFound(product_id)
+        if not reserve_stock(db, product_id, quantity, product.stock_shards):
+            raise InsufficientStock(product_id)
+
+        order_id = get_or_create_cart(db, user_id)
+        db.execute(insert(models.OrderItem).values(order_id=order_id, product_id=product_id, quantity=quantity))
+        db.execute(
+            update(models.Order)
+            .where(models.Order.order_id == order_id)
+            .values(total_price=models.Order.total_price + product.price * quantity, order_date=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        if not product.stock_shards:
+            # Sharded products are recorded by reconcile() once stock_amount catches up.
+            changefeed.record(db, [product_id])
+        db.commit()
+        return product.name, order_id
+    except Exception:
+        db.rollback()
+        raise
+
+
+
+def add_many_to_cart(db: Session, user_id: int, lines: List[schemas.CartItemIn]) -> schemas.CartBatchReport:
+    """
+    Add several lines to the user's cart in one transaction.
+
+    All products are read and locked with one IN query (in product_id order,
+    so concurrent batches cannot deadlock), stock is checked line by line in
+    Python and the new stock values are written back with one executemany.
+    Order lines are inserted with a single multi-row INSERT. Lines that fail
+    (unknown product, not enough stock) are reported and do not stop the rest.
+    Sharded products are reserved line by line from their shards.
+    """
+    try:
+        product_ids = sorted({line.product_id for line in lines})
+        products = {
+            row.product_id: row
+            for row in db.execute(
+                select(
+                    models.Product.product_id,
+                    models.Product.name,
+                    models.Product.price,
+                    models.Product.stock_amount,
+                    models.Product.stock_shards,
+                )
+                .where(models.Product.product_id.in_(product_ids))
+                .order_by(models.Product.product_id)
+                .with_for_update()
+            )
+        }
+
+        available = {product_id: row.stock_amount for product_id, row in products.items() if not row.stock_shards}
+        results: List[schemas.CartItemResult] = []
+        accepted: List[schemas.CartItemIn] = []
+        for line in lines:
+            product = products.get(line.product_id)
+            if product is None:
+                status = "not_found"
+            elif product.stock_shards:
+                status = "added" if _reserve_sharded(db, line.product_id, line.quantity, product.stock_shards) else "insufficient_stock"
+            elif available[line.product_id] >= line.quantity:
+                available[line.product_id] -= line.quantity
+                status = "added"
+            else:
+                status = "insufficient_stock"
+            results.append(schemas.CartItemResult(
+                product_id=line.product_id, name=product.name if product else None, quantity=line.quantity, status=status
+            ))
+            if status == "added":
+                accepted.append(line)
+
+        if not accepted:
+            db.rollback()
+            return schemas.CartBatchReport(order_id=None, added=0, failed=len(results), results=results)
+
+        # Every row in `available` is locked by this transaction, so writing the
+        # computed values back cannot lose a concurrent reservation.
+        taken = [
+            {"product_id": product_id, "stock_amount": stock}
+            for product_id, stock in available.items()
+            if stock != products[product_id].stock_amount
+        ]
+        if taken:
+            db.execute(update(models.Product), taken)
+
+        order_id = get_or_create_cart(db, user_id)
+        db.execute(insert(models.OrderItem), [
+            {"order_id": order_id, "product_id": line.product_id, "quantity": line.quantity} for line in accepted
+        ])
+        db.execute(
+            update(models.Order)
+            .where(models.Order.order_id == order_id)
+            .values(
+                total_price=models.Order.total_price + sum(products[line.product_id].price * line.quantity for line in accepted),
+                order_date=datetime.utcnow(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        changefeed.record(db, [row["product_id"] for row in taken])
+        db.commit()
+        return schemas.CartBatchReport(
+            order_id=order_id, added=len(accepted), failed=len(results) - len(accepted), results=results
+        )
+    except Exception:
+        db.rollback()
+        raise
+
+
+# ==========================================
+# Stored carts (CART_STORE=memory|dbm)
+# ==========================================
+# Carts kept outside the database hold no stock. Adding only checks that the
+# stock is there right now; stock is reserved, and the Order + OrderItem rows
+# are written, in one transaction when the cart is closed. Abandoned carts
+# therefore cost no database writes at all.
+
+
+def _current_stock(db: Session, product_ids: List[int]) -> Dict[int, Tuple[str, int]]:
+    """{product_id: (name, stock)} read without locks; sharded products report their shard total."""
+    rows = db.execute(
+        select(models.Product.product_id, models.Product.name, models.Product.stock_amount, models.Product.stock_shards)
+        .where(models.Product.product_id.in_(product_ids))
+    ).all()
+    totals = shard_totals(db, [row.product_id for row in rows if row.stock_shards])
+    return {row.product_id: (row.name, totals.get(row.product_id, row.stock_amount)) for row in rows}
+
+
+def add_to_stored_cart(db: Session, store, user_id: int, lines: List[schemas.CartItemIn]) -> schemas.CartBatchReport:
+    """Check every line against current stock (and what is already in the cart), then add the accepted ones."""
+    cart = store.get(user_id)
+    stock = _current_stock(db, sorted({line.product_id for line in lines}))
+    wanted = dict(cart)
+    accepted: Dict[int, int] = {}
+    results: List[schemas.CartItemResult] = []
+    for line in lines:
+        if line.product_id not in stock:
+            status = "not_found"
+        elif wanted.get(line.product_id, 0) + line.quantity <= stock[line.product_id][1]:
+            wanted[line.product_id] = wanted.get(line.product_id, 0) + line.quantity
+            accepted[line.product_id] = accepted.get(line.product_id, 0) + line.quantity
+            status = "added"
+        else:
+            status = "insufficient_stock"
+        name = stock[line.product_id][0] if line.product_id in stock else None
+        results.append(schemas.CartItemResult(product_id=line.product_id, name=name, quantity=line.quantity, status=status))
+
+    if accepted:
+        store.add(user_id, accepted)
+    added = sum(1 for result in results if result.status == "added")
+    return schemas.CartBatchReport(
+        order_id=cart_store.CART_ORDER_ID if added or cart else None,
+        added=added,
+        failed=len(results) - added,
+        results=results,
+    )
+
+
+def close_stored_cart(db: Session, store, user_id: int) -> Tuple[int, Dict[int, int]]:
+    """
+    Turn the user's stored cart into a CLOSE order in one transaction: lock
+    the products, reserve all lines, write the order and bulk-insert its lines.
+    Returns (order_id, {product_id: quantity}). Raises EmptyCart, or
+    InsufficientStock with the short product ids; the cart is then kept as is.
+    """
+    cart = store.get(user_id)
+    if not cart:
+        raise EmptyCart(user_id)
+    try:
+        products = {
+            row.product_id: row
+            for row in db.execute(
+                select(models.Product.product_id, models.Product.price, models.Product.stock_amount, models.Product.stock_shards)
+                .where(models.Product.product_id.in_(sorted(cart)))
+                .order_by(models.Product.product_id)
+                .with_for_update()
+            )
+        }
+        short = []
+        for product_id, quantity in cart.items():
+            product = products.get(product_id)
+            if product is None:
+                short.append(product_id)
+            elif product.stock_shards:
+                if not _reserve_sharded(db, product_id, quantity, product.stock_shards):
+                    short.append(product_id)
+            elif product.stock_amount < quantity:
+                short.append(product_id)
+        if short:
+            raise InsufficientStock(sorted(short))
+
+        unsharded = [product_id for product_id in cart if not products[product_id].stock_shards]
+        if unsharded:
+            db.execute(update(models.Product), [
+                {"product_id": product_id, "stock_amount": products[product_id].stock_amount - cart[product_id]}
+                for product_id in unsharded
+            ])
+
+        order = models.Order(
+            user_id=user_id,
+            status=models.OrderStatus.CLOSE,
+            order_date=datetime.utcnow(),
+            total_price=sum(products[product_id].price * quantity for product_id, quantity in cart.items()),
+        )
+        db.add(order)
+        db.flush()
+        order_id = order.order_id
+        # Prices come from the rows locked above, so they match the total.
+        db.execute(insert(models.OrderItem), [
+            {"order_id": order_id, "product_id": product_id, "quantity": quantity, "unit_price": products[product_id].price}
+            for product_id, quantity in cart.items()
+        ])
+        changefeed.record(db, unsharded)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    store.remove(user_id, cart)
+    return order_id, cart
+
+# ==========================================
+# Reconciliation (background)
+# ==========================================
+def _reconcile_candidates(db: Session) -> list:
+    """Sharded products whose stock_amount has drifted or with an empty shard, read without locks."""
+    rows = db.execute(
+        select(
+            models.Product.product_id,
+            models.Product.stock_amount,
+            models.Product.stock_shards,
+            func.sum(models.ProductStockShard.stock_amount).label("total"),
+            func.min(models.ProductStockShard.stock_amount).label("smallest"),
+        )
+        .join(models.ProductStockShard, models.ProductStockShard.product_id == models.Product.product_id)
+        .where(models.Product.stock_shards > 0)
+        .group_by(models.Product.product_id, models.Product.stock_amount, models.Product.stock_shards)
+    ).all()
+    return [
+        row for row in rows
+        if row.total != row.stock_amount or (row.smallest == 0 and row.total >= row.stock_shards)
+    ]
+
+
+def reconcile(db: Session) -> None:
+    """
+    Copy each sharded product's shard total into products.stock_amount (so
+    listings, search and the change feed catch up) and rebalance products
+    whose stock has piled up unevenly, leaving some shards empty.
+
+    Candidates come from an unlocked scan; each one is then handled in its
+    own short transaction that locks the product row and its shards (the
+    order set_shards uses) and re-reads both, so a product unsharded or
+    edited since the scan never gets the scanned total written over it.
+    """
+    reconciled = []
+    for row in _reconcile_candidates(db):
+        shards = db.scalar(
+            select(models.Product.stock_shards).where(models.Product.product_id == row.product_id).with_for_update()
+        )
+        total = _locked_shard_totals(db, [row.product_id]).get(row.product_id) if shards else None
+        if total is None:
+            # Unsharded or deleted since the scan: stock_amount is authoritative again.
+            db.rollback()
+            continue
+        updated = db.execute(
+            update(models.Product)
+            .where(
+                models.Product.product_id == row.product_id,
+                models.Product.stock_shards > 0,
+                models.Product.stock_amount != total,
+            )
+            .values(stock_amount=total)
+        ).rowcount
+        rebalance = row.smallest == 0 and total >= shards
+        if rebalance:
+            _write_shards(db, row.product_id, total, shards)
+        if updated:
+            changefeed.record(db, [row.product_id])
+        db.commit()
+        if updated:
+            reconciled.append(row.product_id)
+        if rebalance:
+            _count("rebalanced")
+
+    if reconciled:
+        catalog.invalidate_products(reconciled)
+        _count("reconciled", len(reconciled))
+
+
+def reconcile_task() -> None:
+    db = database.SessionLocal()
+    try:
+        reconcile(db)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _stats() -> dict:
+    with _counters_lock:
+        return dict(_counters)
+
+
+metrics.register("inventory", _stats)
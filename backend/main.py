@@ -3,18 +3,53 @@ from dotenv import load_dotenv
 from backend.routers import auth
 import os
 
-from backend.database import create_tables
+from backend import (
+    cart_store, catalog, changefeed, idempotency, inventory, metrics, passwords, ratelimit, revocation, rollups,
+    sweeper, tasks,
+)
+from backend.database import SessionLocal, create_tables, replicas, REPLICA_CHECK_INTERVAL, track_writes
+from backend.search import SEARCH_INDEX_ENABLED, product_index, product_suggester
 from backend.routers import customers, products, orders, payments, user_wishlist
 import backend.gpt as gpt
 
 load_dotenv()
 app = FastAPI(title="BuySmart API")
+app.middleware("http")(track_writes)
 app.include_router(auth.router)
 
 
 @app.on_event("startup")
 def on_startup():
     create_tables()
+    db = SessionLocal()
+    try:
+        rollups.ensure_built(db)
+        revocation.sync(db)
+        catalog.start_following(db)
+    finally:
+        db.close()
+    if replicas.replicas:
+        replicas.check()
+        tasks.schedule("replica-health", REPLICA_CHECK_INTERVAL, replicas.check)
+    if SEARCH_INDEX_ENABLED:
+        product_index.build(SessionLocal)
+        product_suggester.build(SessionLocal)
+    tasks.schedule("catalog-follow", catalog.CATALOG_FOLLOW_INTERVAL, catalog.follow_task)
+    tasks.schedule("changefeed-compaction", changefeed.CHANGE_FEED_COMPACT_INTERVAL, changefeed.compact_task)
+    tasks.schedule("inventory-reconcile", inventory.INVENTORY_RECONCILE_INTERVAL, inventory.reconcile_task)
+    tasks.schedule("cart-sweeper", sweeper.TEMP_ORDER_SWEEP_INTERVAL, sweeper.sweep_task)
+    if cart_store.cart_store is not None:
+        tasks.schedule("cart-store-purge", cart_store.CART_PURGE_INTERVAL, cart_store.purge_task)
+    tasks.schedule("idempotency-purge", idempotency.IDEMPOTENCY_PURGE_INTERVAL, idempotency.purge_task)
+    tasks.schedule("token-revocation-sync", revocation.REVOCATION_SYNC_INTERVAL, revocation.sync_task)
+    tasks.schedule("login-rate-purge", ratelimit.LOGIN_RATE_PURGE_INTERVAL, ratelimit.purge_task)
+    passwords.start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    tasks.stop_all()
+    passwords.shutdown()
 
 app.include_router(customers.router)
 app.include_router(products.router)
@@ -27,6 +62,10 @@ app.include_router(gpt.router)
 def health():
     return {"status": "ok"}
 
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
 @app.get("/")
 def root():
     return {"message": "ברוכים הבאים ל־BuySmart!"}
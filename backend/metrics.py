@@ -0,0 +1,16 @@
+from typing import Callable, Dict
+
+# ==========================================
+# In-process metrics registry
+# ==========================================
+# Components register a callable returning a dict of counters; GET /metrics
+# returns a snapshot of all of them. Counters are per worker process.
+_providers: Dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, provider: Callable[[], dict]) -> None:
+    _providers[name] = provider
+
+
+def snapshot() -> dict:
+    return {name: provider() for name, provider in _providers.items()}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Enum
+from sqlalchemy import Boolean, Column, Integer, String, Float, Enum, Index, Text
 import enum
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy import Date, ForeignKey
@@ -6,8 +6,6 @@ from sqlalchemy import DateTime
 from datetime import datetime
 from backend.database import Base
 
-Base = declarative_base()
-
 class Customer(Base):
     __tablename__ = "customers"
 
@@ -28,16 +26,53 @@ class Product(Base):
     name = Column(String(255), nullable=False)
     price = Column(Float, nullable=False)
     stock_amount = Column(Integer, nullable=False)
+    # 0 = stock is kept in stock_amount. N > 0 = stock is split across N rows of
+    # product_stock_shards and stock_amount is a copy refreshed by the reconciler.
+    stock_shards = Column(Integer, nullable=False, default=0, server_default="0")
+
+
+class ProductStockShard(Base):
+    """One independently decremented slice of a hot product's stock (see backend/inventory.py)."""
+    __tablename__ = "product_stock_shards"
+
+    product_id = Column(Integer, ForeignKey("products.product_id", ondelete="CASCADE"), primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    stock_amount = Column(Integer, nullable=False)
+
+
+class ProductChange(Base):
+    """Append-only catalog change log behind GET /products/changes (see backend/changefeed.py)."""
+    __tablename__ = "product_changes"
+    __table_args__ = (Index("ix_product_changes_product_seq", "product_id", "seq"),)
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    product_id = Column(Integer, nullable=False)
+    op = Column(String(10), nullable=False)
+    name = Column(String(255))
+    price = Column(Float)
+    stock_amount = Column(Integer)
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
 
 
+class CatalogVersion(Base):
+    """Single row bumped in every transaction that records product changes; catalog ETags are built from it."""
+    __tablename__ = "catalog_version"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, nullable=False)
+
 
 class OrderStatus(enum.Enum):
     TEMP = "TEMP"
     CLOSE = "CLOSE"
+    EXPIRED = "EXPIRED"
 
 
 class Order(Base):
     __tablename__ = "orders"
+    # For a TEMP order, order_date is the day of the last cart change; the
+    # expiry sweeper scans this index for idle carts.
+    __table_args__ = (Index("ix_orders_status_date", "status", "order_date"),)
 
     order_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -57,18 +92,94 @@ class OrderItem(Base):
     order_id = Column(Integer, ForeignKey("orders.order_id"))
     product_id = Column(Integer, ForeignKey("products.product_id"))
     quantity = Column(Integer, nullable=False)
+    # Product price at checkout; NULL while the order is still a cart.
+    unit_price = Column(Float)
 
     order = relationship("Order", back_populates="items")
+    product = relationship("Product")
 
 
 class Payment(Base):
     __tablename__ = "payments"
+    # Serve GET /payments/ filters with keyset order (paid_at, payment_id).
+    __table_args__ = (
+        Index("ix_payments_paid_at", "paid_at", "payment_id"),
+        Index("ix_payments_method_paid_at", "payment_method", "paid_at", "payment_id"),
+        Index("ix_payments_order_paid_at", "order_id", "paid_at", "payment_id"),
+    )
 
     payment_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     order_id = Column(Integer, ForeignKey("orders.order_id"))
     payment_method = Column(String(50), nullable=False)
     amount = Column(Float, nullable=False)
     paid_at = Column(DateTime, nullable=False)
+    # Settlement reference of an imported payment; unique, so importing a file again skips it.
+    external_ref = Column(String(128), unique=True)
+
+
+class PaymentRollup(Base):
+    """Running payment count and amount per (dimension, bucket), e.g. ("method", "card"); see backend/rollups.py."""
+    __tablename__ = "payment_rollups"
+
+    dimension = Column(String(20), primary_key=True)
+    bucket = Column(String(50), primary_key=True)
+    payment_count = Column(Integer, nullable=False, default=0)
+    total_amount = Column(Float, nullable=False, default=0.0)
+
+
+class PaymentImportStaging(Base):
+    """Validated rows of a running payment import; see importer.import_payments."""
+    __tablename__ = "payment_import_staging"
+    __table_args__ = (Index("ix_payment_import_staging_order", "import_id", "order_id"),)
+
+    import_id = Column(String(32), primary_key=True)
+    line_no = Column(Integer, primary_key=True, autoincrement=False)
+    order_id = Column(Integer, nullable=False)
+    payment_method = Column(String(50), nullable=False)
+    amount = Column(Float, nullable=False)
+    paid_at = Column(DateTime, nullable=False)
+    external_ref = Column(String(128), nullable=False)
+    # Set when a payment with the same external_ref already exists.
+    duplicate = Column(Boolean, nullable=False, default=False)
+
+
+class RevokedToken(Base):
+    """A revoked access token or user, shared by all workers; see backend/revocation.py."""
+    __tablename__ = "revoked_tokens"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    token_key = Column(String(64), nullable=False)
+    revoked_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class RateLimitBucket(Base):
+    """Token bucket shared by all workers (LOGIN_RATE_STORE=db); see backend/ratelimit.py."""
+    __tablename__ = "rate_limit_buckets"
+
+    bucket_key = Column(String(200), primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False, index=True)
+
+
+class ReplicaHeartbeat(Base):
+    """Single row the primary rewrites to measure replica lag; see backend/database.py."""
+    __tablename__ = "replica_heartbeat"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    beat_at = Column(Float, nullable=False)
+
+
+class IdempotencyRecord(Base):
+    """Stored response of a write made with an Idempotency-Key; see backend/idempotency.py."""
+    __tablename__ = "idempotency_keys"
+
+    user_id = Column(Integer, primary_key=True)
+    route = Column(String(64), primary_key=True)
+    idempotency_key = Column(String(128), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
 
 
 class UserWishlist(Base):
@@ -82,6 +193,8 @@ class UserWishlist(Base):
 
 class User(Base):
     __tablename__ = "users"
+    # Never hand a deleted user's id to a new account: tokens and revocations are keyed by it.
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, index=True)
     first_name = Column(String(100), nullable=False)
@@ -93,4 +206,6 @@ class User(Base):
     country = Column(String(100))
     phone = Column(String(50))
 
+    orders = relationship("Order", back_populates="user")
+
 
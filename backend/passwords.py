@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+from passlib.context import CryptContext
+
+from backend import metrics
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+# bcrypt cost factor (2^rounds iterations). Hashes made with another cost are
+# rehashed on the next successful login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Processes that hash and verify passwords, so logins never hold the request threadpool.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Jobs running or waiting in the pool; further logins are turned away with 503.
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "64"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+
+class PasswordPoolBusy(Exception):
+    """PASSWORD_HASH_QUEUE jobs are already queued."""
+
+
+# ==========================================
+# Work done in the pool processes
+# ==========================================
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """(matches, new hash if the stored one uses another cost, else None)."""
+    return pwd_context.verify_and_update(password, hashed)
+
+
+def _ready() -> bool:
+    return True
+
+
+# ==========================================
+# Pool
+# ==========================================
+_executor: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+_stats = {"pending": 0, "completed": 0, "rejected": 0, "busy_ms": 0.0}
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawn: workers import only this module instead of forking a
+            # threaded server process.
+            _executor = ProcessPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+            logger.info(f"Password hashing pool started with {PASSWORD_HASH_WORKERS} processes.")
+        return _executor
+
+
+async def _run(fn, *args):
+    with _lock:
+        if _stats["pending"] >= PASSWORD_HASH_QUEUE:
+            _stats["rejected"] += 1
+            raise PasswordPoolBusy()
+        _stats["pending"] += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), fn, *args)
+    finally:
+        with _lock:
+            _stats["pending"] -= 1
+            _stats["completed"] += 1
+            _stats["busy_ms"] += 1000 * (time.perf_counter() - started)
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run(hash_password, password)
+
+
+async def verify_and_update_async(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return await _run(verify_and_update, password, hashed)
+
+
+def start() -> None:
+    """Start the pool's processes now instead of on the first login."""
+    executor = _get_executor()
+    for future in [executor.submit(_ready) for _ in range(PASSWORD_HASH_WORKERS)]:
+        future.result()
+
+
+def shutdown() -> None:
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+
+
+def stats() -> dict:
+    with _lock:
+        completed = _stats["completed"]
+        return {
+            "workers": PASSWORD_HASH_WORKERS,
+            "queue_limit": PASSWORD_HASH_QUEUE,
+            "bcrypt_rounds": BCRYPT_ROUNDS,
+            "pending": _stats["pending"],
+            "completed": completed,
+            "rejected": _stats["rejected"],
+            "avg_ms": round(_stats["busy_ms"] / completed, 3) if completed else 0.0,
+        }
+
+
+metrics.register("password_pool", stats)
@@ -0,0 +1,168 @@
+import logging
+import math
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+
+from backend import database, metrics, models, passwords
+from backend.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+# Token buckets for POST /auth/login: `burst` attempts at once, then
+# `per_minute` more each minute. One bucket per username and one per client IP.
+LOGIN_USER_BURST = float(os.getenv("LOGIN_USER_BURST", "5"))
+LOGIN_USER_PER_MINUTE = float(os.getenv("LOGIN_USER_PER_MINUTE", "5"))
+LOGIN_IP_BURST = float(os.getenv("LOGIN_IP_BURST", "20"))
+LOGIN_IP_PER_MINUTE = float(os.getenv("LOGIN_IP_PER_MINUTE", "30"))
+# "memory" - buckets live in this process only
+# "db"     - buckets live in rate_limit_buckets and are shared by every worker
+LOGIN_RATE_STORE = os.getenv("LOGIN_RATE_STORE", "memory").lower()
+LOGIN_RATE_MAX_KEYS = int(os.getenv("LOGIN_RATE_MAX_KEYS", "100000"))
+LOGIN_RATE_PURGE_INTERVAL = float(os.getenv("LOGIN_RATE_PURGE_INTERVAL", "600"))
+
+_stats = {"attempts": 0, "allowed": 0, "rejected_user": 0, "rejected_ip": 0}
+_stats_lock = threading.Lock()
+
+
+def _refill(tokens: float, updated_at: float, now: float, burst: float, per_second: float) -> float:
+    return min(burst, tokens + (now - updated_at) * per_second)
+
+
+def _take(tokens: float, burst: float, per_second: float) -> Tuple[float, float]:
+    """(tokens left, seconds to wait): takes one token if there is one."""
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / per_second if per_second > 0 else math.inf
+
+
+# ==========================================
+# Stores
+# ==========================================
+class MemoryBucketStore:
+    """Buckets in a TTLCache; a bucket is forgotten once it would be full again anyway."""
+    name = "memory"
+
+    def __init__(self, maxsize: int):
+        self._buckets = TTLCache(maxsize, 3600)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, burst: float, per_second: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key) or (burst, now)
+            tokens, wait = _take(_refill(tokens, updated_at, now, burst, per_second), burst, per_second)
+            full_in = (burst - tokens) / per_second if per_second > 0 else 86400
+            self._buckets.set(key, (tokens, now), ttl=max(full_in, 1))
+        return wait
+
+    def purge_expired(self) -> int:
+        return self._buckets.purge_expired()
+
+    def stats(self) -> dict:
+        return {"store": self.name, "buckets": len(self._buckets)}
+
+
+class DbBucketStore:
+    """Buckets in rate_limit_buckets; each take is one short locking transaction."""
+    name = "db"
+
+    def take(self, key: str, burst: float, per_second: float) -> float:
+        for _ in range(2):
+            now = time.time()
+            db = database.SessionLocal()
+            try:
+                bucket = db.get(models.RateLimitBucket, key, with_for_update=True)
+                if bucket is None:
+                    bucket = models.RateLimitBucket(bucket_key=key, tokens=burst, updated_at=now)
+                    db.add(bucket)
+                tokens = _refill(bucket.tokens, bucket.updated_at, now, burst, per_second)
+                bucket.tokens, wait = _take(tokens, burst, per_second)
+                bucket.updated_at = now
+                db.commit()
+                return wait
+            except IntegrityError:
+                # Another worker created the bucket first; lock theirs instead.
+                db.rollback()
+            finally:
+                db.close()
+        raise RuntimeError(f"Could not update rate limit bucket {key}")
+
+    def purge_expired(self) -> int:
+        # Buckets untouched for a day are full again under any sane refill rate.
+        db = database.SessionLocal()
+        try:
+            removed = db.execute(
+                delete(models.RateLimitBucket).where(models.RateLimitBucket.updated_at < time.time() - 86400)
+            ).rowcount
+            db.commit()
+            return removed
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        return {"store": self.name}
+
+
+def _create_store():
+    if LOGIN_RATE_STORE == "memory":
+        return MemoryBucketStore(LOGIN_RATE_MAX_KEYS)
+    if LOGIN_RATE_STORE == "db":
+        return DbBucketStore()
+    raise ValueError(f"Unknown LOGIN_RATE_STORE '{LOGIN_RATE_STORE}' (expected memory or db)")
+
+
+store = _create_store()
+
+
+# ==========================================
+# Login limiter
+# ==========================================
+def check_login(username: str, client_ip: Optional[str]) -> float:
+    """
+    Charge one login attempt to the username's and the client IP's buckets.
+    Returns 0 if the attempt may go ahead, otherwise the seconds until it
+    could; a rejected attempt never reaches the password check.
+    """
+    with _stats_lock:
+        _stats["attempts"] += 1
+    wait = store.take(f"login:user:{username.lower()}", LOGIN_USER_BURST, LOGIN_USER_PER_MINUTE / 60)
+    outcome = "rejected_user"
+    if not wait and client_ip:
+        wait = store.take(f"login:ip:{client_ip}", LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE / 60)
+        outcome = "rejected_ip"
+    with _stats_lock:
+        _stats[outcome if wait else "allowed"] += 1
+    return wait
+
+
+def retry_after(wait: float) -> str:
+    return str(max(1, math.ceil(min(wait, 86400))))
+
+
+def purge_task() -> None:
+    removed = store.purge_expired()
+    if removed:
+        logger.info(f"Login rate limiter purged {removed} idle buckets.")
+
+
+def _metrics() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    rejected = stats["rejected_user"] + stats["rejected_ip"]
+    # Each rejected attempt skipped one bcrypt verify, at the pool's average cost.
+    verify_ms = passwords.stats()["avg_ms"]
+    return {**store.stats(), **stats, "bcrypt_ms_saved_estimate": round(rejected * verify_ms, 1)}
+
+
+metrics.register("login_rate_limit", _metrics)
@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from backend import database, metrics, models
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+REVOCATION_FILTER_BITS = int(os.getenv("REVOCATION_FILTER_BITS", str(1 << 20)))
+REVOCATION_FILTER_HASHES = 7
+REVOCATION_SYNC_INTERVAL = float(os.getenv("REVOCATION_SYNC_INTERVAL", "5"))
+# Rows are re-read this far back on every sync, so a revocation committed
+# late by a slow transaction (or on a host with a slightly behind clock) is
+# still picked up.
+REVOCATION_SYNC_OVERLAP = timedelta(seconds=60)
+
+
+def token_key(token: str) -> str:
+    return "token:" + hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+
+def user_key(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def _epoch(utc: datetime) -> float:
+    return utc.replace(tzinfo=timezone.utc).timestamp()
+
+
+# ==========================================
+# In-memory filter
+# ==========================================
+class RevocationFilter:
+    """
+    Bloom filter in front of an exact {key: expiry} map. Almost every
+    lookup is for a key that was never revoked and ends at a few bit tests;
+    a Bloom hit is confirmed in the exact map, so false positives never
+    reject a valid token. Entries are dropped once they expire (a revoked
+    token cannot outlive its own exp anyway) and the bits are rebuilt then.
+    """
+
+    def __init__(self, bits: int, hashes: int):
+        self.bits = bits
+        self.hashes = hashes
+        self._bitmap = bytearray(bits // 8 + 1)
+        self._exact: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.filter_hits = 0
+        self.revoked_hits = 0
+
+    def _positions(self, key: str) -> Iterable[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.hashes).digest()
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[4 * i:4 * i + 4], "little") % self.bits
+
+    def add(self, key: str, expires_at: float) -> None:
+        with self._lock:
+            if self._exact.get(key, 0) < expires_at:
+                self._exact[key] = expires_at
+            for position in self._positions(key):
+                self._bitmap[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        self.checks += 1
+        bitmap = self._bitmap
+        if not all(bitmap[position >> 3] & (1 << (position & 7)) for position in self._positions(key)):
+            return False
+        self.filter_hits += 1
+        with self._lock:
+            revoked = self._exact.get(key, 0) > time.time()
+        if revoked:
+            self.revoked_hits += 1
+        return revoked
+
+    def purge_expired(self) -> int:
+        """Drop expired entries and rebuild the bits from the rest; returns how many were dropped."""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, expires_at in self._exact.items() if expires_at <= now]
+            if not expired:
+                return 0
+            for key in expired:
+                del self._exact[key]
+            bitmap = bytearray(len(self._bitmap))
+            for key in self._exact:
+                for position in self._positions(key):
+                    bitmap[position >> 3] |= 1 << (position & 7)
+            self._bitmap = bitmap
+        return len(expired)
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._exact)
+        return {
+            "revoked": size,
+            "filter_bits": self.bits,
+            "checks": self.checks,
+            "filter_hits": self.filter_hits,
+            "revoked_hits": self.revoked_hits,
+        }
+
+
+revoked = RevocationFilter(REVOCATION_FILTER_BITS, REVOCATION_FILTER_HASHES)
+
+
+# ==========================================
+# Shared revocations (revoked_tokens table)
+# ==========================================
+# Every worker mirrors the table into `revoked`; revocations made by this
+# worker apply immediately, those of other workers after REVOCATION_SYNC_INTERVAL.
+_synced_until = datetime(1970, 1, 1)
+
+
+def revoke(db: Session, key: str, expires_at: datetime) -> None:
+    """Revoke `key` (token_key / user_key) until `expires_at` (UTC) for every worker; commits."""
+    db.execute(insert(models.RevokedToken), [{"token_key": key, "expires_at": expires_at}])
+    db.commit()
+    revoked.add(key, _epoch(expires_at))
+
+
+def sync(db: Session) -> int:
+    """Load revocations recorded since the last sync; returns how many rows were read."""
+    global _synced_until
+    started = datetime.utcnow()
+    rows = db.execute(
+        select(models.RevokedToken.token_key, models.RevokedToken.expires_at)
+        .where(models.RevokedToken.revoked_at >= _synced_until - REVOCATION_SYNC_OVERLAP)
+        .where(models.RevokedToken.expires_at > started)
+    ).all()
+    for key, expires_at in rows:
+        revoked.add(key, _epoch(expires_at))
+    _synced_until = started
+    return len(rows)
+
+
+def sync_task() -> None:
+    revoked.purge_expired()
+    db = database.SessionLocal()
+    try:
+        db.execute(delete(models.RevokedToken).where(models.RevokedToken.expires_at <= datetime.utcnow()))
+        db.commit()
+        sync(db)
+    finally:
+        db.close()
+
+
+metrics.register("token_revocation", revoked.stats)
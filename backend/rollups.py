@@ -0,0 +1,212 @@
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from backend import database, models
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Payment rollups
+# ==========================================
+# payment_rollups holds a running (count, amount) per bucket of each
+# dimension. Payment writes adjust the affected buckets in the same
+# transaction, so summaries read a few dozen rows instead of every payment.
+DIMENSIONS = ("method", "day", "month", "order_status")
+NO_ORDER = "NONE"
+# A row outside every dimension that serializes rebuilds against rollup writes:
+# writers hold it shared, a rebuild holds it exclusively.
+REBUILD_LOCK = ("rebuild_lock", "")
+REBUILD_BATCH_SIZE = 5000
+
+# (dimension, bucket) -> [payment_count, total_amount]
+Deltas = Dict[Tuple[str, str], List[float]]
+
+
+def _buckets(payment_method: str, paid_at: datetime, order_status: Optional[str]) -> Iterable[Tuple[str, str]]:
+    yield "method", payment_method
+    yield "day", paid_at.strftime("%Y-%m-%d")
+    yield "month", paid_at.strftime("%Y-%m")
+    yield "order_status", order_status or NO_ORDER
+
+
+def _add(deltas: Deltas, payment_method: str, amount: float, paid_at: datetime, order_status: Optional[str], sign: int) -> None:
+    for key in _buckets(payment_method, paid_at, order_status):
+        entry = deltas.setdefault(key, [0, 0.0])
+        entry[0] += sign
+        entry[1] += sign * amount
+
+
+def _write(db: Session, deltas: Deltas) -> None:
+    """Add `deltas` to the rollup rows with one multi-row upsert (keys sorted, so lock order is fixed)."""
+    rows = [
+        {"dimension": dimension, "bucket": bucket, "payment_count": count, "total_amount": amount}
+        for (dimension, bucket), (count, amount) in sorted(deltas.items())
+        if count or amount
+    ]
+    if not rows:
+        return
+    _share_rebuild_lock(db)
+    table = models.PaymentRollup.__table__
+    stmt = database.upsert(
+        db, table, ["dimension", "bucket"],
+        lambda new: {
+            "payment_count": table.c.payment_count + new.payment_count,
+            "total_amount": table.c.total_amount + new.total_amount,
+        },
+    )
+    db.execute(stmt, rows)
+
+
+def _order_statuses(db: Session, order_ids: Iterable[Optional[int]]) -> Dict[int, str]:
+    """
+    Current status of each order, read with a shared lock held until commit,
+    so checkout or the sweeper cannot change it before the payment is counted.
+    Orders are locked in order_id order and before the rollup rows, as checkout does.
+    """
+    order_ids = sorted({order_id for order_id in order_ids if order_id is not None})
+    if not order_ids:
+        return {}
+    rows = db.execute(
+        select(models.Order.order_id, models.Order.status)
+        .where(models.Order.order_id.in_(order_ids))
+        .order_by(models.Order.order_id)
+        .with_for_update(read=True)
+    )
+    return {order_id: status.value for order_id, status in rows if status is not None}
+
+
+def apply(db: Session, payments: Iterable, sign: int = 1) -> None:
+    """
+    Count `payments` (objects with order_id, payment_method, amount, paid_at)
+    into the rollups, or out of them with sign=-1. Call inside the writing
+    transaction; the caller commits.
+    """
+    payments = list(payments)
+    statuses = _order_statuses(db, (payment.order_id for payment in payments))
+    deltas: Deltas = {}
+    for payment in payments:
+        _add(deltas, payment.payment_method, payment.amount, payment.paid_at, statuses.get(payment.order_id), sign)
+    _write(db, deltas)
+
+
+def orders_status_changed(db: Session, order_ids: List[int], old_status: str, new_status: Optional[str]) -> None:
+    """Move the payments of `order_ids` between order_status buckets (one aggregate query)."""
+    if not order_ids:
+        return
+    count, amount = db.execute(
+        select(func.count(), func.coalesce(func.sum(models.Payment.amount), 0.0))
+        .where(models.Payment.order_id.in_(order_ids))
+    ).one()
+    if count:
+        _write(db, {
+            ("order_status", old_status): [-count, -amount],
+            ("order_status", new_status or NO_ORDER): [count, amount],
+        })
+
+
+# ==========================================
+# Rebuild
+# ==========================================
+def _share_rebuild_lock(db: Session) -> None:
+    """Wait out a running rebuild, and keep one from starting until this transaction ends."""
+    dimension, bucket = REBUILD_LOCK
+    db.execute(
+        select(models.PaymentRollup.dimension)
+        .where(models.PaymentRollup.dimension == dimension, models.PaymentRollup.bucket == bucket)
+        .with_for_update(read=True)
+    )
+
+
+def _take_rebuild_lock(db: Session) -> None:
+    """
+    Lock the REBUILD_LOCK row exclusively (creating it if needed) until
+    commit. Call before reading payments: writers that already counted a
+    payment have committed by then, and later ones wait, then add their
+    deltas to the rebuilt rows.
+    """
+    dimension, bucket = REBUILD_LOCK
+    table = models.PaymentRollup.__table__
+    stmt = database.upsert(db, table, ["dimension", "bucket"], lambda new: {"payment_count": table.c.payment_count})
+    db.execute(stmt, [{"dimension": dimension, "bucket": bucket, "payment_count": 0, "total_amount": 0.0}])
+
+
+def _has_rollups(db: Session) -> bool:
+    return db.execute(
+        select(models.PaymentRollup.dimension).where(models.PaymentRollup.dimension != REBUILD_LOCK[0]).limit(1)
+    ).first() is not None
+
+
+def _recount(db: Session) -> int:
+    """Replace every rollup with counts from the payments table (streamed); returns the payment count."""
+    deltas: Deltas = {}
+    seen = 0
+    result = db.execute(
+        select(models.Payment.payment_method, models.Payment.amount, models.Payment.paid_at, models.Order.status)
+        .outerjoin(models.Order, models.Order.order_id == models.Payment.order_id)
+        .execution_options(yield_per=REBUILD_BATCH_SIZE)
+    )
+    for payment_method, amount, paid_at, order_status in result:
+        _add(deltas, payment_method, amount, paid_at, order_status.value if order_status else None, 1)
+        seen += 1
+    db.execute(delete(models.PaymentRollup).where(models.PaymentRollup.dimension != REBUILD_LOCK[0]))
+    rows = [
+        {"dimension": dimension, "bucket": bucket, "payment_count": count, "total_amount": amount}
+        for (dimension, bucket), (count, amount) in sorted(deltas.items())
+    ]
+    if rows:
+        db.execute(insert(models.PaymentRollup), rows)
+    logger.info(f"Payment rollups rebuilt from {seen} payments ({len(deltas)} buckets).")
+    return seen
+
+
+def rebuild(db: Session) -> int:
+    """
+    Recompute every rollup from the payments table and commit; returns the
+    payment count. Safe while payments are being written.
+    """
+    # Start a new transaction, so the payments are read after the lock is held.
+    db.rollback()
+    try:
+        _take_rebuild_lock(db)
+        seen = _recount(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return seen
+
+
+def ensure_built(db: Session) -> None:
+    """
+    Build the rollups once for a database that has payments but no rollups
+    yet. Every worker calls this at startup; the first to take the rebuild
+    lock builds, the others then find the rollups and leave them alone.
+    """
+    try:
+        _take_rebuild_lock(db)
+        has_payments = db.execute(select(models.Payment.payment_id).limit(1)).first() is not None
+        if has_payments and not _has_rollups(db):
+            _recount(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+# ==========================================
+# Reading
+# ==========================================
+def summary(db: Session, dimension: str, start: Optional[str] = None, end: Optional[str] = None) -> List[models.PaymentRollup]:
+    """Non-empty buckets of `dimension`, in bucket order; `start`/`end` bound the bucket (e.g. dates)."""
+    query = select(models.PaymentRollup).where(
+        models.PaymentRollup.dimension == dimension, models.PaymentRollup.payment_count != 0
+    )
+    if start is not None:
+        query = query.where(models.PaymentRollup.bucket >= start)
+    if end is not None:
+        query = query.where(models.PaymentRollup.bucket <= end)
+    return db.scalars(query.order_by(models.PaymentRollup.bucket)).all()
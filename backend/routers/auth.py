@@ -1,50 +1,109 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from datetime import datetime, timedelta
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
 from backend.database import get_db
-from backend import models, schemas
-from backend.security import hash_password, verify_password, create_access_token
+from backend import models, passwords, ratelimit, revocation, schemas
+from backend.security import (
+    ACCESS_TOKEN_EXPIRE_MINUTES, access_token_claims, create_access_token, decode_token, get_current_user,
+    invalidate_user,
+)
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+# Register and login are async: bcrypt runs in the backend.passwords process
+# pool and the short database calls in the threadpool, so a burst of logins
+# never ties up the threads other endpoints run on.
+pool_busy = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many logins in progress, try again shortly",
+    headers={"Retry-After": "1"},
+)
+
+
+def _find_user(db: Session, username: str):
+    return db.query(models.User).filter(models.User.username == username).first()
+
+
+def _save(db: Session, row):
+    db.add(row)
+    db.commit()
+    db.refresh(row)
+    return row
+
+
 @router.post("/register", response_model=schemas.UserOut)
-def register(user: schemas.UserRegister, db: Session = Depends(get_db)):
-    existing = db.query(models.User).filter(models.User.username == user.username).first()
+async def register(user: schemas.UserRegister, db: Session = Depends(get_db)):
+    existing = await run_in_threadpool(_find_user, db, user.username)
     if existing:
         raise HTTPException(status_code=400, detail="Username already exists")
 
+    try:
+        password_hash = await passwords.hash_password_async(user.password)
+    except passwords.PasswordPoolBusy:
+        raise pool_busy
     new_user = models.User(
         first_name=user.first_name,
         last_name=user.last_name,
         email=user.email,
         username=user.username,
-        password_hash=hash_password(user.password),
+        password_hash=password_hash,
         city=user.city,
         country=user.country,
         phone=user.phone
     )
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    return new_user
+    return await run_in_threadpool(_save, db, new_user)
 
 @router.post("/login")
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.password_hash):
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    # Throttled per username and per client IP before any database or bcrypt work.
+    client_ip = request.client.host if request.client else None
+    wait = await run_in_threadpool(ratelimit.check_login, form_data.username, client_ip)
+    if wait:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, try again later",
+            headers={"Retry-After": ratelimit.retry_after(wait)},
+        )
+    user = await run_in_threadpool(_find_user, db, form_data.username)
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    try:
+        valid, new_hash = await passwords.verify_and_update_async(form_data.password, user.password_hash)
+    except passwords.PasswordPoolBusy:
+        raise pool_busy
+    if not valid:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
 
-    token = create_access_token({"sub": user.username})
+    if new_hash:
+        # Stored with another BCRYPT_ROUNDS cost: store the rehash.
+        user.password_hash = new_hash
+        await run_in_threadpool(_save, db, user)
+        invalidate_user(user.username)
+    token = create_access_token(access_token_claims(user))
     return {"access_token": token, "token_type": "bearer"}
 
+@router.post("/logout")
+def logout(token: str = Depends(oauth2_scheme), current_user=Depends(get_current_user), db: Session = Depends(get_db)):
+    """Revoke the presented token for every worker until it would have expired."""
+    expires_at = datetime.utcfromtimestamp(decode_token(token)["exp"])
+    revocation.revoke(db, revocation.token_key(token), expires_at)
+    return {"message": "Logged out"}
+
 @router.delete("/delete")
 def delete_user(username: str, db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.username == username).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    user_id = user.id
     db.delete(user)
     db.commit()
+    invalidate_user(username)
+    # Outstanding tokens stay valid until they expire; revoke them all.
+    revocation.revoke(db, revocation.user_key(user_id), datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     return {"message": "User deleted successfully"}
@@ -1,9 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from backend import models, schemas, database
-from backend.security import get_current_user
-from datetime import datetime
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from sqlalchemy import select
+from sqlalchemy.orm import Session, selectinload
+from backend import cart_store, catalog, checkout, inventory, models, schemas, database
+from backend.security import get_current_user, get_current_user_async
+from datetime import date
+from typing import List, Optional, Tuple
 import logging
 
 router = APIRouter(
@@ -13,6 +14,11 @@ router = APIRouter(
 
 logger = logging.getLogger(__name__)
 
+CART_BATCH_MAX = 500
+ORDER_INCLUDES = {"items", "products"}
+ORDER_PAGE_DEFAULT = 50
+ORDER_PAGE_MAX = 200
+
 # ==========================================================
 # Database Dependency
 # ==========================================================
@@ -47,69 +53,202 @@ def create_order(
 # ==========================================================
 # Get All Orders (Requires Authentication)
 # ==========================================================
-@router.get("/", response_model=List[schemas.Order])
-def get_all_orders(
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
-) -> List[schemas.Order]:
-    """Retrieve all orders belonging to the current user."""
+@router.get("/", response_model=List[schemas.OrderOut])
+async def get_all_orders(
+    response: Response,
+    limit: int = Query(ORDER_PAGE_DEFAULT, ge=1, le=ORDER_PAGE_MAX),
+    before: Optional[int] = Query(None, description="Cursor: return orders with a smaller order_id (X-Next-Cursor)"),
+    order_status: Optional[models.OrderStatus] = Query(None, alias="status"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    include: Optional[str] = Query(None, description="Comma-separated: items, products"),
+    db=Depends(database.get_request_db),
+    current_user: models.User = Depends(get_current_user_async)
+) -> List[schemas.OrderOut]:
+    """
+    Retrieve the current user's orders, newest first, one page at a time.
+
+    `include=items` embeds the order lines and `include=products` also embeds
+    each line's product. They are loaded with one extra query each for the
+    whole page, never one per order.
+    """
+    includes = {part.strip() for part in (include or "").split(",") if part.strip()}
+    if includes - ORDER_INCLUDES:
+        raise HTTPException(status_code=400, detail=f"include accepts: {', '.join(sorted(ORDER_INCLUDES))}.")
+    with_products = "products" in includes
+    with_items = with_products or "items" in includes
+
+    query = select(models.Order).where(models.Order.user_id == current_user.id)
+    if before is not None:
+        query = query.where(models.Order.order_id < before)
+    if order_status is not None:
+        query = query.where(models.Order.status == order_status)
+    if date_from is not None:
+        query = query.where(models.Order.order_date >= date_from)
+    if date_to is not None:
+        query = query.where(models.Order.order_date <= date_to)
+    if with_products:
+        query = query.options(selectinload(models.Order.items).selectinload(models.OrderItem.product))
+    elif with_items:
+        query = query.options(selectinload(models.Order.items))
+    # A stored cart is listed first, on the first page, as TEMP order 0.
+    with_cart = cart_store.cart_store is not None and before is None and order_status in (None, models.OrderStatus.TEMP)
+
     try:
-        orders = db.query(models.Order).filter(models.Order.user_id == current_user.id).all()
-        if not orders:
+        result, next_cursor = await database.run_db(
+            db, _orders_page, query.order_by(models.Order.order_id.desc()).limit(limit),
+            current_user.id, limit, with_cart, with_items, with_products,
+        )
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = str(next_cursor)
+        if not result:
             logger.warning(f"No orders found for user: {current_user.username}")
-        return orders
+        return result
     except Exception as e:
         logger.exception(f"Error retrieving orders for {current_user.username}: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving orders.")
 
+
+def _orders_page(
+    db: Session, query, user_id: int, limit: int, with_cart: bool, with_items: bool, with_products: bool
+) -> Tuple[List[schemas.OrderOut], Optional[int]]:
+    """(page of orders, next cursor); the stored cart, if any and wanted, comes first."""
+    orders = db.scalars(query).all()
+    result = [_order_out(order, with_items, with_products) for order in orders]
+    if with_cart:
+        cart = _stored_cart_out(db, user_id, with_items, with_products)
+        if cart is not None:
+            result.insert(0, cart)
+    return result, orders[-1].order_id if len(orders) == limit else None
+
+
+def _stored_cart_out(db: Session, user_id: int, with_items: bool, with_products: bool) -> Optional[schemas.OrderOut]:
+    lines = cart_store.cart_store.get(user_id)
+    if not lines:
+        return None
+    products = {
+        product.product_id: product
+        for product in db.scalars(select(models.Product).where(models.Product.product_id.in_(list(lines))))
+    }
+    items = None
+    if with_items:
+        items = [
+            schemas.OrderLineOut(
+                id=0,
+                product_id=product_id,
+                quantity=quantity,
+                product=schemas.ProductOut.model_validate(products[product_id]) if with_products and product_id in products else None,
+            )
+            for product_id, quantity in lines.items()
+        ]
+    return schemas.OrderOut(
+        order_id=cart_store.CART_ORDER_ID,
+        user_id=user_id,
+        status=models.OrderStatus.TEMP.value,
+        order_date=date.today(),
+        total_price=sum(products[product_id].price * quantity for product_id, quantity in lines.items() if product_id in products),
+        items=items,
+    )
+
+
+def _order_out(order: models.Order, with_items: bool, with_products: bool) -> schemas.OrderOut:
+    """Build the response by hand so relationships that were not requested are never lazy-loaded."""
+    items = None
+    if with_items:
+        items = [
+            schemas.OrderLineOut(
+                id=item.id,
+                product_id=item.product_id,
+                quantity=item.quantity,
+                unit_price=item.unit_price,
+                product=schemas.ProductOut.model_validate(item.product) if with_products and item.product else None,
+            )
+            for item in order.items
+        ]
+    return schemas.OrderOut(
+        order_id=order.order_id,
+        user_id=order.user_id,
+        status=order.status.value,
+        order_date=order.order_date,
+        shipping_address=order.shipping_address,
+        total_price=order.total_price,
+        items=items,
+    )
+
 # ==========================================================
 # Add Item to TEMP Order
 # ==========================================================
 @router.post("/add_item/", status_code=status.HTTP_200_OK)
 def add_item_to_order(
     product_id: int,
-    quantity: int = 1,
+    quantity: int = Query(1, ge=1),
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    """Add an item to the user's TEMP order (cart)."""
+    """Add an item to the user's TEMP order (cart), reserving stock atomically."""
     try:
-        product = db.query(models.Product).filter(models.Product.product_id == product_id).first()
-        if not product:
-            raise HTTPException(status_code=404, detail="Product not found.")
-
-        if product.stock_amount < quantity:
-            raise HTTPException(status_code=400, detail="Insufficient stock available.")
-
-        order = db.query(models.Order).filter(
-            models.Order.user_id == current_user.id,
-            models.Order.status == models.OrderStatus.TEMP
-        ).first()
-
-        if not order:
-            order = models.Order(
-                user_id=current_user.id,
-                status=models.OrderStatus.TEMP,
-                order_date=datetime.utcnow(),
-                total_price=0.0
-            )
-            db.add(order)
-            db.commit()
-            db.refresh(order)
-
-        product.stock_amount -= quantity
-        order_item = models.OrderItem(order_id=order.order_id, product_id=product_id, quantity=quantity)
-        db.add(order_item)
-        order.total_price += product.price * quantity
-        db.commit()
+        store = cart_store.cart_store
+        if store is not None:
+            line = schemas.CartItemIn(product_id=product_id, quantity=quantity)
+            report = inventory.add_to_stored_cart(db, store, current_user.id, [line])
+            result = report.results[0]
+            if result.status == "not_found":
+                raise inventory.ProductNotFound(product_id)
+            if result.status == "insufficient_stock":
+                raise inventory.InsufficientStock(product_id)
+            product_name, order_id = result.name, report.order_id
+        else:
+            product_name, order_id = inventory.add_to_cart(db, current_user.id, product_id, quantity)
+            catalog.stock_adjusted({product_id: -quantity})
 
-        logger.info(f"Added {quantity} x {product.name} to order {order.order_id} for {current_user.username}")
-        return {"message": f"Added {quantity} x {product.name} to order {order.order_id}."}
+        logger.info(f"Added {quantity} x {product_name} to order {order_id} for {current_user.username}")
+        return {"message": f"Added {quantity} x {product_name} to order {order_id}."}
 
+    except inventory.ProductNotFound:
+        raise HTTPException(status_code=404, detail="Product not found.")
+    except inventory.InsufficientStock:
+        raise HTTPException(status_code=400, detail="Insufficient stock available.")
     except Exception as e:
         logger.exception(f"Error adding product {product_id} to order: {e}")
         raise HTTPException(status_code=500, detail="Error adding item to order.")
 
+# ==========================================================
+# Add Many Items to TEMP Order
+# ==========================================================
+@router.post("/items/batch", response_model=schemas.CartBatchReport, status_code=status.HTTP_200_OK)
+def add_items_to_order(
+    items: List[schemas.CartItemIn],
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+) -> schemas.CartBatchReport:
+    """
+    Add several items to the user's TEMP order (cart) in one transaction.
+    Every line gets its own result; lines that cannot be added do not stop the others.
+    """
+    if not items:
+        raise HTTPException(status_code=400, detail="No items given.")
+    if len(items) > CART_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {CART_BATCH_MAX} items per request.")
+    try:
+        if cart_store.cart_store is not None:
+            report = inventory.add_to_stored_cart(db, cart_store.cart_store, current_user.id, items)
+            logger.info(f"Added {report.added} of {len(items)} items to the stored cart of {current_user.username}")
+            return report
+
+        report = inventory.add_many_to_cart(db, current_user.id, items)
+        deltas = {}
+        for result in report.results:
+            if result.status == "added":
+                deltas[result.product_id] = deltas.get(result.product_id, 0) - result.quantity
+        if deltas:
+            catalog.stock_adjusted(deltas)
+
+        logger.info(f"Added {report.added} of {len(items)} items to order {report.order_id} for {current_user.username}")
+        return report
+    except Exception as e:
+        logger.exception(f"Error adding {len(items)} items to order: {e}")
+        raise HTTPException(status_code=500, detail="Error adding items to order.")
+
 # ==========================================================
 # Close TEMP Order
 # ==========================================================
@@ -120,24 +259,39 @@ def close_order(
     current_user: models.User = Depends(get_current_user)
 ):
     """Close the user's TEMP order (checkout)."""
+    if order_id == cart_store.CART_ORDER_ID and cart_store.cart_store is not None:
+        return _close_stored_cart(db, current_user)
     try:
-        order = db.query(models.Order).filter(
-            models.Order.order_id == order_id,
-            models.Order.user_id == current_user.id
-        ).first()
-
-        if not order:
+        result = checkout.checkout_orders(db, [order_id], user_id=current_user.id)[0]
+        if result.status == "not_found":
             raise HTTPException(status_code=404, detail="Order not found.")
-
-        if order.status == models.OrderStatus.CLOSE:
+        if result.status == "expired":
+            raise HTTPException(status_code=400, detail="Order has expired.")
+        if result.status == "already_closed":
             return {"message": "Order already closed."}
 
-        order.status = models.OrderStatus.CLOSE
-        db.commit()
-
-        logger.info(f"Order {order_id} closed successfully for user {current_user.username}")
+        logger.info(f"Order {order_id} closed successfully for user {current_user.username}, total {result.total_price}")
         return {"message": f"Order {order_id} has been closed successfully."}
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error closing order {order_id}: {e}")
         raise HTTPException(status_code=500, detail="Error closing order.")
+
+
+def _close_stored_cart(db: Session, current_user: models.User) -> dict:
+    """Materialize the user's stored cart as a closed order (CART_STORE=memory|dbm)."""
+    try:
+        order_id, lines = inventory.close_stored_cart(db, cart_store.cart_store, current_user.id)
+        catalog.stock_adjusted({product_id: -quantity for product_id, quantity in lines.items()})
+        logger.info(f"Cart of {current_user.username} closed as order {order_id}")
+        return {"message": f"Order {order_id} has been closed successfully."}
+    except inventory.EmptyCart:
+        raise HTTPException(status_code=404, detail="Order not found.")
+    except inventory.InsufficientStock as e:
+        products = ", ".join(map(str, e.args[0]))
+        raise HTTPException(status_code=400, detail=f"Insufficient stock available for products: {products}.")
+    except Exception as e:
+        logger.exception(f"Error closing cart of {current_user.username}: {e}")
+        raise HTTPException(status_code=500, detail="Error closing order.")
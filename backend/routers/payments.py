@@ -1,8 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, File, Header, HTTPException, Query, Response, UploadFile, status
+from sqlalchemy import and_, or_, select
 from sqlalchemy.orm import Session
-from backend import models, schemas, database
-from backend.security import get_current_user
-from typing import List
+from backend import idempotency, importer, models, rollups, schemas, database
+from backend.security import get_current_user, get_current_user_async
+from datetime import datetime
+from typing import List, Literal, Optional, Tuple
 import logging
 
 router = APIRouter(
@@ -12,6 +14,9 @@ router = APIRouter(
 
 logger = logging.getLogger(__name__)
 
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 1000
+
 
 # ==================================================
 # Database Dependency
@@ -30,37 +35,144 @@ def get_db():
 @router.post("/", response_model=schemas.Payment, status_code=status.HTTP_201_CREATED)
 def create_payment(
         payment: schemas.PaymentCreate,
+        response: Response,
+        idempotency_key: Optional[str] = Header(
+            None, alias="Idempotency-Key", min_length=1, max_length=idempotency.IDEMPOTENCY_KEY_MAX_LENGTH
+        ),
         db: Session = Depends(get_db),
         current_user: models.User = Depends(get_current_user)
 ) -> schemas.Payment:
     """
     Create a new payment (requires authentication).
+    A retry with the same Idempotency-Key returns the first response instead of paying twice.
     """
-    try:
+    def write() -> dict:
         new_payment = models.Payment(**payment.dict())
         db.add(new_payment)
-        db.commit()
-        db.refresh(new_payment)
-        logger.info(f"Payment created successfully. ID: {new_payment.payment_id}")
-        return new_payment
+        rollups.apply(db, [new_payment])
+        db.flush()
+        return schemas.Payment.model_validate(new_payment).model_dump(mode="json")
+
+    try:
+        if idempotency_key is None:
+            created = write()
+            db.commit()
+        else:
+            created, replayed = idempotency.run_once(
+                db, current_user.id, "POST /payments/", idempotency_key, payment.model_dump(mode="json"), write
+            )
+            if replayed:
+                response.headers["Idempotent-Replayed"] = "true"
+                logger.info(f"Payment request replayed for key {idempotency_key}. ID: {created['payment_id']}")
+                return created
+        logger.info(f"Payment created successfully. ID: {created['payment_id']}")
+        return created
+    except idempotency.IdempotencyKeyReused:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request.")
     except Exception as e:
         logger.exception(f"Error creating payment: {e}")
         raise HTTPException(status_code=500, detail="Error creating payment.")
 
 
 # ==================================================
-# Retrieve All Payments (Requires Authentication)
+# Bulk Import Payments (Requires Authentication)
 # ==================================================
-@router.get("/", response_model=List[schemas.Payment])
-def get_all_payments(
+@router.post("/import", response_model=schemas.PaymentImportReport, status_code=status.HTTP_200_OK)
+def import_payments(
+        file: UploadFile = File(..., description="CSV with an order_id,amount,payment_method,paid_at header, or NDJSON"),
+        output_format: Optional[str] = Query(None, alias="format", pattern="^(csv|ndjson)$", description="Defaults to the file extension"),
         db: Session = Depends(get_db),
         current_user: models.User = Depends(get_current_user)
+) -> schemas.PaymentImportReport:
+    """
+    Bulk insert payments from a settlement file in batched transactions and
+    reconcile them against their orders.
+    """
+    try:
+        fmt = output_format or importer.detect_format(file.filename, file.content_type)
+        report = importer.import_payments(db, file.file, fmt)
+        logger.info(f"Payments imported by {current_user.username}: {report.rows_written} written, {report.rows_failed} failed.")
+        return report
+    except Exception as e:
+        logger.exception(f"Error importing payments: {e}")
+        raise HTTPException(status_code=500, detail="Error importing payments.")
+
+
+# ==================================================
+# Retrieve All Payments (Requires Authentication)
+# ==================================================
+def encode_cursor(payment: models.Payment) -> str:
+    return f"{payment.paid_at.isoformat()},{payment.payment_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    paid_at, payment_id = cursor.rsplit(",", 1)
+    return datetime.fromisoformat(paid_at), int(payment_id)
+
+
+def payments_query(
+        paid_from: Optional[datetime] = None,
+        paid_to: Optional[datetime] = None,
+        method: Optional[str] = None,
+        order_id: Optional[int] = None,
+        cursor: Optional[Tuple[datetime, int]] = None,
+        limit: int = PAGE_SIZE_DEFAULT,
+):
+    """
+    Newest-first page of payments. Every filter combination is a range on one
+    of the (..., paid_at, payment_id) indexes, and the cursor continues strictly
+    after the last row of the previous page, so a page never scans what
+    earlier pages returned.
+    """
+    query = select(models.Payment)
+    if method is not None:
+        query = query.where(models.Payment.payment_method == method)
+    if order_id is not None:
+        query = query.where(models.Payment.order_id == order_id)
+    if paid_from is not None:
+        query = query.where(models.Payment.paid_at >= paid_from)
+    if paid_to is not None:
+        query = query.where(models.Payment.paid_at < paid_to)
+    if cursor is not None:
+        paid_at, payment_id = cursor
+        # The redundant paid_at <= bound keeps this a plain index range on every engine.
+        query = query.where(
+            models.Payment.paid_at <= paid_at,
+            or_(
+                models.Payment.paid_at < paid_at,
+                and_(models.Payment.paid_at == paid_at, models.Payment.payment_id < payment_id),
+            ),
+        )
+    return query.order_by(models.Payment.paid_at.desc(), models.Payment.payment_id.desc()).limit(limit)
+
+
+def _scalars(db: Session, query) -> list:
+    return db.scalars(query).all()
+
+
+@router.get("/", response_model=List[schemas.Payment])
+async def get_all_payments(
+        response: Response,
+        paid_from: Optional[datetime] = Query(None, alias="from", description="Paid at or after"),
+        paid_to: Optional[datetime] = Query(None, alias="to", description="Paid before"),
+        method: Optional[str] = None,
+        order_id: Optional[int] = None,
+        cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+        limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+        db=Depends(database.get_request_db),
+        current_user: models.User = Depends(get_current_user_async)
 ) -> List[schemas.Payment]:
     """
-    Retrieve all payments (for authenticated users).
+    Retrieve payments, newest first, one page at a time (for authenticated users).
     """
     try:
-        payments = db.query(models.Payment).all()
+        position = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    try:
+        payments = await database.run_db(db, _scalars, payments_query(paid_from, paid_to, method, order_id, position, limit))
+        if len(payments) == limit:
+            response.headers["X-Next-Cursor"] = encode_cursor(payments[-1])
         if not payments:
             logger.warning("No payments found in the database.")
         logger.info(f"{len(payments)} payments retrieved successfully.")
@@ -70,25 +182,98 @@ def get_all_payments(
         raise HTTPException(status_code=500, detail="Error retrieving payments.")
 
 
+# ==================================================
+# Payment Summaries (Requires Authentication)
+# ==================================================
+def _summary_rows(rows) -> List[schemas.PaymentSummaryRow]:
+    return [
+        schemas.PaymentSummaryRow(bucket=row.bucket, payment_count=row.payment_count, total_amount=round(row.total_amount, 2))
+        for row in rows
+    ]
+
+
+def _payment_summary(db: Session) -> schemas.PaymentSummary:
+    by_method = _summary_rows(rollups.summary(db, "method"))
+    return schemas.PaymentSummary(
+        payment_count=sum(row.payment_count for row in by_method),
+        total_amount=round(sum(row.total_amount for row in by_method), 2),
+        by_method=by_method,
+        by_order_status=_summary_rows(rollups.summary(db, "order_status")),
+        by_month=_summary_rows(rollups.summary(db, "month")),
+    )
+
+
+@router.get("/summary", response_model=schemas.PaymentSummary)
+async def get_payment_summary(
+        db=Depends(database.get_request_db),
+        current_user: models.User = Depends(get_current_user_async)
+) -> schemas.PaymentSummary:
+    """
+    Payment totals overall and by method, order status and month, read from the rollup tables.
+    """
+    try:
+        return await database.run_db(db, _payment_summary)
+    except Exception as e:
+        logger.exception(f"Error retrieving payment summary: {e}")
+        raise HTTPException(status_code=500, detail="Error retrieving payment summary.")
+
+
+@router.get("/summary/{dimension}", response_model=List[schemas.PaymentSummaryRow])
+async def get_payment_summary_by(
+        dimension: Literal["method", "day", "month", "order_status"],
+        start: Optional[str] = Query(None, description="First bucket to include, e.g. 2025-01-01 or 2025-01"),
+        end: Optional[str] = Query(None, description="Last bucket to include"),
+        db=Depends(database.get_request_db),
+        current_user: models.User = Depends(get_current_user_async)
+) -> List[schemas.PaymentSummaryRow]:
+    """
+    Payment count and amount per bucket of one dimension (method, day, month or order_status).
+    """
+    try:
+        return _summary_rows(await database.run_db(db, rollups.summary, dimension, start, end))
+    except Exception as e:
+        logger.exception(f"Error retrieving payment summary by {dimension}: {e}")
+        raise HTTPException(status_code=500, detail="Error retrieving payment summary.")
+
+
+@router.post("/summary/rebuild", status_code=status.HTTP_200_OK)
+def rebuild_payment_summary(
+        db: Session = Depends(get_db),
+        current_user: models.User = Depends(get_current_user)
+) -> dict:
+    """
+    Recompute the rollup tables from all payments (after manual data fixes).
+    """
+    try:
+        count = rollups.rebuild(db)
+        logger.info(f"Payment rollups rebuilt by {current_user.username}")
+        return {"message": f"Payment summary rebuilt from {count} payments."}
+    except Exception as e:
+        logger.exception(f"Error rebuilding payment summary: {e}")
+        raise HTTPException(status_code=500, detail="Error rebuilding payment summary.")
+
+
 # ==================================================
 # Retrieve Payment by ID (Requires Authentication)
 # ==================================================
 @router.get("/{payment_id}", response_model=schemas.Payment)
-def get_payment(
+async def get_payment(
         payment_id: int,
-        db: Session = Depends(get_db),
-        current_user: models.User = Depends(get_current_user)
+        db=Depends(database.get_request_db),
+        current_user: models.User = Depends(get_current_user_async)
 ) -> schemas.Payment:
     """
     Retrieve a specific payment by its ID.
     """
     try:
-        payment = db.query(models.Payment).filter(models.Payment.payment_id == payment_id).first()
+        payment = await database.run_db(db, Session.get, models.Payment, payment_id)
         if not payment:
             logger.error(f"Payment not found. ID: {payment_id}")
             raise HTTPException(status_code=404, detail="Payment not found.")
         logger.info(f"Payment retrieved successfully. ID: {payment_id}")
         return payment
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error retrieving payment {payment_id}: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving payment.")
@@ -113,13 +298,17 @@ def update_payment(
             logger.error(f"Payment not found for update. ID: {payment_id}")
             raise HTTPException(status_code=404, detail="Payment not found.")
 
+        rollups.apply(db, [schemas.Payment.model_validate(payment)], -1)
         for key, value in updated_payment.dict().items():
             setattr(payment, key, value)
+        rollups.apply(db, [payment])
 
         db.commit()
         db.refresh(payment)
         logger.info(f"Payment updated successfully. ID: {payment_id}")
         return payment
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error updating payment {payment_id}: {e}")
         raise HTTPException(status_code=500, detail="Error updating payment.")
@@ -143,10 +332,13 @@ def delete_payment(
             logger.error(f"Payment not found for deletion. ID: {payment_id}")
             raise HTTPException(status_code=404, detail="Payment not found.")
 
+        rollups.apply(db, [payment], -1)
         db.delete(payment)
         db.commit()
         logger.info(f"Payment deleted successfully. ID: {payment_id}")
         return {"message": "Payment deleted successfully."}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error deleting payment {payment_id}: {e}")
         raise HTTPException(status_code=500, detail="Error deleting payment.")
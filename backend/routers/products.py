@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, status, Query, Request, Response, UploadFile
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from backend import models, schemas, database
+from backend import catalog, changefeed, importer, inventory, models, schemas, database
+from backend.search import SUGGEST_MAX_RESULTS, product_index, product_suggester
 from backend.security import get_current_user
-from typing import List, Optional
+from typing import Iterator, List, Optional
+import json
 import logging
 
 router = APIRouter(
@@ -12,6 +16,15 @@ router = APIRouter(
 
 logger = logging.getLogger(__name__)
 
+BATCH_UPDATE_MAX = 50000
+BATCH_CHUNK_SIZE = 1000
+CHANGES_PAGE_DEFAULT = 1000
+CHANGES_PAGE_MAX = 10000
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 1000
+STREAM_BATCH_SIZE = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
 # ==================================================
 # Database Dependency
 # ==================================================
@@ -38,8 +51,11 @@ def create_product(
     try:
         new_product = models.Product(**product.dict())
         db.add(new_product)
+        db.flush()
+        changefeed.record(db, [new_product.product_id])
         db.commit()
         db.refresh(new_product)
+        catalog.product_saved(new_product)
         logger.info(f"Product created successfully. ID: {new_product.product_id}")
         return new_product
     except Exception as e:
@@ -47,16 +63,274 @@ def create_product(
         raise HTTPException(status_code=500, detail="Error creating product.")
 
 
+# ==================================================
+# Bulk Import Products (Requires Authentication)
+# ==================================================
+@router.post("/import", response_model=schemas.ImportReport, status_code=status.HTTP_200_OK)
+def import_products(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(..., description="CSV with a name,price,stock_amount[,product_id] header, or NDJSON"),
+    output_format: Optional[str] = Query(None, alias="format", pattern="^(csv|ndjson)$", description="Defaults to the file extension"),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+) -> schemas.ImportReport:
+    """
+    Bulk insert/upsert products from an uploaded file in batched transactions.
+    Invalid rows are reported individually and do not stop the import.
+    """
+    try:
+        fmt = output_format or importer.detect_format(file.filename, file.content_type)
+        report = importer.import_products(db, file.file, fmt)
+        if report.rows_written:
+            background_tasks.add_task(catalog.catalog_reloaded, database.SessionLocal)
+        logger.info(f"Products imported by {current_user.username}: {report.rows_written} written, {report.rows_failed} failed.")
+        return report
+    except Exception as e:
+        logger.exception(f"Error importing products: {e}")
+        raise HTTPException(status_code=500, detail="Error importing products.")
+
+
+# ==================================================
+# Batch Update Prices / Stock (Requires Authentication)
+# ==================================================
+@router.patch("/batch", response_model=schemas.ProductBatchReport, status_code=status.HTTP_200_OK)
+def batch_update_products(
+    updates: List[schemas.ProductBatchUpdate],
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+) -> schemas.ProductBatchReport:
+    """
+    Apply many price/stock changes (absolute or delta) in one transaction.
+
+    Products are locked and read with one IN query per chunk of ids, new values
+    are checked in Python, and each chunk is written back with one multi-row
+    statement. Rejected lines do not stop the others; every product_id gets its
+    own result.
+    """
+    if len(updates) > BATCH_UPDATE_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_UPDATE_MAX} updates per request.")
+
+    try:
+        results = {}
+        changed = {}
+        product_ids = sorted({u.product_id for u in updates})
+        for start in range(0, len(product_ids), BATCH_CHUNK_SIZE):
+            chunk = product_ids[start:start + BATCH_CHUNK_SIZE]
+            # Locks the chunk's products (sorted), then their shards, before they are read.
+            inventory.fold_shards(db, chunk)
+            rows = db.execute(
+                select(models.Product.product_id, models.Product.name, models.Product.price, models.Product.stock_amount)
+                .where(models.Product.product_id.in_(chunk))
+                .order_by(models.Product.product_id)
+                .with_for_update()
+            ).all()
+            changed.update({row.product_id: schemas.ProductOut.model_validate(row) for row in rows})
+
+        for item in updates:
+            product = changed.get(item.product_id)
+            if product is None:
+                results[item.product_id] = schemas.ProductBatchResult(product_id=item.product_id, status="not_found")
+                continue
+            error = _apply_batch_item(product, item)
+            if error:
+                results[item.product_id] = schemas.ProductBatchResult(product_id=item.product_id, status="invalid", detail=error)
+
+        # A product with any rejected line keeps its current values.
+        changed = {product_id: p for product_id, p in changed.items() if product_id not in results}
+        _write_batch_values(db, list(changed.values()))
+        inventory.spread_shards(db, changed)
+        changefeed.record(db, changed)
+        db.commit()
+        catalog.products_saved(changed.values())
+
+        for product in changed.values():
+            results[product.product_id] = schemas.ProductBatchResult(
+                product_id=product.product_id, status="updated", price=product.price, stock_amount=product.stock_amount
+            )
+        logger.info(f"Batch update by {current_user.username}: {len(changed)} updated, {len(results) - len(changed)} failed.")
+        return schemas.ProductBatchReport(
+            updated=len(changed),
+            failed=len(results) - len(changed),
+            results=[results[product_id] for product_id in product_ids],
+        )
+    except Exception as e:
+        db.rollback()
+        logger.exception(f"Error applying batch product update: {e}")
+        raise HTTPException(status_code=500, detail="Error applying batch update.")
+
+
+def _apply_batch_item(product: schemas.ProductOut, item: schemas.ProductBatchUpdate) -> Optional[str]:
+    """Apply one update line to `product` in place; return an error message instead if it is invalid."""
+    if item.price is None and item.stock_amount is None:
+        return "Nothing to update: give price and/or stock_amount."
+    price, stock_amount = product.price, product.stock_amount
+    if item.price is not None:
+        price = price + item.price if item.mode == "delta" else item.price
+    if item.stock_amount is not None:
+        stock_amount = stock_amount + item.stock_amount if item.mode == "delta" else item.stock_amount
+    if price <= 0:
+        return "Price must be greater than zero."
+    if stock_amount < 0:
+        return "Stock must be zero or more."
+    product.price, product.stock_amount = price, stock_amount
+    return None
+
+
+def _write_batch_values(db: Session, products: List[schemas.ProductOut]) -> None:
+    """
+    Write the new values with a multi-row upsert keyed on product_id.
+
+    Every row was just read under FOR UPDATE, so the statement only ever takes
+    the update branch. It is one multi-row INSERT ... ON DUPLICATE KEY UPDATE
+    per chunk, which MySQL applies far faster than a CASE expression.
+    """
+    stmt = database.upsert(
+        db, models.Product.__table__, ["product_id"],
+        lambda new: {"price": new.price, "stock_amount": new.stock_amount},
+    )
+    for start in range(0, len(products), BATCH_CHUNK_SIZE):
+        chunk = products[start:start + BATCH_CHUNK_SIZE]
+        db.execute(stmt, [product.model_dump() for product in chunk])
+
+
 # ==================================================
 # Retrieve All Products (Public)
 # ==================================================
+def _not_modified(request: Request, etag: Optional[str]) -> Optional[Response]:
+    """Answer 304 straight away when the client already holds the current version."""
+    if etag and catalog.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return None
+
+
+def _index_etag(index, db: Session, *parts) -> Optional[str]:
+    """
+    ETag for a response served by an in-memory index (by `db` until it is
+    built), or None while that source may still miss changes from other
+    writers that the version already counts.
+    """
+    if index.ready and not catalog.indexes_current():
+        return None
+    if not index.ready and _replica_may_be_stale(db):
+        return None
+    return catalog.etag(*parts)
+
+
+def _wants_ndjson(request: Request, output_format: Optional[str]) -> bool:
+    if output_format is not None:
+        return output_format == "ndjson"
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def _stream_products(after: Optional[int], limit: Optional[int]) -> Iterator[str]:
+    """
+    Yield the catalog as NDJSON, one batch of lines at a time.
+
+    Runs on its own session because the request-scoped one is closed before
+    the response body is sent. `yield_per` turns on a server-side cursor, so
+    only one batch of rows is held in memory at any point.
+    """
+    db = database.SessionLocal()
+    try:
+        query = select(
+            models.Product.product_id,
+            models.Product.name,
+            models.Product.price,
+            models.Product.stock_amount,
+        ).order_by(models.Product.product_id)
+        if after is not None:
+            query = query.where(models.Product.product_id > after)
+        if limit is not None:
+            query = query.limit(limit)
+
+        result = db.execute(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+        for batch in result.partitions():
+            yield "".join(json.dumps(row._asdict()) + "\n" for row in batch)
+    except Exception as e:
+        logger.exception(f"Error streaming products: {e}")
+        raise
+    finally:
+        db.close()
+
+
+def _replica_may_be_stale(db) -> bool:
+    """A replica may not have product writes from the last REPLICA_STALE_WINDOW seconds yet."""
+    return database.on_replica(db) and catalog.changed_within(database.REPLICA_STALE_WINDOW)
+
+
+def _seen_version(db: Session) -> Optional[int]:
+    """Catalog version to cache a read under, or None (not cached) while a replica may be stale."""
+    if _replica_may_be_stale(db):
+        return None
+    return catalog.catalog_version()
+
+
+async def _read_etag(db, *parts) -> Optional[str]:
+    """
+    ETag for a response read through `db`, or None while it is a replica that
+    may be stale: its body must not be labelled, and later 304'd, as the
+    current version.
+    """
+    if _replica_may_be_stale(db):
+        return None
+    return await catalog.etag_async(*parts)
+
+
+def _products_page(db: Session, after: Optional[int], page_size: int):
+    """(products, next cursor) read from the database and cached for the next request."""
+    seen_version = _seen_version(db)
+    query = db.query(models.Product).order_by(models.Product.product_id)
+    if after is not None:
+        query = query.filter(models.Product.product_id > after)
+    rows = query.limit(page_size + 1).all()
+
+    next_cursor = rows[page_size - 1].product_id if len(rows) > page_size else None
+    return catalog.cache_page(after, page_size, rows[:page_size], next_cursor, seen_version), next_cursor
+
+
 @router.get("/", response_model=List[schemas.ProductOut], status_code=status.HTTP_200_OK)
-def get_all_products(db: Session = Depends(get_db)) -> List[schemas.ProductOut]:
+async def get_all_products(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, description=f"Page size (default {PAGE_SIZE_DEFAULT}, max {PAGE_SIZE_MAX}; unbounded when streaming)"),
+    after: Optional[int] = Query(None, ge=0, description="Cursor: only return products with a greater product_id"),
+    output_format: Optional[str] = Query(None, alias="format", pattern="^(json|ndjson)$", description="Set to 'ndjson' to stream the catalog"),
+    db=Depends(database.get_request_db)
+) -> List[schemas.ProductOut]:
     """
-    Retrieve all available products.
+    Retrieve products ordered by ID, one keyset page at a time.
+
+    Pass the `X-Next-Cursor` response header back as `after` to fetch the next
+    page; the header is absent on the last page. Send `Accept: application/x-ndjson`
+    (or `?format=ndjson`) to stream every product after the cursor instead.
+    Responses carry an ETag; a matching `If-None-Match` gets an empty 304.
     """
+    ndjson = _wants_ndjson(request, output_format)
+    page_size = limit if ndjson else min(limit or PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX)
+    # The stream reads the primary; pages are read through db, which may be a replica.
+    if ndjson:
+        etag = await catalog.etag_async("products", after, page_size, ndjson)
+    else:
+        etag = await _read_etag(db, "products", after, page_size, ndjson)
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+
+    if ndjson:
+        return StreamingResponse(_stream_products(after, limit), media_type=NDJSON_MEDIA_TYPE, headers={"ETag": etag})
+
+    if etag:
+        response.headers["ETag"] = etag
     try:
-        products = db.query(models.Product).all()
+        cached = catalog.get_page(after, page_size)
+        if cached is not None:
+            products, next_cursor = cached
+        else:
+            products, next_cursor = await database.run_db(db, _products_page, after, page_size)
+
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = str(next_cursor)
+
         if not products:
             logger.warning("No products found in the database.")
         else:
@@ -67,21 +341,118 @@ def get_all_products(db: Session = Depends(get_db)) -> List[schemas.ProductOut]:
         raise HTTPException(status_code=500, detail="Error retrieving products.")
 
 
+# ==================================================
+# Suggest Product Names (Public)
+# ==================================================
+@router.get("/suggest", response_model=List[schemas.ProductSuggestion], status_code=status.HTTP_200_OK)
+def suggest_products(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1, description="Beginning of any word in the product name"),
+    limit: int = Query(10, ge=1, le=SUGGEST_MAX_RESULTS, description="Maximum number of completions"),
+    db: Session = Depends(database.get_read_db)
+) -> List[schemas.ProductSuggestion]:
+    """
+    Type-ahead completions for product names, best stocked first.
+    Served from memory; falls back to SQL only until the index is built.
+    """
+    etag = _index_etag(product_suggester, db, "suggest", q, limit)
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    if etag:
+        response.headers["ETag"] = etag
+    try:
+        if product_suggester.ready:
+            return product_suggester.suggest(q, limit)
+
+        products = (
+            db.query(models.Product)
+            .filter(models.Product.name.ilike(f"{q}%"))
+            .order_by(models.Product.stock_amount.desc())
+            .limit(limit)
+            .all()
+        )
+        return [schemas.ProductSuggestion(product_id=p.product_id, name=p.name) for p in products]
+    except Exception as e:
+        logger.exception(f"Error suggesting products for '{q}': {e}")
+        raise HTTPException(status_code=500, detail="Error suggesting products.")
+
+
+# ==================================================
+# Catalog Change Feed (Public)
+# ==================================================
+@router.get("/changes", status_code=status.HTTP_200_OK)
+def get_product_changes(
+    since: int = Query(0, ge=0, description="Return changes with a sequence number greater than this"),
+    limit: int = Query(CHANGES_PAGE_DEFAULT, ge=1, le=CHANGES_PAGE_MAX, description="Maximum number of changes"),
+    db: Session = Depends(get_db)
+) -> StreamingResponse:
+    """
+    Stream catalog changes after `since` as NDJSON, oldest first.
+
+    Each line is a full product snapshot ("upsert") or a "delete" tombstone;
+    continue from the `seq` of the last line received. Fewer than `limit` lines
+    means the client is caught up. To start a mirror, read `X-Change-Head`,
+    load the catalog through GET /products, then follow changes since that head.
+    """
+    try:
+        change_head = changefeed.head(db)
+    except Exception as e:
+        logger.exception(f"Error reading change feed head: {e}")
+        raise HTTPException(status_code=500, detail="Error reading product changes.")
+
+    def stream() -> Iterator[str]:
+        for change in changefeed.iter_changes(since, limit):
+            yield schemas.ProductChangeOut.model_validate(change).model_dump_json() + "\n"
+
+    return StreamingResponse(stream(), media_type=NDJSON_MEDIA_TYPE, headers={"X-Change-Head": str(change_head)})
+
+
 # ==================================================
 # Retrieve Product by ID (Public)
 # ==================================================
+def _load_product(db: Session, product_id: int) -> Optional[schemas.ProductOut]:
+    """The product with its stock summed over its shards, cached; None if it does not exist."""
+    seen_version = _seen_version(db)
+    product = db.query(models.Product).filter(models.Product.product_id == product_id).first()
+    if not product:
+        return None
+    if product.stock_shards:
+        total = inventory.shard_totals(db, [product_id]).get(product_id, 0)
+        product = schemas.ProductOut.model_validate(product).model_copy(update={"stock_amount": total})
+    return catalog.cache_product(product, seen_version)
+
+
 @router.get("/{product_id}", response_model=schemas.ProductOut, status_code=status.HTTP_200_OK)
-def get_product(product_id: int, db: Session = Depends(get_db)) -> schemas.ProductOut:
+async def get_product(
+    product_id: int,
+    request: Request,
+    response: Response,
+    db=Depends(database.get_request_db)
+) -> schemas.ProductOut:
     """
     Retrieve a specific product by its ID.
     """
+    etag = await _read_etag(db, "product", product_id)
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    if etag:
+        response.headers["ETag"] = etag
     try:
-        product = db.query(models.Product).filter(models.Product.product_id == product_id).first()
+        cached = catalog.get_product(product_id)
+        if cached is not None:
+            return cached
+
+        product = await database.run_db(db, _load_product, product_id)
         if not product:
             logger.error(f"Product not found. ID: {product_id}")
             raise HTTPException(status_code=404, detail="Product not found.")
         logger.info(f"Product retrieved successfully. ID: {product_id}")
         return product
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error retrieving product {product_id}: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving product.")
@@ -109,15 +480,51 @@ def update_product(
         for key, value in updated_product.dict().items():
             setattr(product, key, value)
 
+        db.flush()
+        inventory.spread_shards(db, [product_id])
+        changefeed.record(db, [product_id])
         db.commit()
         db.refresh(product)
+        catalog.product_saved(product)
         logger.info(f"Product updated successfully. ID: {product_id}")
         return product
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error updating product {product_id}: {e}")
         raise HTTPException(status_code=500, detail="Error updating product.")
 
 
+# ==================================================
+# Stock Sharding (Requires Authentication)
+# ==================================================
+@router.put("/{product_id}/stock-shards", response_model=schemas.ProductOut, status_code=status.HTTP_200_OK)
+def set_stock_shards(
+    product_id: int,
+    body: schemas.StockShardsUpdate,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+) -> schemas.ProductOut:
+    """
+    Split a hot product's stock across `shards` independently decremented
+    counters (0 switches back to a single counter). Total stock is kept.
+    """
+    if body.shards > inventory.INVENTORY_MAX_SHARDS:
+        raise HTTPException(status_code=400, detail=f"At most {inventory.INVENTORY_MAX_SHARDS} shards.")
+    try:
+        product = inventory.set_shards(db, product_id, body.shards)
+        if product is None:
+            raise HTTPException(status_code=404, detail="Product not found.")
+        catalog.product_saved(product)
+        logger.info(f"Stock shards for product {product_id} set to {body.shards} by {current_user.username}")
+        return product
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Error setting stock shards for product {product_id}: {e}")
+        raise HTTPException(status_code=500, detail="Error setting stock shards.")
+
+
 # ==================================================
 # Delete Product (Requires Authentication)
 # ==================================================
@@ -136,10 +543,16 @@ def delete_product(
             logger.error(f"Product not found for deletion. ID: {product_id}")
             raise HTTPException(status_code=404, detail="Product not found.")
 
+        inventory.drop_shards(db, [product_id])
         db.delete(product)
+        db.flush()
+        changefeed.record_deleted(db, [product_id])
         db.commit()
+        catalog.product_deleted(product_id)
         logger.info(f"Product deleted successfully. ID: {product_id}")
         return {"message": "Product deleted successfully."}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error deleting product {product_id}: {e}")
         raise HTTPException(status_code=500, detail="Error deleting product.")
@@ -150,39 +563,65 @@ def delete_product(
 # ==================================================
 @router.get("/search/", response_model=List[schemas.ProductOut], status_code=status.HTTP_200_OK)
 def search_products(
+    request: Request,
+    response: Response,
     name: Optional[str] = Query(None, description="Partial or full product name"),
     min_price: Optional[float] = Query(None, description="Minimum price filter"),
     max_price: Optional[float] = Query(None, description="Maximum price filter"),
     min_stock: Optional[int] = Query(None, description="Minimum stock quantity"),
     max_stock: Optional[int] = Query(None, description="Maximum stock quantity"),
-    db: Session = Depends(get_db)
+    limit: int = Query(50, ge=1, le=PAGE_SIZE_MAX, description="Maximum number of results"),
+    offset: int = Query(0, ge=0, description="Number of ranked results to skip"),
+    db: Session = Depends(database.get_read_db)
 ) -> List[schemas.ProductOut]:
     """
     Search for products by name, price range, and stock quantity.
-    Supports partial matches and numeric filtering.
+    Name words match anywhere inside product name words; results are ranked by
+    relevance. The total number of matches is returned in `X-Total-Count`; when
+    the index stops early (SEARCH_MAX_MATCHES, SEARCH_MAX_SCANNED) it is a lower bound.
     """
+    etag = _index_etag(product_index, db, "search", name, min_price, max_price, min_stock, max_stock, limit, offset)
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    if etag:
+        response.headers["ETag"] = etag
     try:
-        query = db.query(models.Product)
-
-        if name:
-            query = query.filter(models.Product.product_name.ilike(f"%{name}%"))
-        if min_price is not None:
-            query = query.filter(models.Product.product_price >= min_price)
-        if max_price is not None:
-            query = query.filter(models.Product.product_price <= max_price)
-        if min_stock is not None:
-            query = query.filter(models.Product.stock_quantity >= min_stock)
-        if max_stock is not None:
-            query = query.filter(models.Product.stock_quantity <= max_stock)
-
-        products = query.all()
+        if product_index.ready:
+            total, products = product_index.search(
+                name, min_price, max_price, min_stock, max_stock, limit=limit, offset=offset
+            )
+        else:
+            total, products = _search_products_sql(
+                db, name, min_price, max_price, min_stock, max_stock, limit, offset
+            )
 
+        response.headers["X-Total-Count"] = str(total)
         if not products:
             logger.warning("No products found matching the given filters.")
-            raise HTTPException(status_code=404, detail="No products match the search criteria.")
-
-        logger.info(f"Search returned {len(products)} products.")
+        else:
+            logger.info(f"Search returned {len(products)} of {total} products.")
         return products
     except Exception as e:
         logger.exception(f"Error searching products: {e}")
         raise HTTPException(status_code=500, detail="Error searching products.")
+
+
+def _search_products_sql(db, name, min_price, max_price, min_stock, max_stock, limit, offset):
+    """Fallback used while the in-memory index is disabled or still building."""
+    query = db.query(models.Product)
+
+    if name:
+        query = query.filter(models.Product.name.ilike(f"%{name}%"))
+    if min_price is not None:
+        query = query.filter(models.Product.price >= min_price)
+    if max_price is not None:
+        query = query.filter(models.Product.price <= max_price)
+    if min_stock is not None:
+        query = query.filter(models.Product.stock_amount >= min_stock)
+    if max_stock is not None:
+        query = query.filter(models.Product.stock_amount <= max_stock)
+
+    total = query.count()
+    products = query.order_by(models.Product.product_id).offset(offset).limit(limit).all()
+    return total, products
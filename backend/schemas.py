@@ -1,5 +1,5 @@
 from datetime import datetime, date
-from typing import Optional
+from typing import Dict, List, Literal, Optional
 from pydantic import BaseModel, EmailStr, Field, field_validator
 
 
@@ -14,6 +14,58 @@ class ProductOut(ProductCreate):
     class Config:
         from_attributes = True
 
+class ProductSuggestion(BaseModel):
+    product_id: int
+    name: str
+
+class StockShardsUpdate(BaseModel):
+    shards: int = Field(..., ge=0, description="Number of stock counters; 0 keeps stock in the product row")
+
+class ProductChangeOut(BaseModel):
+    seq: int
+    product_id: int
+    op: Literal["upsert", "delete"]
+    name: Optional[str] = None
+    price: Optional[float] = None
+    stock_amount: Optional[int] = None
+    changed_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class ProductImportRow(ProductCreate):
+    product_id: Optional[int] = Field(None, gt=0, description="Set to update an existing product")
+
+
+class ProductBatchUpdate(BaseModel):
+    product_id: int
+    price: Optional[float] = None
+    stock_amount: Optional[int] = None
+    mode: Literal["set", "delta"] = Field("set", description="'set' replaces the values, 'delta' adds to them")
+
+class ProductBatchResult(BaseModel):
+    product_id: int
+    status: Literal["updated", "not_found", "invalid"]
+    detail: Optional[str] = None
+    price: Optional[float] = None
+    stock_amount: Optional[int] = None
+
+class ProductBatchReport(BaseModel):
+    updated: int
+    failed: int
+    results: List[ProductBatchResult]
+
+
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+class ImportReport(BaseModel):
+    rows_read: int = 0
+    rows_written: int = 0
+    rows_failed: int = 0
+    errors: List[ImportRowError] = []
+
 
 class CustomerBase(BaseModel):
     first_name: str
@@ -68,6 +120,81 @@ class Payment(PaymentCreate):
     class Config:
         from_attributes = True
 
+class PaymentSummaryRow(BaseModel):
+    bucket: str
+    payment_count: int
+    total_amount: float
+
+    class Config:
+        from_attributes = True
+
+class PaymentSummary(BaseModel):
+    payment_count: int
+    total_amount: float
+    by_method: List[PaymentSummaryRow]
+    by_order_status: List[PaymentSummaryRow]
+    by_month: List[PaymentSummaryRow]
+
+class PaymentImportRow(PaymentCreate):
+    payment_method: str = Field(..., min_length=1, max_length=50)
+    reference: Optional[str] = Field(
+        None, min_length=1, max_length=100,
+        description="Settlement reference; defaults to order, method, amount and time",
+    )
+
+class ReconciliationIssue(BaseModel):
+    kind: Literal["order_missing", "order_not_closed", "amount_mismatch"]
+    order_id: int
+    row: Optional[int] = Field(None, description="First file row for the order (order_missing only)")
+    order_status: Optional[str] = None
+    order_total: Optional[float] = None
+    paid_total: Optional[float] = None
+
+class PaymentImportReport(ImportReport):
+    import_id: str
+    rows_duplicate: int = Field(0, description="Rows already imported earlier, skipped")
+    orders_checked: int = 0
+    orders_matched: int = 0
+    issue_counts: Dict[str, int] = {}
+    issues: List[ReconciliationIssue] = []
+
+
+class CartItemIn(BaseModel):
+    product_id: int
+    quantity: int = Field(1, gt=0, description="Quantity must be greater than zero")
+
+class CartItemResult(BaseModel):
+    product_id: int
+    name: Optional[str] = None
+    quantity: int
+    status: Literal["added", "not_found", "insufficient_stock"]
+
+class CartBatchReport(BaseModel):
+    order_id: Optional[int] = None
+    added: int
+    failed: int
+    results: List[CartItemResult]
+
+class CheckoutResult(BaseModel):
+    order_id: int
+    status: Literal["closed", "already_closed", "expired", "not_found"]
+    total_price: Optional[float] = None
+
+class OrderLineOut(BaseModel):
+    id: int
+    product_id: int
+    quantity: int
+    unit_price: Optional[float] = None
+    product: Optional[ProductOut] = None
+
+class OrderOut(BaseModel):
+    order_id: int
+    user_id: Optional[int] = None
+    status: str
+    order_date: Optional[date] = None
+    shipping_address: Optional[str] = None
+    total_price: Optional[float] = None
+    items: Optional[List[OrderLineOut]] = None
 
 class OrderItemBase(BaseModel):
     order_id: int
@@ -0,0 +1,695 @@
+import bisect
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from itertools import chain, filterfalse, islice
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from backend import metrics, models, schemas
+from backend.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+SEARCH_INDEX_ENABLED = os.getenv("SEARCH_INDEX_ENABLED", "true").lower() == "true"
+# A query stops after this many matches; past it the reported total is a lower bound.
+SEARCH_MAX_MATCHES = int(os.getenv("SEARCH_MAX_MATCHES", "1000"))
+# A query looks at no more than this many candidates; past it the reported total is a lower bound.
+SEARCH_MAX_SCANNED = int(os.getenv("SEARCH_MAX_SCANNED", "10000"))
+# Checking a candidate's name, price or stock costs about as much as this many set lookups.
+DOCUMENT_CHECK_COST = 10
+# A posting list holding at least 1/DENSE_SCAN_RATIO of the catalog is walked in product_id order.
+DENSE_SCAN_RATIO = 8
+BUILD_BATCH_SIZE = 5000
+# Bulk upserts at least this large re-sort the range arrays instead of bisecting per row.
+BULK_RESORT_THRESHOLD = 1000
+# Prefixes matching more keys than this are ranked once and memoized.
+SUGGEST_SCAN_LIMIT = int(os.getenv("SUGGEST_SCAN_LIMIT", "2000"))
+SUGGEST_MEMO_SIZE = int(os.getenv("SUGGEST_MEMO_SIZE", "4096"))
+SUGGEST_MEMO_TTL = float(os.getenv("SUGGEST_MEMO_TTL", "300"))
+SUGGEST_MAX_RESULTS = 50
+
+_TOKEN_RE = re.compile(r"\w+")
+_EMPTY: frozenset = frozenset()
+
+# Positions inside an indexed document tuple
+_NAME, _PRICE, _STOCK, _KEY = range(4)
+
+
+class _Part(NamedTuple):
+    """One condition of a query: a word or a price/stock range."""
+
+    size: int  # products matching it (an upper bound unless `exact`)
+    ids: Callable[[], Iterator[int]]  # the matching products
+    test: Callable[[int], bool]  # whether a product matches it
+    ordered: bool  # `ids` yields in product_id order
+    exact: bool
+    sets: Tuple[Set[int], ...] = ()  # the matching products are their union; () for a range
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _trigrams(token: str) -> Set[str]:
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+# ==========================================
+# Product Search Index
+# ==========================================
+class ProductSearchIndex:
+    """
+    In-memory full-text index over Product.name, plus sorted price/stock arrays.
+
+    - `_tokens` maps each whole word to the products containing it.
+    - `_grams` maps 3-character substrings to the words containing them, so a
+      query word of 3+ characters matches anywhere inside a word ("phon" ->
+      "iPhone") after a lookup in the vocabulary rather than in the products.
+    - Shorter query words match as word prefixes through the sorted `_token_list`.
+    - `_by_price` / `_by_stock` are sorted `(value, product_id)` lists, so a range
+      filter is two bisects.
+
+    A query starts from its most selective part (the query word or range with
+    the fewest products) and checks the other parts product by product. Products
+    in which every query word is a whole word come first, then the rest; within
+    that, results are ranked by how many query words match a whole word, then
+    by product_id. A query stops after SEARCH_MAX_MATCHES matches or
+    SEARCH_MAX_SCANNED candidates, so its cost does not grow with the catalog;
+    when it stops early, results come from the matches found first and the
+    total is a lower bound.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ready = False
+        # While build() runs, the ids of products written meanwhile are
+        # collected here and re-read once the fresh index is swapped in, so
+        # none are lost.
+        self._touched: Optional[Set[int]] = None
+        self._reset()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.max_query_seconds = 0.0
+
+    def _reset(self) -> None:
+        self._docs: Dict[int, tuple] = {}
+        self._tokens: Dict[str, Set[int]] = {}
+        self._grams: Dict[str, Set[str]] = {}
+        self._token_list: List[str] = []
+        self._ids: List[int] = []
+        self._by_price: List[Tuple[float, int]] = []
+        self._by_stock: List[Tuple[int, int]] = []
+
+    # ------------------------------------------
+    # Building and maintenance
+    # ------------------------------------------
+    def build(self, session_factory: Callable[[], Session]) -> None:
+        """(Re)build the whole index from the products table and swap it in."""
+        started = time.perf_counter()
+        with self._lock:
+            self._touched = set()
+        fresh = ProductSearchIndex()
+        db = session_factory()
+        try:
+            query = select(
+                models.Product.product_id,
+                models.Product.name,
+                models.Product.price,
+                models.Product.stock_amount,
+            ).execution_options(yield_per=BUILD_BATCH_SIZE)
+            for product_id, name, price, stock_amount in db.execute(query):
+                fresh._add_terms(product_id, name, price, stock_amount)
+                fresh._ids.append(product_id)
+                fresh._by_price.append((price, product_id))
+                fresh._by_stock.append((stock_amount, product_id))
+        except Exception:
+            self._stop_recording()
+            raise
+        finally:
+            db.close()
+
+        fresh._ids.sort()
+        fresh._by_price.sort()
+        fresh._by_stock.sort()
+        fresh._token_list = sorted(fresh._tokens)
+
+        _swap_in(self, fresh, session_factory, (models.Product.name, models.Product.price, models.Product.stock_amount))
+        logger.info(f"Search index built: {len(self._docs)} products in {time.perf_counter() - started:.2f}s")
+
+    def _adopt(self, fresh: "ProductSearchIndex") -> None:
+        self._docs, self._tokens, self._grams = fresh._docs, fresh._tokens, fresh._grams
+        self._token_list, self._ids = fresh._token_list, fresh._ids
+        self._by_price, self._by_stock = fresh._by_price, fresh._by_stock
+
+    def _apply(self, rows: Dict[int, tuple], product_ids: Iterable[int]) -> None:
+        """Set `product_ids` to their current `rows` (missing = deleted); the caller holds the lock."""
+        for product_id in product_ids:
+            row = rows.get(product_id)
+            if row is None:
+                self._remove(product_id)
+            else:
+                self._upsert(*row, keep_sorted=True)
+
+    def upsert(self, product_id: int, name: str, price: float, stock_amount: int) -> None:
+        with self._lock:
+            self._record(product_id)
+            self._upsert(product_id, name, price, stock_amount, keep_sorted=True)
+
+    def upsert_many(self, rows: Iterable[Tuple[int, str, float, int]]) -> None:
+        """Upsert many (product_id, name, price, stock_amount) rows, re-sorting the arrays once if that is cheaper."""
+        rows = list(rows)
+        with self._lock:
+            self._record(*(row[0] for row in rows))
+            keep_sorted = len(rows) < BULK_RESORT_THRESHOLD
+            for row in rows:
+                self._upsert(*row, keep_sorted=keep_sorted)
+            if not keep_sorted:
+                docs = self._docs
+                self._ids = sorted(docs)
+                self._by_price = sorted((doc[_PRICE], product_id) for product_id, doc in docs.items())
+                self._by_stock = sorted((doc[_STOCK], product_id) for product_id, doc in docs.items())
+                self._token_list = sorted(self._tokens)
+
+    def _upsert(self, product_id: int, name: str, price: float, stock_amount: int, keep_sorted: bool) -> None:
+        old = self._docs.get(product_id)
+        if keep_sorted and old is not None:
+            _discard_sorted(self._by_price, (old[_PRICE], product_id))
+            _discard_sorted(self._by_stock, (old[_STOCK], product_id))
+
+        if old is not None and old[_NAME] == name:
+            # Price/stock change only: the word postings stay as they are.
+            self._docs[product_id] = (name, price, stock_amount, old[_KEY])
+        else:
+            self._remove_terms(product_id, keep_sorted)
+            self._add_terms(product_id, name, price, stock_amount)
+            if keep_sorted:
+                for token in set(tokenize(name)):
+                    if len(self._tokens[token]) == 1:
+                        bisect.insort(self._token_list, token)
+                if old is None:
+                    bisect.insort(self._ids, product_id)
+
+        if keep_sorted:
+            bisect.insort(self._by_price, (price, product_id))
+            bisect.insort(self._by_stock, (stock_amount, product_id))
+
+    def remove(self, product_id: int) -> None:
+        with self._lock:
+            self._record(product_id)
+            self._remove(product_id)
+
+    def adjust_stock(self, product_id: int, delta: int) -> None:
+        with self._lock:
+            self._record(product_id)
+            doc = self._docs.get(product_id)
+            if doc is None:
+                return
+            _discard_sorted(self._by_stock, (doc[_STOCK], product_id))
+            stock_amount = doc[_STOCK] + delta
+            self._docs[product_id] = (doc[_NAME], doc[_PRICE], stock_amount, doc[_KEY])
+            bisect.insort(self._by_stock, (stock_amount, product_id))
+
+    def _record(self, *product_ids: int) -> None:
+        if self._touched is not None:
+            self._touched.update(product_ids)
+
+    def _take_touched(self) -> Set[int]:
+        with self._lock:
+            touched, self._touched = self._touched, set()
+            return touched
+
+    def _stop_recording(self) -> None:
+        with self._lock:
+            self._touched = None
+
+    def _add_terms(self, product_id: int, name: str, price: float, stock_amount: int) -> None:
+        self._docs[product_id] = (name, price, stock_amount, name.lower())
+        for token in set(tokenize(name)):
+            postings = self._tokens.get(token)
+            if postings is None:
+                postings = self._tokens[token] = set()
+                for gram in _trigrams(token):
+                    self._grams.setdefault(gram, set()).add(token)
+            postings.add(product_id)
+
+    def _remove(self, product_id: int) -> None:
+        doc = self._docs.get(product_id)
+        if doc is None:
+            return
+        self._remove_terms(product_id, keep_sorted=True)
+        del self._docs[product_id]
+        _discard_sorted(self._ids, product_id)
+        _discard_sorted(self._by_price, (doc[_PRICE], product_id))
+        _discard_sorted(self._by_stock, (doc[_STOCK], product_id))
+
+    def _remove_terms(self, product_id: int, keep_sorted: bool) -> None:
+        doc = self._docs.get(product_id)
+        if doc is None:
+            return
+        for token in set(tokenize(doc[_NAME])):
+            _discard_posting(self._tokens, token, product_id)
+            if token in self._tokens:
+                continue
+            if keep_sorted:
+                _discard_sorted(self._token_list, token)
+            for gram in _trigrams(token):
+                _discard_posting(self._grams, gram, token)
+
+    # ------------------------------------------
+    # Querying
+    # ------------------------------------------
+    def search(
+        self,
+        name: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        min_stock: Optional[int] = None,
+        max_stock: Optional[int] = None,
+        limit: int = 50,
+        offset: int = 0,
+    ) -> Tuple[int, List[schemas.ProductOut]]:
+        """Return (total matches, one ranked page of products)."""
+        started = time.perf_counter()
+        with self._lock:
+            terms = tokenize(name) if name else []
+            wanted = offset + limit
+            if not terms and min_price is None and max_price is None and min_stock is None and max_stock is None:
+                total = len(self._ids)
+                page_ids = self._ids[offset:wanted]
+            else:
+                total, ranked = self._find(terms, min_price, max_price, min_stock, max_stock)
+                page_ids = ranked[offset:wanted]
+
+            page = [self._to_out(product_id) for product_id in page_ids]
+
+        elapsed = time.perf_counter() - started
+        self.queries += 1
+        self.query_seconds += elapsed
+        self.max_query_seconds = max(self.max_query_seconds, elapsed)
+        return total, page
+
+    def _find(self, terms, min_price, max_price, min_stock, max_stock) -> Tuple[int, List[int]]:
+        """(total, ranked ids) of up to SEARCH_MAX_MATCHES matching products."""
+        ranges = [
+            part for part in (
+                self._range_part(self._by_price, _PRICE, min_price, max_price),
+                self._range_part(self._by_stock, _STOCK, min_stock, max_stock),
+            )
+            if part is not None
+        ]
+        if not terms:
+            found, total = self._collect(ranges, SEARCH_MAX_MATCHES)
+            return total, found
+
+        # Best tier first: products in which every query word is a whole word.
+        terms = list(dict.fromkeys(terms))
+        whole = [self._tokens.get(term, _EMPTY) for term in terms]
+        top, top_total = self._collect([self._set_part(ids) for ids in whole] + ranges, SEARCH_MAX_MATCHES)
+        if len(top) >= SEARCH_MAX_MATCHES:
+            return top_total, top
+
+        # The rest match every query word, at least one of them only inside
+        # another word: for each query word, the products with one of its
+        # other matching words that match the remaining query words too.
+        matching = [self._words_matching(term) for term in terms]
+        rest, rest_total, seen = [], 0, set(top)
+        for position, term in enumerate(terms):
+            others = [word for word in matching[position] if word != term]
+            room = SEARCH_MAX_MATCHES - len(top) - len(rest)
+            if not others or room <= 0:
+                continue
+            parts = [self._word_part(term, others)] + ranges + [
+                self._word_part(other, words)
+                for other, words in zip(terms, matching)
+                if other != term
+            ]
+            found, total = self._collect(parts, room, exclude=seen)
+            rest += found
+            rest_total += total
+            seen.update(found)
+        rest.sort()
+        if len(whole) > 1:
+            hits = Counter()
+            for ids in whole:
+                hits.update(filter(ids.__contains__, rest))
+            # Stable, so ties stay in product_id order.
+            rest.sort(key=hits.__getitem__, reverse=True)
+        return top_total + rest_total, top + rest
+
+    def _collect(self, parts: List[_Part], limit: int, exclude: Set[int] = _EMPTY) -> Tuple[List[int], int]:
+        """
+        (up to `limit` ids matching every part, sorted, and the total): the ids
+        come from the smallest part and are checked against the others, at
+        most SEARCH_MAX_SCANNED of them. Checks that read the indexed documents
+        are slower, so fewer candidates get them.
+        """
+        parts = sorted(parts, key=lambda part: part.size)
+        driver = parts[0]
+        if driver.size == 0:
+            return [], 0
+
+        # A word part matching several words is checked against the union of
+        # their postings when that union is small enough to build.
+        sets, document_tests = [], []
+        expected = driver.size
+        for part in parts[1:]:
+            expected *= part.size / len(self._ids)
+            if len(part.sets) == 1 or (part.sets and part.size <= SEARCH_MAX_SCANNED):
+                sets.append(_union(part.sets))
+            else:
+                document_tests.append(part.test)
+
+        expected -= len(exclude)
+        if driver.sets and driver.size <= 2 * SEARCH_MAX_SCANNED and not document_tests and expected < 2 * limit:
+            # Few matches expected, so stopping early saves little: a set
+            # intersection, done in C, is about twice as fast as checking one
+            # id at a time.
+            matches = _union(driver.sets).intersection(*sets)
+            matches.difference_update(exclude)
+            return sorted(islice(matches, limit)), len(matches)
+
+        ids = driver.ids()
+        if exclude or len(parts) > 1:
+            ids = islice(ids, SEARCH_MAX_SCANNED)
+        if exclude:
+            ids = filterfalse(exclude.__contains__, ids)
+        for members in sets:
+            ids = filter(members.__contains__, ids)
+        if document_tests:
+            ids = islice(ids, SEARCH_MAX_SCANNED // DOCUMENT_CHECK_COST)
+            for test in document_tests:
+                ids = filter(test, ids)
+        found = list(islice(ids, limit))
+
+        total = len(found)
+        if total == limit and len(parts) == 1 and driver.exact and not exclude:
+            total = driver.size
+        if not driver.ordered:
+            found.sort()
+        return found, total
+
+    def _set_part(self, ids: Set[int]) -> _Part:
+        if len(ids) * DENSE_SCAN_RATIO >= len(self._ids):
+            # Dense: walking the ids in order finds enough matches quickly, already sorted.
+            return _Part(len(ids), lambda: filter(ids.__contains__, self._ids), ids.__contains__, True, True, (ids,))
+        return _Part(len(ids), lambda: iter(ids), ids.__contains__, False, True, (ids,))
+
+    def _word_part(self, term: str, words: List[str]) -> _Part:
+        """The products with a word that `term` matches, from that word list."""
+        if len(words) <= 1:
+            return self._set_part(self._tokens[words[0]] if words else _EMPTY)
+        postings = tuple(self._tokens[word] for word in words)
+        docs = self._docs
+        if len(term) < 3:
+            pattern = re.compile(r"\b" + re.escape(term))
+            test = lambda i: pattern.search(docs[i][_KEY]) is not None
+        else:
+            test = lambda i: term in docs[i][_KEY]
+        # A product with several matching words is in several postings; the size is an upper bound.
+        return _Part(sum(map(len, postings)), lambda: _unique(chain.from_iterable(postings)), test, False, False, postings)
+
+    def _words_matching(self, term: str) -> List[str]:
+        """Indexed words that `term` matches: by prefix below 3 characters, as a substring otherwise."""
+        if len(term) < 3:
+            start = bisect.bisect_left(self._token_list, term)
+            end = bisect.bisect_left(self._token_list, term + "\uffff", start)
+            return self._token_list[start:end]
+        grams = sorted((self._grams.get(gram, _EMPTY) for gram in _trigrams(term)), key=len)
+        return [word for word in grams[0].intersection(*grams[1:]) if term in word]
+
+    def _range_part(self, sorted_values, field: int, low, high) -> Optional[_Part]:
+        if low is None and high is None:
+            return None
+        start = 0 if low is None else bisect.bisect_left(sorted_values, (low, float("-inf")))
+        end = len(sorted_values) if high is None else bisect.bisect_right(sorted_values, (high, float("inf")))
+        low = float("-inf") if low is None else low
+        high = float("inf") if high is None else high
+        docs = self._docs
+        return _Part(
+            max(0, end - start),
+            lambda: map(itemgetter(1), map(sorted_values.__getitem__, range(start, end))),
+            lambda i: low <= docs[i][field] <= high,
+            False,
+            True,
+        )
+
+    def _to_out(self, product_id: int) -> schemas.ProductOut:
+        name, price, stock_amount, _ = self._docs[product_id]
+        return schemas.ProductOut(product_id=product_id, name=name, price=price, stock_amount=stock_amount)
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "products": len(self._docs),
+            "tokens": len(self._tokens),
+            "trigrams": len(self._grams),
+            "queries": self.queries,
+            "avg_query_ms": round(1000 * self.query_seconds / self.queries, 3) if self.queries else 0.0,
+            "max_query_ms": round(1000 * self.max_query_seconds, 3),
+        }
+
+
+# ==========================================
+# Product Name Suggester (autocomplete)
+# ==========================================
+class ProductSuggester:
+    """
+    Prefix autocomplete over Product.name using one sorted array and bisect.
+
+    Every name is stored once per word start ("apple iphone 15" also as
+    "iphone 15" and "15"), so typing the beginning of any word finds it.
+    Completions are ranked by stock, highest first. Short prefixes that match
+    many keys are ranked once and memoized; adding, renaming or removing a
+    product drops the memo entries for its prefixes, while stock changes only
+    age out with the memo TTL.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ready = False
+        self._keys: List[Tuple[str, int]] = []
+        self._docs: Dict[int, Tuple[str, int]] = {}
+        self._memo = TTLCache(SUGGEST_MEMO_SIZE, SUGGEST_MEMO_TTL)
+        # Ids of products written while build() runs, re-read into the fresh arrays.
+        self._touched: Optional[Set[int]] = None
+
+    def build(self, session_factory: Callable[[], Session]) -> None:
+        started = time.perf_counter()
+        with self._lock:
+            self._touched = set()
+        fresh = ProductSuggester()
+        keys, docs = fresh._keys, fresh._docs
+        db = session_factory()
+        try:
+            query = select(
+                models.Product.product_id,
+                models.Product.name,
+                models.Product.stock_amount,
+            ).execution_options(yield_per=BUILD_BATCH_SIZE)
+            for product_id, name, stock_amount in db.execute(query):
+                docs[product_id] = (name, stock_amount)
+                keys.extend((key, product_id) for key in _suggest_keys(name))
+        except Exception:
+            self._stop_recording()
+            raise
+        finally:
+            db.close()
+        keys.sort()
+        fresh._warm_memo()
+
+        _swap_in(self, fresh, session_factory, (models.Product.name, models.Product.stock_amount))
+        logger.info(f"Suggest index built: {len(docs)} products in {time.perf_counter() - started:.2f}s")
+
+    def _adopt(self, fresh: "ProductSuggester") -> None:
+        self._keys, self._docs, self._memo = fresh._keys, fresh._docs, fresh._memo
+
+    def _apply(self, rows: Dict[int, tuple], product_ids: Iterable[int]) -> None:
+        """Set `product_ids` to their current `rows` (missing = deleted); the caller holds the lock."""
+        for product_id in product_ids:
+            row = rows.get(product_id)
+            if row is None:
+                self._remove(product_id)
+            else:
+                self._upsert(*row)
+
+    def upsert(self, product_id: int, name: str, stock_amount: int) -> None:
+        with self._lock:
+            self._record(product_id)
+            self._upsert(product_id, name, stock_amount)
+
+    def _upsert(self, product_id: int, name: str, stock_amount: int) -> None:
+        doc = self._docs.get(product_id)
+        if doc is not None and doc[0] == name:
+            self._docs[product_id] = (name, stock_amount)
+            return
+        self._remove(product_id)
+        self._docs[product_id] = (name, stock_amount)
+        for key in _suggest_keys(name):
+            bisect.insort(self._keys, (key, product_id))
+            self._forget_prefixes(key)
+
+    def remove(self, product_id: int) -> None:
+        with self._lock:
+            self._record(product_id)
+            self._remove(product_id)
+
+    def adjust_stock(self, product_id: int, delta: int) -> None:
+        with self._lock:
+            self._record(product_id)
+            doc = self._docs.get(product_id)
+            if doc is not None:
+                self._docs[product_id] = (doc[0], doc[1] + delta)
+
+    def _record(self, *product_ids: int) -> None:
+        if self._touched is not None:
+            self._touched.update(product_ids)
+
+    def _take_touched(self) -> Set[int]:
+        with self._lock:
+            touched, self._touched = self._touched, set()
+            return touched
+
+    def _stop_recording(self) -> None:
+        with self._lock:
+            self._touched = None
+
+    def _remove(self, product_id: int) -> None:
+        doc = self._docs.pop(product_id, None)
+        if doc is not None:
+            for key in _suggest_keys(doc[0]):
+                _discard_sorted(self._keys, (key, product_id))
+                self._forget_prefixes(key)
+
+    def _forget_prefixes(self, key: str) -> None:
+        for end in range(1, len(key) + 1):
+            self._memo.pop(key[:end])
+
+    def _rank_prefix(self, prefix: str, limit: int) -> List[int]:
+        start = bisect.bisect_left(self._keys, (prefix,))
+        end = bisect.bisect_left(self._keys, (prefix + "\uffff",), start)
+        product_ids = {product_id for _, product_id in self._keys[start:end]}
+        docs = self._docs
+        if end - start <= SUGGEST_SCAN_LIMIT:
+            return heapq.nsmallest(limit, product_ids, key=lambda i: (-docs[i][1], i))
+        ranked = heapq.nsmallest(SUGGEST_MAX_RESULTS, product_ids, key=lambda i: (-docs[i][1], i))
+        self._memo.set(prefix, ranked)
+        return ranked
+
+    def _warm_memo(self) -> None:
+        """Rank the one- and two-character prefixes up front; they are the expensive ones."""
+        prefixes = sorted({key[:length] for key, _ in self._keys for length in (1, 2)})
+        for prefix in prefixes:
+            self._rank_prefix(prefix, SUGGEST_MAX_RESULTS)
+
+    def suggest(self, prefix: str, limit: int = 10) -> List[schemas.ProductSuggestion]:
+        prefix = " ".join(tokenize(prefix))
+        if not prefix:
+            return []
+
+        with self._lock:
+            ranked = self._memo.get(prefix)
+            if ranked is None:
+                ranked = self._rank_prefix(prefix, limit)
+            return [
+                schemas.ProductSuggestion(product_id=product_id, name=self._docs[product_id][0])
+                for product_id in ranked[:limit]
+                if product_id in self._docs
+            ]
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "products": len(self._docs), "keys": len(self._keys), "memo": self._memo.stats()}
+
+
+def _current_rows(session_factory: Callable[[], Session], product_ids: Set[int], columns) -> Dict[int, tuple]:
+    """{product_id: (product_id, *columns)} for the ids that still exist."""
+    db = session_factory()
+    try:
+        rows = db.execute(
+            select(models.Product.product_id, *columns).where(models.Product.product_id.in_(list(product_ids)))
+        )
+        return {row[0]: tuple(row) for row in rows}
+    finally:
+        db.close()
+
+
+def _swap_in(index, fresh, session_factory: Callable[[], Session], columns) -> None:
+    """
+    Replace `index`'s contents with the freshly built `fresh`, then re-read the
+    products written while the build ran. Full rows rather than the writes
+    themselves: the build's scan may already include a write, and deltas such
+    as adjust_stock would then count twice.
+
+    Rows are read with the lock released, so queries never wait on the
+    database; a product written again after its row was read is skipped and
+    re-read in the next round.
+    """
+    try:
+        pending = index._take_touched()
+        while pending:
+            fresh._apply(_current_rows(session_factory, pending, columns), pending)
+            pending = index._take_touched()
+        with index._lock:
+            index._adopt(fresh)
+            index.ready = True
+            pending = index._touched
+            index._touched = set() if pending else None
+        while pending:
+            rows = _current_rows(session_factory, pending, columns)
+            with index._lock:
+                index._apply(rows, pending - index._touched)
+                pending = index._touched
+                index._touched = set() if pending else None
+    except Exception:
+        index._stop_recording()
+        raise
+
+
+def _suggest_keys(name: str) -> List[str]:
+    words = tokenize(name)
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
+def _discard_posting(index: Dict[str, set], key: str, member) -> None:
+    postings = index.get(key)
+    if postings is not None:
+        postings.discard(member)
+        if not postings:
+            del index[key]
+
+
+def _union(sets: Tuple[Set[int], ...]) -> Set[int]:
+    return sets[0] if len(sets) == 1 else set().union(*sets)
+
+
+def _unique(ids: Iterable[int]) -> Iterator[int]:
+    seen = set()
+    for product_id in ids:
+        if product_id not in seen:
+            seen.add(product_id)
+            yield product_id
+
+
+def _discard_sorted(values: list, value) -> None:
+    position = bisect.bisect_left(values, value)
+    if position < len(values) and values[position] == value:
+        del values[position]
+
+
+product_index = ProductSearchIndex()
+product_suggester = ProductSuggester()
+metrics.register("search_index", product_index.stats)
+metrics.register("suggest_index", product_suggester.stats)
@@ -1,11 +1,14 @@
 from datetime import datetime, timedelta, timezone
-from passlib.context import CryptContext
 from jose import jwt, JWTError
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
-from backend import models, database
+from backend import metrics, models, database, passwords, revocation
+from backend.cache import TTLCache
 import os
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
 
 # ==========================================
@@ -17,17 +20,25 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+AUTH_USER_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", "10000"))
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "60"))
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+# Authenticate requests from the token's user_id claim alone (plus the
+# revocation filter) without reading users.
+AUTH_CLAIMS_TOKENS = os.getenv("AUTH_CLAIMS_TOKENS", "false").lower() == "true"
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 # ==========================================
 # Password Hashing
 # ==========================================
+# These run bcrypt in the calling thread; request handlers use the
+# backend.passwords pool instead.
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return passwords.hash_password(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return passwords.pwd_context.verify(plain_password, hashed_password)
 
 # ==========================================
 # Token Creation
@@ -35,9 +46,18 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    # jti makes every token unique, so logging out revokes only this one.
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+def access_token_claims(user: models.User) -> dict:
+    """
+    Claims for a user's access token. user_id pins the token to this account,
+    so it stops working when the user is deleted even if the username is
+    registered again before it expires.
+    """
+    return {"sub": user.username, "user_id": user.id}
+
 # ==========================================
 # Database Session
 # ==========================================
@@ -48,29 +68,125 @@ def get_db():
     finally:
         db.close()
 
+# ==========================================
+# Authentication caches (per worker process)
+# ==========================================
+# token -> verified claims, kept no longer than the token's own expiry, so a
+# repeat token skips the signature check.
+token_cache = TTLCache(AUTH_TOKEN_CACHE_SIZE, ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+# username -> User detached from its session, so repeat requests skip the
+# users query. Handlers must treat it as read-only.
+user_cache = TTLCache(AUTH_USER_CACHE_SIZE, AUTH_USER_CACHE_TTL)
+
+# Bumped by invalidate_user. A lookup only fills the cache if it has not moved
+# since the lookup started, so a read racing with a delete cannot put the old
+# row back. Other workers see changes after at most AUTH_USER_CACHE_TTL.
+_user_version = 0
+_user_lock = threading.Lock()
+
+
+def invalidate_user(username: str) -> None:
+    """Forget a cached user; call after committing a change to or deletion of their row."""
+    global _user_version
+    with _user_lock:
+        _user_version += 1
+        user_cache.pop(username)
+
+
+def decode_token(token: str) -> dict:
+    """Verified claims of `token` (cached); raises JWTError if it is invalid or expired."""
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    if payload.get("sub") is None:
+        raise JWTError("Token has no subject")
+    remaining = payload["exp"] - time.time() if "exp" in payload else token_cache.ttl
+    if remaining > 0:
+        token_cache.set(token, payload, ttl=min(remaining, token_cache.ttl))
+    return payload
+
+
+class TokenUser:
+    """The current user as described by a claims token: the fields handlers use, no database row."""
+    __slots__ = ("id", "username")
+
+    def __init__(self, id: int, username: str):
+        self.id = id
+        self.username = username
+
+
+def _metrics() -> dict:
+    return {"tokens": token_cache.stats(), "users": user_cache.stats()}
+
+
+metrics.register("auth_cache", _metrics)
+
 # ==========================================
 # Verify Current User (JWT Validation)
 # ==========================================
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    """
-    Decode JWT token, verify it, and return the user from DB.
-    If token is invalid or expired → raise 401 Unauthorized.
-    """
-    credentials_exception = HTTPException(
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
 
+
+def _user_from_token(token: str):
+    """
+    (user, username, user_id) without touching the database; user is None when
+    the users row is needed. user_id is None for tokens issued without one.
+    """
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
+        payload = decode_token(token)
     except JWTError:
-        raise credentials_exception
+        raise _credentials_exception()
+    if revocation.token_key(token) in revocation.revoked:
+        raise _credentials_exception()
 
+    username, user_id = payload["sub"], payload.get("user_id")
+    if AUTH_CLAIMS_TOKENS and user_id is not None:
+        return TokenUser(user_id, username), username, user_id
+    return user_cache.get(username), username, user_id
+
+
+def _load_user(db: Session, username: str):
+    version = _user_version
     user = db.query(models.User).filter(models.User.username == username).first()
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
+    db.expunge(user)
+    with _user_lock:
+        if version == _user_version:
+            user_cache.set(username, user)
+    return user
+
+
+def _not_revoked(user, user_id):
+    if user_id is not None and user.id != user_id:
+        # The account the token was issued to is gone; this is a new one with the same username.
+        raise _credentials_exception()
+    if revocation.user_key(user.id) in revocation.revoked:
+        raise _credentials_exception()
     return user
+
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    """
+    Decode JWT token, verify it, and return the user (cached, read-only).
+    Claims tokens (AUTH_CLAIMS_TOKENS) give a TokenUser without a database query.
+    If token is invalid, expired or revoked → raise 401 Unauthorized.
+    """
+    user, username, user_id = _user_from_token(token)
+    if user is None:
+        user = _load_user(db, username)
+    return _not_revoked(user, user_id)
+
+
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db=Depends(database.get_request_db)):
+    """get_current_user for async endpoints: a cache miss reads users through database.run_db."""
+    user, username, user_id = _user_from_token(token)
+    if user is None:
+        user = await database.run_db(db, _load_user, username)
+    return _not_revoked(user, user_id)
@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import Session
+
+from backend import catalog, changefeed, database, inventory, metrics, models, rollups
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# Configuration
+# ==========================================
+load_dotenv()
+
+# order_date has day resolution, so the age is given in days.
+TEMP_ORDER_EXPIRE_DAYS = int(os.getenv("TEMP_ORDER_EXPIRE_DAYS", "2"))
+TEMP_ORDER_SWEEP_INTERVAL = float(os.getenv("TEMP_ORDER_SWEEP_INTERVAL", "300"))
+TEMP_ORDER_SWEEP_BATCH = int(os.getenv("TEMP_ORDER_SWEEP_BATCH", "500"))
+# "archive" marks expired carts EXPIRED, "delete" removes them and their lines.
+TEMP_ORDER_SWEEP_MODE = os.getenv("TEMP_ORDER_SWEEP_MODE", "archive").lower()
+
+_stats = {
+    "sweeps": 0,
+    "carts_reclaimed": 0,
+    "lines_reclaimed": 0,
+    "units_restored": 0,
+    "last_sweep_carts": 0,
+    "last_sweep_ms": 0.0,
+}
+_stats_lock = threading.Lock()
+
+
+# ==========================================
+# Sweeping
+# ==========================================
+def _sweep_batch(db: Session, cutoff) -> int:
+    """
+    Expire one batch of idle carts in one transaction; returns how many carts were reclaimed.
+
+    Locks are taken in the order add_to_cart and checkout use: the products
+    first (in product_id order), then the carts. The batch is found without
+    locks; carts that changed meanwhile are left for a later sweep.
+    """
+    idle = (models.Order.status == models.OrderStatus.TEMP, models.Order.order_date < cutoff)
+    candidates = db.scalars(
+        select(models.Order.order_id)
+        .where(*idle)
+        .order_by(models.Order.status, models.Order.order_date)
+        .limit(TEMP_ORDER_SWEEP_BATCH)
+    ).all()
+    if not candidates:
+        return 0
+
+    held_products = select(models.OrderItem.product_id).where(models.OrderItem.order_id.in_(candidates)).distinct()
+    locked_products = db.scalars(
+        select(models.Product.product_id)
+        .where(models.Product.product_id.in_(held_products))
+        .order_by(models.Product.product_id)
+        .with_for_update()
+    ).all()
+    order_ids = db.scalars(
+        select(models.Order.order_id)
+        .where(models.Order.order_id.in_(candidates), *idle)
+        .order_by(models.Order.order_id)
+        .with_for_update(skip_locked=True)
+    ).all()
+    # A line added after the product locks were taken would also have moved
+    # order_date; skip any such cart rather than lock its product out of order.
+    changed = set(db.scalars(
+        select(models.OrderItem.order_id)
+        .where(models.OrderItem.order_id.in_(order_ids), models.OrderItem.product_id.not_in(locked_products))
+    ))
+    order_ids = [order_id for order_id in order_ids if order_id not in changed]
+    if not order_ids:
+        db.rollback()
+        return 0
+
+    held = db.execute(
+        select(
+            models.OrderItem.product_id,
+            func.sum(models.OrderItem.quantity).label("quantity"),
+            func.count().label("lines"),
+            models.Product.stock_shards,
+        )
+        .join(models.Product, models.Product.product_id == models.OrderItem.product_id)
+        .where(models.OrderItem.order_id.in_(order_ids))
+        .group_by(models.OrderItem.product_id, models.Product.stock_shards)
+    ).all()
+
+    # Products with a single stock counter get their units back in one
+    # set-based UPDATE; sharded products return them to a shard each.
+    held_by_carts = (
+        select(func.sum(models.OrderItem.quantity))
+        .where(models.OrderItem.product_id == models.Product.product_id, models.OrderItem.order_id.in_(order_ids))
+        .scalar_subquery()
+    )
+    unsharded = [row.product_id for row in held if not row.stock_shards]
+    if unsharded:
+        db.execute(
+            update(models.Product)
+            .where(models.Product.product_id.in_(unsharded))
+            .values(stock_amount=models.Product.stock_amount + held_by_carts)
+            .execution_options(synchronize_session=False)
+        )
+    for row in held:
+        if row.stock_shards:
+            inventory.release_stock(db, row.product_id, int(row.quantity))
+
+    if TEMP_ORDER_SWEEP_MODE == "delete":
+        rollups.orders_status_changed(db, order_ids, models.OrderStatus.TEMP.value, None)
+        db.execute(delete(models.OrderItem).where(models.OrderItem.order_id.in_(order_ids)))
+        db.execute(delete(models.Order).where(models.Order.order_id.in_(order_ids)))
+    else:
+        rollups.orders_status_changed(db, order_ids, models.OrderStatus.TEMP.value, models.OrderStatus.EXPIRED.value)
+        db.execute(
+            update(models.Order)
+            .where(models.Order.order_id.in_(order_ids))
+            .values(status=models.OrderStatus.EXPIRED)
+            .execution_options(synchronize_session=False)
+        )
+    changefeed.record(db, unsharded)
+    db.commit()
+
+    restored: Dict[int, int] = {row.product_id: int(row.quantity) for row in held}
+    if restored:
+        catalog.stock_adjusted(restored)
+    with _stats_lock:
+        _stats["carts_reclaimed"] += len(order_ids)
+        _stats["lines_reclaimed"] += sum(row.lines for row in held)
+        _stats["units_restored"] += sum(restored.values())
+    return len(order_ids)
+
+
+def sweep(db: Session) -> int:
+    """
+    Release the stock held by TEMP orders idle for TEMP_ORDER_EXPIRE_DAYS and
+    archive or delete them, TEMP_ORDER_SWEEP_BATCH carts per transaction.
+    Returns the number of carts reclaimed.
+    """
+    started = time.perf_counter()
+    cutoff = (datetime.utcnow() - timedelta(days=TEMP_ORDER_EXPIRE_DAYS)).date()
+    reclaimed = 0
+    try:
+        while True:
+            count = _sweep_batch(db, cutoff)
+            reclaimed += count
+            if count < TEMP_ORDER_SWEEP_BATCH:
+                break
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        with _stats_lock:
+            _stats["sweeps"] += 1
+            _stats["last_sweep_carts"] = reclaimed
+            _stats["last_sweep_ms"] = round(1000 * (time.perf_counter() - started), 3)
+    if reclaimed:
+        logger.info(f"Cart sweeper reclaimed {reclaimed} idle TEMP orders ({TEMP_ORDER_SWEEP_MODE}).")
+    return reclaimed
+
+
+def sweep_task() -> None:
+    db = database.SessionLocal()
+    try:
+        sweep(db)
+    finally:
+        db.close()
+
+
+def _metrics() -> dict:
+    with _stats_lock:
+        return {"mode": TEMP_ORDER_SWEEP_MODE, "expire_days": TEMP_ORDER_EXPIRE_DAYS, **_stats}
+
+
+metrics.register("cart_sweeper", _metrics)
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from typing import Callable, List
+
+from backend import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """
+    Runs `func` every `interval` seconds on a daemon thread until stopped.
+
+    Exceptions are logged and counted; the task keeps its schedule.
+    """
+
+    def __init__(self, name: str, interval: float, func: Callable[[], None]):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.runs = 0
+        self.failures = 0
+        self.last_duration_ms = 0.0
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            logger.info(f"Started periodic task '{self.name}' every {self.interval}s")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+            self._thread = None
+
+    def run_once(self) -> None:
+        started = time.perf_counter()
+        try:
+            self.func()
+        except Exception as e:
+            self.failures += 1
+            logger.exception(f"Periodic task '{self.name}' failed: {e}")
+        finally:
+            self.runs += 1
+            self.last_duration_ms = round(1000 * (time.perf_counter() - started), 3)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def stats(self) -> dict:
+        return {
+            "interval_seconds": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_duration_ms": self.last_duration_ms,
+        }
+
+
+_tasks: List[PeriodicTask] = []
+
+
+def schedule(name: str, interval: float, func: Callable[[], None]) -> PeriodicTask:
+    """Register and start a periodic task; it is stopped by stop_all() on shutdown."""
+    task = PeriodicTask(name, interval, func)
+    _tasks.append(task)
+    metrics.register(f"task:{name}", task.stats)
+    task.start()
+    return task
+
+
+def stop_all() -> None:
+    for task in _tasks:
+        task.stop()
+    _tasks.clear()
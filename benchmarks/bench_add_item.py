@@ -0,0 +1,133 @@
+"""
+Concurrency benchmark for cart adds (backend.inventory.add_to_cart).
+
+Many threads add one unit of the same product to their users' carts until the
+stock runs out, then the script checks that nothing was oversold: final stock
+is never negative, and the stock taken equals the quantity in order_items.
+
+Usage (uses DATABASE_URL, so point it at a scratch database):
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.bench_add_item --threads 16 --stock 2000
+
+Pass --shards N to run against a product with sharded stock counters.
+"""
+import argparse
+import threading
+import time
+import uuid
+
+from sqlalchemy import delete, func, select
+
+from backend import database, inventory, models
+
+
+def setup(stock: int, users: int, shards: int):
+    database.create_tables()
+    db = database.SessionLocal()
+    try:
+        product = models.Product(name=f"bench-{uuid.uuid4().hex[:8]}", price=1.0, stock_amount=stock)
+        db.add(product)
+        user_ids = []
+        for _ in range(users):
+            tag = uuid.uuid4().hex[:12]
+            user = models.User(
+                first_name="Bench", last_name="User", email=f"{tag}@bench.invalid",
+                username=f"bench-{tag}", password_hash="x",
+            )
+            db.add(user)
+            db.flush()
+            user_ids.append(user.id)
+        db.commit()
+        if shards:
+            inventory.set_shards(db, product.product_id, shards)
+        return product.product_id, user_ids
+    finally:
+        db.close()
+
+
+def worker(product_id: int, user_id: int, counts: dict, lock: threading.Lock, deadline: float):
+    db = database.SessionLocal()
+    added = rejected = errors = 0
+    try:
+        while time.perf_counter() < deadline:
+            try:
+                inventory.add_to_cart(db, user_id, product_id, 1)
+                added += 1
+            except inventory.InsufficientStock:
+                rejected += 1
+                break
+            except Exception:
+                errors += 1
+    finally:
+        db.close()
+    with lock:
+        counts["added"] += added
+        counts["rejected"] += rejected
+        counts["errors"] += errors
+
+
+def verify(product_id: int, stock: int, added: int) -> bool:
+    db = database.SessionLocal()
+    try:
+        final = db.execute(select(models.Product.stock_amount).where(models.Product.product_id == product_id)).scalar_one()
+        if db.execute(select(models.Product.stock_shards).where(models.Product.product_id == product_id)).scalar_one():
+            final = inventory.shard_totals(db, [product_id]).get(product_id, 0)
+        in_carts = db.execute(
+            select(func.coalesce(func.sum(models.OrderItem.quantity), 0)).where(models.OrderItem.product_id == product_id)
+        ).scalar_one()
+        print(f"final stock={final}  taken={stock - final}  in carts={in_carts}  successful adds={added}")
+        return final >= 0 and stock - final == in_carts == added
+    finally:
+        db.close()
+
+
+def cleanup(product_id: int, user_ids):
+    db = database.SessionLocal()
+    try:
+        order_ids = select(models.Order.order_id).where(models.Order.user_id.in_(user_ids))
+        db.execute(delete(models.OrderItem).where(models.OrderItem.order_id.in_(order_ids)))
+        db.execute(delete(models.Order).where(models.Order.user_id.in_(user_ids)))
+        db.execute(delete(models.ProductChange).where(models.ProductChange.product_id == product_id))
+        inventory.drop_shards(db, [product_id])
+        db.execute(delete(models.Product).where(models.Product.product_id == product_id))
+        db.execute(delete(models.User).where(models.User.id.in_(user_ids)))
+        db.commit()
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--users", type=int, default=4, help="Threads share these users, so carts are contended too")
+    parser.add_argument("--stock", type=int, default=2000)
+    parser.add_argument("--shards", type=int, default=0, help="Split the product's stock across N counters")
+    parser.add_argument("--seconds", type=float, default=60.0, help="Upper bound on run time")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark rows")
+    args = parser.parse_args()
+
+    product_id, user_ids = setup(args.stock, args.users, args.shards)
+    counts = {"added": 0, "rejected": 0, "errors": 0}
+    lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + args.seconds
+    threads = [
+        threading.Thread(target=worker, args=(product_id, user_ids[i % len(user_ids)], counts, lock, deadline))
+        for i in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.threads} threads, {args.shards or 1} stock counter(s), {counts['added']} adds in {elapsed:.2f}s = {counts['added'] / elapsed:.0f} adds/sec "
+          f"({counts['rejected']} out-of-stock, {counts['errors']} errors)")
+    ok = verify(product_id, args.stock, counts["added"])
+    print("no oversell: OK" if ok else "no oversell: FAILED")
+    if not args.keep:
+        cleanup(product_id, user_ids)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
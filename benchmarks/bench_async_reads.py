@@ -0,0 +1,156 @@
+"""
+Read throughput benchmark: requests/sec and latency with many concurrent clients.
+
+Starts the API with uvicorn twice (uses DATABASE_URL, so point it at a
+scratch database), once with ASYNC_DB=false and once with ASYNC_DB=true, and
+runs --clients concurrent keep-alive connections against each for --seconds.
+Every client cycles through GET /payments/, GET /orders/ and GET
+/products/{id} as one user. With the sync path the clients queue for the
+threadpool's 40 threads; with the asyncio driver they only queue for the
+ASYNC_DB_POOL_SIZE + ASYNC_DB_MAX_OVERFLOW connections.
+
+Usage:
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.bench_async_reads --clients 500
+
+Pass --url to measure a server that is already running instead (one run,
+whatever ASYNC_DB it was started with).
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+from backend import database, models
+from benchmarks.bench_login import PASSWORD, create_users, percentile, wait_until_up
+
+
+def seed(username: str, orders: int, payments_per_order: int) -> None:
+    """Give the benchmark user some closed orders with payments to read."""
+    db = database.SessionLocal()
+    try:
+        user = db.query(models.User).filter(models.User.username == username).one()
+        if not db.query(models.Product).first():
+            db.add(models.Product(name="Bench product", price=9.99, stock_amount=100))
+        started = datetime.utcnow() - timedelta(days=30)
+        for i in range(orders):
+            order = models.Order(user_id=user.id, status=models.OrderStatus.CLOSE, total_price=9.99)
+            db.add(order)
+            db.flush()
+            for j in range(payments_per_order):
+                db.add(models.Payment(
+                    order_id=order.order_id, payment_method="card", amount=9.99 / payments_per_order,
+                    paid_at=started + timedelta(minutes=i * payments_per_order + j),
+                ))
+        db.commit()
+    finally:
+        db.close()
+
+
+def product_id() -> int:
+    db = database.SessionLocal()
+    try:
+        return db.query(models.Product.product_id).order_by(models.Product.product_id).first()[0]
+    finally:
+        db.close()
+
+
+async def client(host: str, port: int, paths: list, token: str, deadline: float, latencies: list, errors: list):
+    """One keep-alive HTTP/1.1 connection issuing requests back to back until the deadline."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        i = 0
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            started = time.perf_counter()
+            writer.write(
+                f"GET {path} HTTP/1.1\r\nHost: {host}\r\nAuthorization: Bearer {token}\r\n\r\n".encode()
+            )
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors.append(status)
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        errors.append(type(e).__name__)
+    finally:
+        writer.close()
+
+
+async def run_load(base: str, token: str, paths: list, clients: int, seconds: float) -> dict:
+    url = urllib.parse.urlsplit(base)
+    latencies: list = []
+    errors: list = []
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(
+        client(url.hostname, url.port or 80, paths, token, deadline, latencies, errors) for _ in range(clients)
+    ))
+    return {
+        "clients": clients,
+        "requests_per_sec": round(len(latencies) / seconds, 1),
+        "errors": len(errors),
+        "p50_ms": round(percentile(latencies, 0.50), 1),
+        "p99_ms": round(percentile(latencies, 0.99), 1),
+    }
+
+
+def measure(base: str, username: str, paths: list, args) -> dict:
+    body = urllib.parse.urlencode({"username": username, "password": PASSWORD}).encode()
+    with urllib.request.urlopen(urllib.request.Request(f"{base}/auth/login", data=body)) as response:
+        token = json.load(response)["access_token"]
+    # Warm the connection pools and caches before measuring.
+    asyncio.run(run_load(base, token, paths, min(args.clients, 20), 1))
+    return asyncio.run(run_load(base, token, paths, args.clients, args.seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark read endpoints with and without ASYNC_DB.")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--orders", type=int, default=50)
+    parser.add_argument("--payments-per-order", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--url", help="Use a running API instead of starting one")
+    args = parser.parse_args()
+
+    username = create_users(1)[0]
+    seed(username, args.orders, args.payments_per_order)
+    paths = ["/payments/?limit=20", "/orders/?limit=20", f"/products/{product_id()}"]
+
+    if args.url:
+        print(f"{args.url}: " + "  ".join(f"{key}={value}" for key, value in measure(args.url, username, paths, args).items()))
+        return
+
+    base = f"http://127.0.0.1:{args.port}"
+    for async_db in ("false", "true"):
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(args.port),
+             "--log-level", "warning", "--backlog", str(max(2048, args.clients))],
+            env={**os.environ, "ASYNC_DB": async_db},
+        )
+        try:
+            wait_until_up(base, server)
+            result = measure(base, username, paths, args)
+            print(f"ASYNC_DB={async_db:>5}: " + "  ".join(f"{key}={value}" for key, value in result.items()))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Login load benchmark: logins/sec and the latency other endpoints see meanwhile.
+
+Starts the API with uvicorn (uses DATABASE_URL, so point it at a scratch
+database), creates a few users, then runs two phases of --seconds each:
+  1. only the "other" clients, which GET /products/ (a sync endpoint on the
+     shared threadpool), for a baseline p50/p99;
+  2. the same clients while --login-threads clients log in continuously.
+A healthy setup keeps the phase 2 p99 close to the baseline; with bcrypt on
+the request threads it grows with the login load.
+
+Usage:
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.bench_login --login-threads 32
+
+Pass --url to run against a server that is already running instead.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from backend import database, models, passwords
+
+PASSWORD = "bench-password"
+
+
+def create_users(count: int):
+    database.create_tables()
+    db = database.SessionLocal()
+    try:
+        password_hash = passwords.hash_password(PASSWORD)
+        usernames = []
+        for _ in range(count):
+            tag = uuid.uuid4().hex[:12]
+            db.add(models.User(
+                first_name="Bench", last_name="User", email=f"{tag}@bench.invalid",
+                username=f"bench-{tag}", password_hash=password_hash,
+            ))
+            usernames.append(f"bench-{tag}")
+        db.commit()
+        return usernames
+    finally:
+        db.close()
+
+
+def request(url: str, data: bytes = None, headers: dict = None) -> int:
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers or {}), timeout=60) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def login(base: str, username: str) -> int:
+    body = urllib.parse.urlencode({"username": username, "password": PASSWORD}).encode()
+    return request(f"{base}/auth/login", body, {"Content-Type": "application/x-www-form-urlencoded"})
+
+
+def login_worker(base: str, username: str, stop: threading.Event, counts: dict, lock: threading.Lock):
+    ok = busy = failed = 0
+    while not stop.is_set():
+        code = login(base, username)
+        if code == 200:
+            ok += 1
+        elif code == 503:
+            busy += 1
+        else:
+            failed += 1
+    with lock:
+        counts["ok"] += ok
+        counts["busy"] += busy
+        counts["failed"] += failed
+
+
+def other_worker(base: str, token: str, stop: threading.Event, latencies: list, lock: threading.Lock):
+    headers = {"Authorization": f"Bearer {token}"}
+    mine = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        request(f"{base}/products/?limit=20", headers=headers)
+        mine.append(time.perf_counter() - started)
+    with lock:
+        latencies.extend(mine)
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return 1000 * values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def run_phase(base: str, token: str, usernames: list, login_threads: int, other_threads: int, seconds: float) -> dict:
+    stop = threading.Event()
+    lock = threading.Lock()
+    counts = {"ok": 0, "busy": 0, "failed": 0}
+    latencies: list = []
+    threads = [threading.Thread(target=other_worker, args=(base, token, stop, latencies, lock)) for _ in range(other_threads)]
+    threads += [
+        threading.Thread(target=login_worker, args=(base, usernames[i % len(usernames)], stop, counts, lock))
+        for i in range(login_threads)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {
+        "login_threads": login_threads,
+        "logins_per_sec": round(counts["ok"] / seconds, 1),
+        "logins_rejected_503": counts["busy"],
+        "logins_failed": counts["failed"],
+        "other_requests": len(latencies),
+        "other_p50_ms": round(percentile(latencies, 0.50), 1),
+        "other_p99_ms": round(percentile(latencies, 0.99), 1),
+    }
+
+
+def wait_until_up(base: str, server, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"API server exited with code {server.returncode}")
+        try:
+            if request(f"{base}/healthz") == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"API at {base} did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark logins/sec against latency of other routes.")
+    parser.add_argument("--login-threads", type=int, default=16)
+    parser.add_argument("--other-threads", type=int, default=4)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="Use a running API instead of starting one")
+    args = parser.parse_args()
+
+    usernames = create_users(args.users)
+    server = None
+    base = args.url
+    if base is None:
+        base = f"http://127.0.0.1:{args.port}"
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(args.port), "--log-level", "warning"],
+            env=os.environ.copy(),
+        )
+    try:
+        wait_until_up(base, server)
+        body = urllib.parse.urlencode({"username": usernames[0], "password": PASSWORD}).encode()
+        with urllib.request.urlopen(urllib.request.Request(f"{base}/auth/login", data=body)) as response:
+            token = json.load(response)["access_token"]
+        baseline = run_phase(base, token, usernames, 0, args.other_threads, args.seconds)
+        loaded = run_phase(base, token, usernames, args.login_threads, args.other_threads, args.seconds)
+        for name, result in (("baseline", baseline), ("under login load", loaded)):
+            print(f"{name:>17}: " + "  ".join(f"{key}={value}" for key, value in result.items()))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Search index latency benchmark: p50/p99 of ProductSearchIndex.search per query kind.
+
+Fills an in-memory index with --products synthetic products (no database)
+whose names draw 2-5 words from a Zipf-distributed vocabulary, so a few words
+appear in a large share of the catalog, like "black" or "usb" do in a real
+one. Then runs --queries queries of each kind and prints p50/p99 in
+milliseconds. Exits non-zero if any p99 is above --target-ms.
+
+Usage:
+    python -m benchmarks.bench_search --products 1000000
+"""
+import argparse
+import random
+import sys
+import time
+from itertools import accumulate
+
+from backend.search import ProductSearchIndex
+from benchmarks.bench_login import percentile
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def fill(index: ProductSearchIndex, products: int, vocab, rng: random.Random) -> None:
+    cum_weights = list(accumulate(1 / rank for rank in range(1, len(vocab) + 1)))
+    index.upsert_many(
+        (
+            product_id,
+            " ".join(rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(2, 5))),
+            round(rng.uniform(1, 1000), 2),
+            rng.randint(0, 500),
+        )
+        for product_id in range(1, products + 1)
+    )
+    index.ready = True
+
+
+def query_kinds(vocab, rng: random.Random) -> dict:
+    common = vocab[:20]
+    return {
+        "common word": lambda: {"name": rng.choice(common)},
+        "common prefix (3 chars)": lambda: {"name": rng.choice(common)[:3]},
+        "two common words": lambda: {"name": " ".join(rng.sample(common, 2))},
+        "random word": lambda: {"name": rng.choice(vocab)},
+        "random substring": lambda: {"name": rng.choice(vocab)[1:]},
+        "2-char prefix": lambda: {"name": rng.choice(vocab)[:2]},
+        "common word + price": lambda: {"name": rng.choice(common), "min_price": 100, "max_price": 900},
+        "price only": lambda: {"min_price": 100, "max_price": 900},
+        "price + stock": lambda: {"min_price": 100, "max_price": 900, "min_stock": 10},
+        "random word + stock": lambda: {"name": rng.choice(vocab), "max_stock": 250},
+        "common word, offset 500": lambda: {"name": rng.choice(common), "offset": 500},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=1_000_000)
+    parser.add_argument("--vocabulary", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=300, help="queries per kind")
+    parser.add_argument("--limit", type=int, default=50, help="page size")
+    parser.add_argument("--target-ms", type=float, default=5.0, help="p99 every query kind must stay under")
+    parser.add_argument("--seed", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocab = [
+        "".join(rng.choice(LETTERS) for _ in range(rng.randint(3, 10)))
+        for _ in range(args.vocabulary)
+    ]
+    index = ProductSearchIndex()
+    started = time.perf_counter()
+    fill(index, args.products, vocab, rng)
+    stats = index.stats()
+    print(f"Indexed {stats['products']} products, {stats['tokens']} words in {time.perf_counter() - started:.1f}s")
+
+    failed = False
+    for label, make_query in query_kinds(vocab, rng).items():
+        latencies = []
+        for _ in range(args.queries):
+            query = make_query()
+            query_started = time.perf_counter()
+            index.search(limit=args.limit, **query)
+            latencies.append(time.perf_counter() - query_started)
+        p99 = percentile(latencies, 0.99)
+        failed |= p99 > args.target_ms
+        print(f"{label:28} p50 {percentile(latencies, 0.5):7.2f} ms   p99 {p99:7.2f} ms")
+
+    if failed:
+        print(f"p99 above the {args.target_ms} ms target")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
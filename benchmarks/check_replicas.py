@@ -0,0 +1,135 @@
+"""
+Local check of read-replica routing with two SQLite files.
+
+SQLite has no replication, so this script plays the replica's part itself
+by copying the primary file over the replica file (sqlite3 backup API)
+whenever the replica should be caught up. It then checks that
+  1. public reads are served by the replica (a row written only to the
+     primary is not found),
+  2. a client that just wrote reads from the primary until
+     REPLICA_READ_AFTER_WRITE has passed,
+  3. a replica more than REPLICA_MAX_LAG behind is skipped,
+  4. a replica that cannot be reached is skipped,
+  5. a replica read shortly after a product write carries no ETag.
+
+Usage:
+    python -m benchmarks.check_replicas
+
+To try it against MySQL instead, point DATABASE_URL at the primary and
+DATABASE_REPLICA_URLS at a real replica and start the API as usual; the
+replica_heartbeat row and /metrics show what the router sees.
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+workdir = tempfile.mkdtemp(prefix="buysmart-replicas-")
+PRIMARY = os.path.join(workdir, "primary.db")
+REPLICA = os.path.join(workdir, "replica.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{PRIMARY}"
+os.environ["DATABASE_REPLICA_URLS"] = f"sqlite:///{REPLICA}"
+os.environ["REPLICA_MAX_LAG"] = "1"
+os.environ["REPLICA_READ_AFTER_WRITE"] = "1"
+os.environ["REPLICA_CHECK_INTERVAL"] = "1"
+os.environ["ASYNC_DB"] = "false"
+os.environ.setdefault("SECRET_KEY", "check-replicas")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from backend import database, metrics, models  # noqa: E402
+from backend.routers import products  # noqa: E402
+from backend.security import get_current_user  # noqa: E402
+
+
+class CheckUser:
+    id = 1
+    username = "replica-check"
+
+
+def replicate() -> None:
+    """Bring the replica up to date with the primary."""
+    source, target = sqlite3.connect(PRIMARY), sqlite3.connect(REPLICA)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def add_product(name: str) -> int:
+    db = database.SessionLocal()
+    try:
+        product = models.Product(name=name, price=1.0, stock_amount=1)
+        db.add(product)
+        db.commit()
+        return product.product_id
+    finally:
+        db.close()
+
+
+def expect(label: str, actual, wanted) -> bool:
+    ok = actual == wanted
+    print(f"{'ok  ' if ok else 'FAIL'} {label}: got {actual}, expected {wanted}")
+    return ok
+
+
+def main() -> int:
+    database.create_tables()
+    app = FastAPI()
+    app.middleware("http")(database.track_writes)
+    app.include_router(products.router)
+    app.dependency_overrides[get_current_user] = lambda: CheckUser()
+    client = TestClient(app)
+    replica = database.replicas.replicas[0]
+
+    # Copy, check, copy, check: the first check writes the heartbeat the second one finds.
+    replicate()
+    database.replicas.check()
+    replicate()
+    database.replicas.check()
+    results = [expect("replica lag after replication", replica.lag, 0.0)]
+
+    missing_id = add_product("Written to the primary only")
+    results.append(expect("read served by the replica", client.get(f"/products/{missing_id}").status_code, 404))
+
+    created = client.post("/products/", json={"name": "Read your writes", "price": 2.0, "stock_amount": 1})
+    results.append(expect("write", created.status_code, 201))
+    created_id = created.json()["product_id"]
+    results.append(expect("read after write goes to the primary", client.get(f"/products/{created_id}").status_code, 200))
+    time.sleep(database.REPLICA_READ_AFTER_WRITE + 0.2)
+    results.append(expect("replica again once the window passed", client.get(f"/products/{missing_id}").status_code, 404))
+    results.append(expect("no ETag on a replica read right after a write", "etag" in client.get("/products/").headers, False))
+
+    time.sleep(database.REPLICA_MAX_LAG + 0.2)
+    database.replicas.check()
+    results.append(expect("lagging replica is not usable", replica.usable(time.monotonic()), False))
+    results.append(expect("read falls back to the primary", client.get(f"/products/{missing_id}").status_code, 200))
+
+    replicate()
+    database.replicas.check()
+    database.replicas.check()
+    results.append(expect("caught-up replica is usable again", replica.usable(time.monotonic()), True))
+    results.append(expect("ETag again once the stale window passed", "etag" in client.get("/products/").headers, True))
+
+    # Make the replica unreachable: its file becomes a directory SQLite cannot open.
+    replica.engine.dispose()
+    os.remove(REPLICA)
+    os.mkdir(REPLICA)
+    not_replicated_id = add_product("Also only on the primary")
+    results.append(expect("unreachable replica falls back", client.get(f"/products/{not_replicated_id}").status_code, 200))
+    results.append(expect("replica marked down", replica.usable(time.monotonic()), False))
+
+    print(metrics.snapshot()["read_replicas"])
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    try:
+        code = main()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(code)
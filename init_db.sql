@@ -16,7 +16,32 @@ CREATE TABLE IF NOT EXISTS products (
   product_id INT AUTO_INCREMENT PRIMARY KEY,
   name VARCHAR(255) NOT NULL,
   price DECIMAL(10,2) NOT NULL,
-  stock_amount INT NOT NULL
+  stock_amount INT NOT NULL,
+  stock_shards INT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS product_stock_shards (
+  product_id INT NOT NULL,
+  shard INT NOT NULL,
+  stock_amount INT NOT NULL,
+  PRIMARY KEY (product_id, shard),
+  FOREIGN KEY (product_id) REFERENCES products(product_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS product_changes (
+  seq INT AUTO_INCREMENT PRIMARY KEY,
+  product_id INT NOT NULL,
+  op VARCHAR(10) NOT NULL,
+  name VARCHAR(255),
+  price DECIMAL(10,2),
+  stock_amount INT,
+  changed_at DATETIME NOT NULL,
+  INDEX ix_product_changes_product_seq (product_id, seq)
+);
+
+CREATE TABLE IF NOT EXISTS catalog_version (
+  id INT PRIMARY KEY,
+  version INT NOT NULL
 );
 
 CREATE TABLE IF NOT EXISTS orders (
@@ -26,7 +51,8 @@ CREATE TABLE IF NOT EXISTS orders (
   order_date DATE,
   shipping_address VARCHAR(255),
   total_price DECIMAL(10,2),
-  FOREIGN KEY (customer_id) REFERENCES customers(customer_id)
+  FOREIGN KEY (customer_id) REFERENCES customers(customer_id),
+  INDEX ix_orders_status_date (status, order_date)
 );
 
 CREATE TABLE IF NOT EXISTS order_items (
@@ -34,6 +60,7 @@ CREATE TABLE IF NOT EXISTS order_items (
   order_id INT,
   product_id INT,
   quantity INT NOT NULL,
+  unit_price DECIMAL(10,2),
   FOREIGN KEY (order_id) REFERENCES orders(order_id),
   FOREIGN KEY (product_id) REFERENCES products(product_id)
 );
@@ -44,7 +71,65 @@ CREATE TABLE IF NOT EXISTS payments (
   payment_method VARCHAR(50) NOT NULL,
   amount DECIMAL(10,2) NOT NULL,
   paid_at DATETIME NOT NULL,
-  FOREIGN KEY (order_id) REFERENCES orders(order_id)
+  external_ref VARCHAR(128) NULL,
+  FOREIGN KEY (order_id) REFERENCES orders(order_id),
+  UNIQUE KEY ux_payments_external_ref (external_ref),
+  INDEX ix_payments_paid_at (paid_at, payment_id),
+  INDEX ix_payments_method_paid_at (payment_method, paid_at, payment_id),
+  INDEX ix_payments_order_paid_at (order_id, paid_at, payment_id)
+);
+
+CREATE TABLE IF NOT EXISTS payment_rollups (
+  dimension VARCHAR(20) NOT NULL,
+  bucket VARCHAR(50) NOT NULL,
+  payment_count INT NOT NULL DEFAULT 0,
+  total_amount DOUBLE NOT NULL DEFAULT 0,
+  PRIMARY KEY (dimension, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS payment_import_staging (
+  import_id VARCHAR(32) NOT NULL,
+  line_no INT NOT NULL,
+  order_id INT NOT NULL,
+  payment_method VARCHAR(50) NOT NULL,
+  amount DOUBLE NOT NULL,
+  paid_at DATETIME NOT NULL,
+  external_ref VARCHAR(128) NOT NULL,
+  duplicate BOOLEAN NOT NULL DEFAULT FALSE,
+  PRIMARY KEY (import_id, line_no),
+  INDEX ix_payment_import_staging_order (import_id, order_id)
+);
+
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+  id INT AUTO_INCREMENT PRIMARY KEY,
+  token_key VARCHAR(64) NOT NULL,
+  revoked_at DATETIME NOT NULL,
+  expires_at DATETIME NOT NULL,
+  INDEX ix_revoked_tokens_revoked_at (revoked_at),
+  INDEX ix_revoked_tokens_expires_at (expires_at)
+);
+
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+  bucket_key VARCHAR(200) PRIMARY KEY,
+  tokens DOUBLE NOT NULL,
+  updated_at DOUBLE NOT NULL,
+  INDEX ix_rate_limit_buckets_updated_at (updated_at)
+);
+
+CREATE TABLE IF NOT EXISTS replica_heartbeat (
+  id INT PRIMARY KEY,
+  beat_at DOUBLE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  user_id INT NOT NULL,
+  route VARCHAR(64) NOT NULL,
+  idempotency_key VARCHAR(128) NOT NULL,
+  request_hash CHAR(64) NOT NULL,
+  response TEXT NOT NULL,
+  created_at DATETIME NOT NULL,
+  PRIMARY KEY (user_id, route, idempotency_key),
+  INDEX ix_idempotency_keys_created_at (created_at)
 );
 
 CREATE TABLE IF NOT EXISTS user_wishlist (
@@ -28,17 +28,62 @@ def get_headers():
 # Helper Functions
 # ==========================================
 def get_products():
-    r = requests.get(f"{API_URL}/products", headers=get_headers())
-    return pd.DataFrame(r.json()) if r.status_code == 200 else None
+    # Revalidate the first page with the last ETag; the ETag changes with any
+    # catalog write, so a 304 means every cached page is still current.
+    cached = st.session_state.get("products_cache")
+    headers = get_headers()
+    if cached:
+        headers["If-None-Match"] = cached["etag"]
+    params = {"limit": 1000}
+    r = requests.get(f"{API_URL}/products", params=params, headers=headers)
+    if r.status_code == 304 and cached:
+        return cached["df"]
+    if r.status_code != 200:
+        return None
+    etag = r.headers.get("ETag")
+    # Follow the keyset cursor until the last page.
+    products = r.json()
+    while r.headers.get("X-Next-Cursor"):
+        params["after"] = r.headers["X-Next-Cursor"]
+        r = requests.get(f"{API_URL}/products", params=params, headers=get_headers())
+        if r.status_code != 200:
+            return None
+        products.extend(r.json())
+    df = pd.DataFrame(products)
+    if etag:
+        st.session_state["products_cache"] = {"etag": etag, "df": df}
+    return df
 
 
 def get_orders():
-    r = requests.get(f"{API_URL}/orders", headers=get_headers())
+    # Follow the keyset cursor until the last page.
+    orders, params = [], {"limit": 200}
+    while True:
+        r = requests.get(f"{API_URL}/orders", params=params, headers=get_headers())
+        if r.status_code != 200:
+            return None
+        orders.extend(r.json())
+        cursor = r.headers.get("X-Next-Cursor")
+        if not cursor:
+            return pd.DataFrame(orders).drop(columns=["items"], errors="ignore")
+        params["before"] = cursor
+
+
+def get_cart():
+    r = requests.get(f"{API_URL}/orders", params={"status": "TEMP", "include": "products", "limit": 1},
+                     headers=get_headers())
+    return r.json()[0] if r.status_code == 200 and r.json() else None
+
+
+def get_payments(params=None):
+    # One page, newest first; the filters are applied by the API.
+    r = requests.get(f"{API_URL}/payments", params=params, headers=get_headers())
     return pd.DataFrame(r.json()) if r.status_code == 200 else None
 
 
-def get_payments():
-    r = requests.get(f"{API_URL}/payments", headers=get_headers())
+def get_payment_summary(dimension):
+    # Pre-aggregated on the server; a few rows instead of every payment.
+    r = requests.get(f"{API_URL}/payments/summary/{dimension}", headers=get_headers())
     return pd.DataFrame(r.json()) if r.status_code == 200 else None
 
 
@@ -127,12 +172,11 @@ elif choice == "Dashboard":
 
 
     # Payments Chart
-    df_payments = get_payments()
-    if df_payments is not None and not df_payments.empty:
-        payment_summary = df_payments.groupby("payment_method")["amount"].sum().reset_index()
-
+    payment_summary = get_payment_summary("method")
+    if payment_summary is not None and not payment_summary.empty:
         fig2, ax2 = plt.subplots()
-        sns.barplot(data=payment_summary, x="payment_method", y="amount", ax=ax2)
+        sns.barplot(data=payment_summary, x="bucket", y="total_amount", ax=ax2)
+        ax2.set_xlabel("payment_method")
         ax2.set_title("Sales by Payment Method")
         ax2.set_ylabel("Total Amount (₪)")
         st.pyplot(fig2)
@@ -146,18 +190,32 @@ elif choice == "Products":
     st.subheader("Available Products")
     df = get_products()
     if df is not None and not df.empty:
+        quantities = {}
         for _, row in df.iterrows():
             st.write(f"**{row['name']}** — ₪{row['price']} (Stock: {row['stock_amount']})")
             col1, col2 = st.columns(2)
-            if col1.button("🛒 Add to Cart", key=f"order_{row['product_id']}"):
-                r = requests.post(f"{API_URL}/orders/add_item/?product_id={row['product_id']}&quantity=1",
-                                  headers=get_headers())
-                st.success("Added to order!") if r.status_code == 200 else st.error("Failed to add item.")
+            quantities[int(row["product_id"])] = col1.number_input(
+                "Quantity", min_value=0, step=1, value=0, key=f"qty_{row['product_id']}"
+            )
             if col2.button("Add to Wishlist", key=f"fav_{row['product_id']}"):
                 r = requests.post(f"{API_URL}/wishlist/",
                                   json={"product_id": row["product_id"], "customer_id": 1},
                                   headers=get_headers())
                 st.success("Added to wishlist!") if r.status_code == 200 else st.error("Failed to add to wishlist.")
+
+        # One request (and one transaction) for the whole selection
+        selected = [{"product_id": pid, "quantity": int(qty)} for pid, qty in quantities.items() if qty > 0]
+        if st.button("🛒 Add Selected to Cart", disabled=not selected):
+            r = requests.post(f"{API_URL}/orders/items/batch", json=selected, headers=get_headers())
+            if r.status_code == 200:
+                report = r.json()
+                if report["added"]:
+                    st.success(f"Added {report['added']} item(s) to order!")
+                for line in report["results"]:
+                    if line["status"] != "added":
+                        st.error(f"Product {line['product_id']}: {line['status'].replace('_', ' ')}")
+            else:
+                st.error("Failed to add items.")
     else:
         st.warning("No products available.")
 
@@ -175,6 +233,13 @@ elif choice == "Orders":
         if not temp_orders.empty:
             st.markdown("### Current Cart (TEMP Orders)")
             st.dataframe(temp_orders)
+            cart = get_cart()
+            if cart and cart["items"]:
+                st.dataframe(pd.DataFrame([
+                    {"product": (line["product"] or {}).get("name"), "price": (line["product"] or {}).get("price"),
+                     "quantity": line["quantity"]}
+                    for line in cart["items"]
+                ]))
             order_id = int(temp_orders.iloc[0]["order_id"])
             if st.button("Close Order"):
                 r = requests.put(f"{API_URL}/orders/close/{order_id}", headers=get_headers())
@@ -189,8 +254,19 @@ elif choice == "Orders":
 
 
 elif choice == "Payments":
-    st.subheader("All Payments")
-    df_payments = get_payments()
+    st.subheader("Payments")
+    col1, col2, col3 = st.columns(3)
+    date_from = col1.date_input("From", value=None)
+    date_to = col2.date_input("To (exclusive)", value=None)
+    method = col3.text_input("Method")
+    params = {"limit": 200}
+    if date_from:
+        params["from"] = date_from.isoformat()
+    if date_to:
+        params["to"] = date_to.isoformat()
+    if method:
+        params["method"] = method
+    df_payments = get_payments(params)
 
     if df_payments is not None and not df_payments.empty:
         st.dataframe(df_payments)
@@ -198,17 +274,20 @@ elif choice == "Payments":
         # ==========================================
         # Pie Chart: Payment Methods Distribution
         # ==========================================
-        method_counts = df_payments["payment_method"].value_counts()
-        fig_pie_pay, ax_pie_pay = plt.subplots()
-        ax_pie_pay.pie(
-            method_counts.values,
-            labels=method_counts.index,
-            autopct="%1.1f%%",
-            startangle=90,
-            colors=["#3498DB", "#2ECC71", "#E67E22", "#E74C3C"]
-        )
-        ax_pie_pay.set_title("Payment Methods Distribution")
-        st.pyplot(fig_pie_pay)
+        method_counts = get_payment_summary("method")
+        if method_counts is not None and not method_counts.empty:
+            fig_pie_pay, ax_pie_pay = plt.subplots()
+            ax_pie_pay.pie(
+                method_counts["payment_count"],
+                labels=method_counts["bucket"],
+                autopct="%1.1f%%",
+                startangle=90,
+                colors=["#3498DB", "#2ECC71", "#E67E22", "#E74C3C"]
+            )
+            ax_pie_pay.set_title("Payment Methods Distribution")
+            st.pyplot(fig_pie_pay)
+        else:
+            st.info("No payment summary available.")
 
     else:
         st.warning("No payments found or unauthorized access.")
@@ -230,14 +309,18 @@ elif choice == "Wishlist":
 elif choice == "Search Products":
     st.subheader("Search Products")
     name = st.text_input("Product Name (optional)")
+    if name:
+        r = requests.get(f"{API_URL}/products/suggest", params={"q": name, "limit": 5})
+        if r.status_code == 200 and r.json():
+            st.caption("Suggestions: " + ", ".join(s["name"] for s in r.json()))
     min_price = st.number_input("Min Price", 0.0, step=1.0)
     max_price = st.number_input("Max Price", 0.0, step=1.0)
     min_stock = st.number_input("Min Stock", 0, step=1)
     max_stock = st.number_input("Max Stock", 0, step=1)
 
     if st.button("Search"):
-        params = {"name": name, "min_price": min_price, "max_price": max_price,
-                  "min_stock": min_stock, "max_stock": max_stock}
+        params = {"name": name or None, "min_price": min_price or None, "max_price": max_price or None,
+                  "min_stock": min_stock or None, "max_stock": max_stock or None}
         response = requests.get(f"{API_URL}/products/search/", params=params, headers=get_headers())
         if response.status_code == 200:
             results = response.json()
@@ -299,5 +382,7 @@ elif choice == "Login / Register":
                 st.error("Invalid username or password.")
 
     elif action == "Logout":
+        if st.session_state["token"]:
+            requests.post(f"{API_URL}/auth/logout", headers=get_headers())
         st.session_state["token"] = None
         st.info("You have been logged out.")
@@ -0,0 +1,27 @@
+import os
+import tempfile
+
+# The backend reads its configuration at import time, so point it at a
+# scratch SQLite database before any test module imports it.
+_workdir = tempfile.mkdtemp(prefix="buysmart-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_workdir, 'test.db')}")
+os.environ.setdefault("SECRET_KEY", "tests")
+
+import pytest  # noqa: E402
+
+from backend import database  # noqa: E402
+from backend.base import Base  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """A session on freshly created tables, dropped again after the test."""
+    from backend import models  # noqa: F401  (registers the tables)
+
+    Base.metadata.create_all(bind=database.engine)
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(bind=database.engine)
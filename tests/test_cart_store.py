@@ -0,0 +1,30 @@
+import multiprocessing
+import os
+
+from backend.cart_store import DbmCartStore
+
+WORKERS = 4
+ADDS = 50
+
+
+def _add_many(path: str) -> None:
+    store = DbmCartStore(path, ttl=3600)
+    for _ in range(ADDS):
+        store.add(1, {7: 1})
+
+
+def test_dbm_store_keeps_adds_from_several_processes(tmp_path):
+    path = os.path.join(tmp_path, "carts.dbm")
+    store = DbmCartStore(path, ttl=3600)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_add_many, args=(path,)) for _ in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert all(worker.exitcode == 0 for worker in workers)
+    assert store.get(1) == {7: WORKERS * ADDS}
+    store.remove(1, {7: WORKERS * ADDS})
+    assert store.get(1) == {}
+    assert store.stats()["size"] == 0
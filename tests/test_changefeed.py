@@ -0,0 +1,17 @@
+from backend import changefeed, models
+
+
+def test_every_recorded_change_bumps_the_catalog_version(db):
+    product = models.Product(name="Versioned", price=1.0, stock_amount=1)
+    db.add(product)
+    db.flush()
+    assert changefeed.version(db) == (0, 0)
+
+    changefeed.record(db, [product.product_id])
+    db.commit()
+    head, first = changefeed.version(db)
+    assert head > 0 and first == 1
+
+    changefeed.record_deleted(db, [product.product_id])
+    db.commit()
+    assert changefeed.version(db) == (head + 1, 2)
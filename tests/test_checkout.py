@@ -0,0 +1,37 @@
+from backend import checkout, database, models
+
+
+def _product(db, price: float) -> int:
+    product = models.Product(name="Lamp", price=price, stock_amount=10)
+    db.add(product)
+    db.commit()
+    return product.product_id
+
+
+def test_checkout_relocks_when_a_line_lands_between_the_locks(db, monkeypatch):
+    first, second = _product(db, 2.0), _product(db, 3.0)
+    order = models.Order(status=models.OrderStatus.TEMP, total_price=2.0)
+    db.add(order)
+    db.flush()
+    db.add(models.OrderItem(order_id=order.order_id, product_id=first, quantity=1))
+    db.commit()
+    lock_products = checkout._lock_products
+    locked = []
+
+    def lock_then_add(db, batch, user_id):
+        product_ids = lock_products(db, batch, user_id)
+        if not locked:
+            # A cart add commits after the product locks, before the order lock.
+            with database.SessionLocal() as other:
+                other.add(models.OrderItem(order_id=order.order_id, product_id=second, quantity=2))
+                other.commit()
+        locked.append(product_ids)
+        return product_ids
+
+    monkeypatch.setattr(checkout, "_lock_products", lock_then_add)
+    [result] = checkout.checkout_orders(db, [order.order_id])
+
+    # The first attempt is rolled back; the second locks both products.
+    assert locked == [[first], [first, second]]
+    assert result.status == "closed"
+    assert result.total_price == 8.0
@@ -0,0 +1,45 @@
+import io
+
+import pytest
+
+from backend import importer, models, rollups
+
+CSV = (
+    "order_id,amount,payment_method,paid_at,reference\n"
+    "{order},10.00,card,2025-03-01T12:00:00,\n"
+    "{order},5.00,cash,2025-03-01T13:00:00,\n"
+    "{order},2.50,card,2025-03-02T09:00:00,SETTLE-1\n"
+)
+
+
+def _order(db) -> int:
+    order = models.Order(status=models.OrderStatus.CLOSE, total_price=17.5)
+    db.add(order)
+    db.commit()
+    return order.order_id
+
+
+def test_importing_a_file_again_skips_its_payments(db):
+    data = CSV.format(order=_order(db)).encode()
+
+    first = importer.import_payments(db, io.BytesIO(data))
+    second = importer.import_payments(db, io.BytesIO(data))
+
+    assert (first.rows_written, first.rows_duplicate) == (3, 0)
+    assert (second.rows_written, second.rows_duplicate) == (0, 3)
+    assert db.query(models.Payment).count() == 3
+    assert {row.bucket: row.payment_count for row in rollups.summary(db, "method")} == {"card": 2, "cash": 1}
+    assert db.query(models.PaymentImportStaging).count() == 0
+
+
+def test_failed_import_raises_its_own_error_and_drops_staging(db, monkeypatch):
+    data = CSV.format(order=_order(db)).encode()
+
+    def fail(db, report):
+        raise RuntimeError("reconcile failed")
+
+    monkeypatch.setattr(importer, "reconcile_payments", fail)
+    with pytest.raises(RuntimeError, match="reconcile failed"):
+        importer.import_payments(db, io.BytesIO(data))
+
+    assert db.query(models.PaymentImportStaging).count() == 0
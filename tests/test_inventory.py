@@ -0,0 +1,72 @@
+from sqlalchemy import update
+
+from backend import database, inventory, models
+
+
+def _sharded_product(db, stock_amount: int, shards: int) -> int:
+    product = models.Product(name="Sharded", price=1.0, stock_amount=stock_amount)
+    db.add(product)
+    db.commit()
+    inventory.set_shards(db, product.product_id, shards)
+    return product.product_id
+
+
+def _drift(db, product_id: int, extra: int) -> None:
+    """Move stock in one shard without touching products.stock_amount, as reservations do."""
+    db.execute(
+        update(models.ProductStockShard)
+        .where(models.ProductStockShard.product_id == product_id, models.ProductStockShard.shard == 0)
+        .values(stock_amount=models.ProductStockShard.stock_amount + extra)
+    )
+    db.commit()
+
+
+def test_reconcile_copies_shard_total(db):
+    product_id = _sharded_product(db, 10, 4)
+    _drift(db, product_id, 5)
+
+    inventory.reconcile(db)
+
+    db.expire_all()
+    assert db.get(models.Product, product_id).stock_amount == 15
+
+
+def test_reconcile_leaves_product_unsharded_after_its_scan(db, monkeypatch):
+    product_id = _sharded_product(db, 10, 4)
+    _drift(db, product_id, 5)
+    scan = inventory._reconcile_candidates
+
+    def scan_then_unshard(session):
+        candidates = scan(session)
+        assert [row.product_id for row in candidates] == [product_id]
+        # Between reconcile's scan and its write: unshard the product and sell
+        # from the single counter, which is authoritative from then on.
+        other = database.SessionLocal()
+        try:
+            inventory.set_shards(other, product_id, 0)
+            other.execute(update(models.Product).where(models.Product.product_id == product_id).values(stock_amount=3))
+            other.commit()
+        finally:
+            other.close()
+        return candidates
+
+    monkeypatch.setattr(inventory, "_reconcile_candidates", scan_then_unshard)
+    inventory.reconcile(db)
+
+    db.expire_all()
+    product = db.get(models.Product, product_id)
+    assert product.stock_shards == 0
+    assert product.stock_amount == 3
+    assert db.query(models.ProductStockShard).filter_by(product_id=product_id).count() == 0
+
+
+def test_reserve_with_stale_unsharded_count_takes_from_shards(db):
+    # The caller read stock_shards == 0, then set_shards(4) committed.
+    product_id = _sharded_product(db, 10, 4)
+
+    assert inventory.reserve_stock(db, product_id, 3, 0)
+    db.commit()
+
+    db.expire_all()
+    assert db.get(models.Product, product_id).stock_amount == 10
+    assert inventory.shard_totals(db, [product_id]) == {product_id: 7}
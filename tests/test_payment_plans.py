@@ -0,0 +1,93 @@
+"""
+Query plan regression test: every GET /payments/ filter combination must be
+answered by a range scan on its composite index, never a full table scan or a
+filesort. Only meaningful against MySQL, so it is skipped on any other
+DATABASE_URL. The tables are seeded and analyzed first: on an empty table the
+optimizer's choice says nothing about production plans.
+"""
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert, text
+
+from backend import database, models
+from backend.base import Base
+from backend.routers.payments import payments_query
+
+pytestmark = pytest.mark.skipif(
+    database.engine.dialect.name != "mysql", reason="query plans are checked against MySQL only"
+)
+
+USERS = 200
+ORDERS = 5000
+PAYMENTS = 50000
+METHODS = ["card", "paypal", "bank_transfer", "gift_card", "cash"]
+SEED_START = datetime(2024, 7, 1)
+SEED_DAYS = 365
+
+FROM = datetime(2025, 1, 1)
+TO = datetime(2025, 2, 1)
+CURSOR = (datetime(2025, 1, 15), PAYMENTS // 2)
+
+# (filters, index the plan must use)
+CASES = {
+    "time range": ({"paid_from": FROM, "paid_to": TO}, "ix_payments_paid_at"),
+    "time range + cursor": ({"paid_from": FROM, "paid_to": TO, "cursor": CURSOR}, "ix_payments_paid_at"),
+    "cursor only": ({"cursor": CURSOR}, "ix_payments_paid_at"),
+    "method": ({"method": "card"}, "ix_payments_method_paid_at"),
+    "method + time range + cursor": (
+        {"method": "card", "paid_from": FROM, "cursor": CURSOR}, "ix_payments_method_paid_at"
+    ),
+    "order": ({"order_id": 42}, "ix_payments_order_paid_at"),
+    "order + time range": ({"order_id": 42, "paid_from": FROM, "paid_to": TO}, "ix_payments_order_paid_at"),
+}
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    """Users, orders in every status and payments spread over a year and every method, then ANALYZE."""
+    Base.metadata.create_all(bind=database.engine)
+    rng = random.Random(17)
+    statuses = list(models.OrderStatus)
+    try:
+        with database.engine.begin() as conn:
+            conn.execute(insert(models.User), [
+                {
+                    "id": i, "first_name": "Plan", "last_name": f"User {i}", "email": f"plan{i}@example.com",
+                    "username": f"plan{i}", "password_hash": "not-a-hash",
+                }
+                for i in range(1, USERS + 1)
+            ])
+            conn.execute(insert(models.Order), [
+                {
+                    "order_id": i, "user_id": rng.randint(1, USERS), "status": rng.choice(statuses),
+                    "order_date": (SEED_START + timedelta(days=rng.randrange(SEED_DAYS))).date(), "total_price": 0.0,
+                }
+                for i in range(1, ORDERS + 1)
+            ])
+            conn.execute(insert(models.Payment), [
+                {
+                    "payment_id": i, "order_id": rng.randint(1, ORDERS), "payment_method": rng.choice(METHODS),
+                    "amount": round(rng.uniform(1, 500), 2),
+                    "paid_at": SEED_START + timedelta(seconds=rng.randrange(SEED_DAYS * 86400)),
+                }
+                for i in range(1, PAYMENTS + 1)
+            ])
+            conn.execute(text("ANALYZE TABLE users, orders, payments"))
+        yield
+    finally:
+        Base.metadata.drop_all(bind=database.engine)
+
+
+@pytest.mark.parametrize("filters, index", CASES.values(), ids=CASES.keys())
+def test_payments_query_uses_index(seeded, filters, index):
+    sql = str(payments_query(**filters).compile(
+        dialect=database.engine.dialect, compile_kwargs={"literal_binds": True}
+    ))
+    with database.engine.connect() as conn:
+        plan = conn.execute(text(f"EXPLAIN {sql}")).mappings().first()
+
+    assert plan["key"] == index, plan
+    assert plan["type"] in ("range", "ref"), plan
+    assert "filesort" not in (plan["Extra"] or ""), plan
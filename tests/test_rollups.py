@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from backend import models, rollups
+
+
+def _pay(db, amount: float, method: str = "card") -> models.Payment:
+    payment = models.Payment(order_id=None, payment_method=method, amount=amount, paid_at=datetime(2025, 3, 1, 12))
+    db.add(payment)
+    db.flush()
+    return payment
+
+
+def _by_method(db) -> dict:
+    return {row.bucket: (row.payment_count, row.total_amount) for row in rollups.summary(db, "method")}
+
+
+def test_ensure_built_counts_existing_payments_once(db):
+    _pay(db, 10.0)
+    _pay(db, 5.0, "cash")
+    db.commit()
+
+    # Every worker runs this at startup; only the first may build.
+    rollups.ensure_built(db)
+    rollups.ensure_built(db)
+
+    assert _by_method(db) == {"card": (1, 10.0), "cash": (1, 5.0)}
+
+
+def test_rebuild_keeps_counting_later_payments(db):
+    rollups.apply(db, [_pay(db, 10.0)])
+    db.commit()
+
+    assert rollups.rebuild(db) == 1
+    rollups.apply(db, [_pay(db, 2.5)])
+    db.commit()
+
+    assert _by_method(db) == {"card": (2, 12.5)}
+    assert db.get(models.PaymentRollup, rollups.REBUILD_LOCK) is not None
+    assert rollups.rebuild(db) == 2
+    assert _by_method(db) == {"card": (2, 12.5)}
@@ -0,0 +1,114 @@
+import random
+
+from backend import database, models, search
+from backend.search import ProductSearchIndex
+
+
+def _ranked(docs: dict, terms: list, low=None, high=None) -> list:
+    """Reference ranking by brute force over (name, price) docs."""
+
+    def matches(word: str, term: str) -> bool:
+        return word.startswith(term) if len(term) < 3 else term in word
+
+    scored = []
+    for product_id, (name, price) in docs.items():
+        words = search.tokenize(name)
+        if low is not None and price < low or high is not None and price > high:
+            continue
+        if all(any(matches(word, term) for word in words) for term in terms):
+            hits = sum(term in words for term in terms)
+            scored.append((hits < len(terms), -hits, product_id))
+    return [product_id for *_, product_id in sorted(scored)]
+
+
+def test_search_ranks_like_brute_force():
+    rng = random.Random(7)
+    vocab = ["phone", "iphone", "case", "black", "blue", "usb", "cable", "charger", "ab", "abc", "cab"]
+    index = ProductSearchIndex()
+    docs = {}
+    for product_id in range(1, 400):
+        name = " ".join(rng.sample(vocab, rng.randint(1, 4)))
+        price = round(rng.uniform(1, 100), 2)
+        docs[product_id] = (name, price)
+        index.upsert(product_id, name, price, rng.randint(0, 50))
+
+    for query in ["phone", "hone", "ca", "cab", "phone case", "ab cab", "blue ab", "usb nothing"]:
+        terms = list(dict.fromkeys(search.tokenize(query)))
+        expected = _ranked(docs, terms)
+        total, page = index.search(query, limit=1000)
+        assert total == len(expected), query
+        assert [product.product_id for product in page] == expected, query
+
+    expected = _ranked(docs, ["phone"], low=20, high=60)
+    total, page = index.search("phone", min_price=20, max_price=60, limit=10, offset=5)
+    assert total == len(expected)
+    assert [product.product_id for product in page] == expected[5:15]
+
+
+def test_search_total_is_exact_for_one_word_past_the_cap(monkeypatch):
+    monkeypatch.setattr(search, "SEARCH_MAX_MATCHES", 10)
+    index = ProductSearchIndex()
+    index.upsert_many((product_id, "red lamp", 5.0, 1) for product_id in range(1, 101))
+
+    total, page = index.search("lamp", limit=5)
+
+    assert total == 100
+    assert [product.product_id for product in page] == [1, 2, 3, 4, 5]
+
+
+def test_search_follows_writes():
+    index = ProductSearchIndex()
+    index.upsert(1, "Walnut desk", 100.0, 3)
+    index.upsert(2, "Oak desk", 80.0, 0)
+
+    index.upsert(1, "Walnut table", 100.0, 3)
+    index.adjust_stock(2, 4)
+
+    assert [product.product_id for product in index.search("desk", min_stock=1)[1]] == [2]
+    assert index.search("walnut desk")[0] == 0
+    index.remove(2)
+    assert index.search("desk")[0] == 0
+    assert "desk" not in index._tokens
+
+
+def test_build_reads_rows_outside_the_lock_and_keeps_writes(db, monkeypatch):
+    for name in ("Red chair", "Blue chair", "Green chair"):
+        db.add(models.Product(name=name, price=10.0, stock_amount=5))
+    db.commit()
+    index = ProductSearchIndex()
+    current_rows = search._current_rows
+    calls = []
+
+    def read_then_write(session_factory, product_ids, columns):
+        assert not index._lock.locked()
+        rows = current_rows(session_factory, product_ids, columns)
+        if not calls:
+            # A sale lands after the rows were read: the re-read must not undo it.
+            db.query(models.Product).filter_by(product_id=1).update({"stock_amount": 4})
+            db.commit()
+            index.adjust_stock(1, -1)
+        calls.append(set(product_ids))
+        return rows
+
+    scan = search.select
+
+    def select_then_write(*columns):
+        # The build's scan runs first; write while it is in flight.
+        if len(columns) > 3 and not calls:
+            db.query(models.Product).filter_by(product_id=2).update({"name": "Blue sofa"})
+            db.commit()
+            index.upsert(2, "Blue sofa", 10.0, 5)
+            monkeypatch.setattr(search, "select", scan)
+        return scan(*columns)
+
+    monkeypatch.setattr(search, "_current_rows", read_then_write)
+    monkeypatch.setattr(search, "select", select_then_write)
+    index.build(database.SessionLocal)
+
+    assert calls[0] == {2}
+    assert calls[-1] == {1}
+    assert index._touched is None
+    assert [product.product_id for product in index.search("chair")[1]] == [1, 3]
+    assert [product.product_id for product in index.search("sofa")[1]] == [2]
+    assert index.search("red", min_stock=4, max_stock=4)[0] == 1
+
@@ -0,0 +1,31 @@
+import pytest
+from fastapi import HTTPException
+
+from backend import models, security
+
+
+def _register(db, username: str) -> models.User:
+    user = models.User(
+        first_name="Test", last_name="User", email=f"{username}@example.com",
+        username=username, password_hash="not-a-hash",
+    )
+    db.add(user)
+    db.commit()
+    return user
+
+
+def test_token_rejected_after_username_is_registered_again(db):
+    old = _register(db, "reused")
+    token = security.create_access_token(security.access_token_claims(old))
+    assert security.get_current_user(token, db).id == old.id
+
+    db.delete(old)
+    db.commit()
+    security.invalidate_user("reused")
+    new = _register(db, "reused")
+
+    with pytest.raises(HTTPException) as raised:
+        security.get_current_user(token, db)
+    assert raised.value.status_code == 401
+    new_token = security.create_access_token(security.access_token_claims(new))
+    assert security.get_current_user(new_token, db).id == new.id